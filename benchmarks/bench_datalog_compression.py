@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""
+Measure compressed datalog ratio and CPU cost on representative port agent data:
+ASCII instrument records with a varying rate, a heartbeat every 10 seconds and
+periodic status packets, as the DATALOGGER endpoint receives them from the router.
+
+For each compression level and frame size reports the compression ratio, the CPU
+time to compress and write, and the CPU time to read the packets back with
+PacketReader, compared with an uncompressed datalog.
+
+Usage:
+    bench_datalog_compression.py [--size=<mb>] [--levels=<levels>] [--frames=<sizes>]
+
+Options:
+    --size=<mb>         Uncompressed size of the generated data in MB [default: 32]
+    --levels=<levels>   Comma separated zlib levels [default: 1,6,9]
+    --frames=<sizes>    Comma separated frame sizes in KB [default: 256,1024]
+"""
+import os
+import random
+import tempfile
+import time
+
+import docopt
+
+from ooi_port_agent.common import PacketType
+from ooi_port_agent.datalog import FrameCompressor
+from ooi_port_agent.datalog import open_datalog
+from ooi_port_agent.packet import FakeClock
+from ooi_port_agent.packet import Packet
+from ooi_port_agent.packet import PacketReader
+
+
+# seconds between the NTP and Unix epochs
+NTP_EPOCH_OFFSET = 2208988800
+
+
+def make_batches(size):
+    """
+    :return: list of lists of packed packets, one list per router flush
+    """
+    rand = random.Random(0)
+    clock = FakeClock(start=3800000000, step=0.25)
+    batches = []
+    written = 0
+    count = 0
+    temperature = 10.0
+    while written < size:
+        batch = []
+        for _ in xrange(rand.randint(1, 8)):
+            temperature += rand.gauss(0, 0.001)
+            sample_time = time.strftime('%d %b %Y %H:%M:%S', time.gmtime(clock.time - NTP_EPOCH_OFFSET))
+            record = '#  %8.4f,  %7.5f,  %8.3f,   %6.4f, %8.3f, %s\r\n' % (
+                temperature, 3.8 + rand.random() * 0.01, 1500 + rand.random(), rand.random(),
+                34 + rand.random() * 0.1, sample_time)
+            batch.append(Packet.create(record, PacketType.FROM_INSTRUMENT, clock=clock)[0].data)
+            count += 1
+            if count % 40 == 0:
+                batch.append(Packet.create('HB', PacketType.PA_HEARTBEAT, clock=clock)[0].data)
+            if count % 1000 == 0:
+                status = 'instrument connected: 10.31.8.7:4001 clients: 2 bytes: %d' % written
+                batch.append(Packet.create(status, PacketType.PA_STATUS, clock=clock)[0].data)
+        batches.append(batch)
+        written += sum(map(len, batch))
+    return batches, written
+
+
+def write_plain(path, batches):
+    with open(path, 'wb') as fh:
+        for batch in batches:
+            fh.writelines(batch)
+
+
+def write_compressed(path, batches, level, frame_bytes):
+    compressor = FrameCompressor(level=level, frame_bytes=frame_bytes)
+    with open(path, 'wb') as fh:
+        for batch in batches:
+            fh.write(compressor.compress(batch))
+        fh.write(compressor.end())
+    return compressor.frames
+
+
+def read_packets(path):
+    with open_datalog(path) as fh:
+        return sum(1 for _ in PacketReader(fh))
+
+
+def timed(func, *args):
+    start = time.clock()
+    result = func(*args)
+    return result, time.clock() - start
+
+
+def main():
+    options = docopt.docopt(__doc__)
+    batches, size = make_batches(int(float(options['--size']) * 1e6))
+    mb = size / 1e6
+    levels = [int(level) for level in options['--levels'].split(',')]
+    frame_sizes = [int(kb) * 1024 for kb in options['--frames'].split(',')]
+
+    fd, path = tempfile.mkstemp(suffix='.datalog')
+    os.close(fd)
+    try:
+        print 'data: %.1f MB in %d batches' % (mb, len(batches))
+        print '%-18s %8s %8s %10s %10s %10s' % ('format', 'frames', 'ratio', 'write cpu', 'MB/s', 'read MB/s')
+
+        _, write_cpu = timed(write_plain, path, batches)
+        packets, read_cpu = timed(read_packets, path)
+        print '%-18s %8s %8.2f %9.2fs %10.1f %10.1f' % ('plain', '-', 1.0, write_cpu, mb / write_cpu,
+                                                         mb / read_cpu)
+
+        for level in levels:
+            for frame_bytes in frame_sizes:
+                frames, write_cpu = timed(write_compressed, path, batches, level, frame_bytes)
+                count, read_cpu = timed(read_packets, path)
+                assert count == packets
+                ratio = size / float(os.path.getsize(path))
+                name = 'gzip-%d %dKB' % (level, frame_bytes // 1024)
+                print '%-18s %8d %8.2f %9.2fs %10.1f %10.1f' % (name, frames, ratio, write_cpu, mb / write_cpu,
+                                                                 mb / read_cpu)
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
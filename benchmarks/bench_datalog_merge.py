@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+Measure the throughput of merging many datalogs in timestamp order.
+
+Writes the given number of datalogs, each the record of one port sampling at its own rate,
+all covering the same period, so their packets interleave throughout. Reports the wall time
+and packet rate of reading every file one after the other without merging, then of merging
+all the files decoded in this process and decoded by each number of worker processes.
+
+Usage:
+    bench_datalog_merge.py [--packets=<count>] [--files=<counts>] [--processes=<counts>] [--compressed]
+
+Options:
+    --packets=<count>       Total packets written across the files [default: 1000000]
+    --files=<counts>        Comma separated numbers of files [default: 8,64]
+    --processes=<counts>    Comma separated numbers of worker processes, 0 decodes in process [default: 0,2,4]
+    --compressed            Write compressed datalogs
+"""
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import docopt
+
+from ooi_port_agent.common import PacketType
+from ooi_port_agent.datalog import FrameCompressor
+from ooi_port_agent.datalog import open_datalog
+from ooi_port_agent.merge import DatalogMerge
+from ooi_port_agent.packet import FakeClock
+from ooi_port_agent.packet import Packet
+from ooi_port_agent.packet import PacketReader
+
+
+def write_files(directory, files, packets, compressed):
+    """
+    :return: list of paths, bytes written before compression
+    """
+    rand = random.Random(0)
+    paths = []
+    size = 0
+    per_file = packets // files
+    for index in xrange(files):
+        # every port covers the same period at its own rate
+        step = 1000.0 / per_file * rand.uniform(0.9, 1.1)
+        clock = FakeClock(start=3800000000 + rand.random(), step=step)
+        data = [Packet.create('PORT%02d,%07d,%8.4f,%7.5f\r\n' % (index, number, rand.gauss(10, 1), rand.random()),
+                              PacketType.FROM_INSTRUMENT, clock=clock)[0].data
+                for number in xrange(per_file)]
+        size += sum(map(len, data))
+        path = os.path.join(directory, 'port%02d.datalog' % index)
+        with open(path, 'wb') as fh:
+            if compressed:
+                compressor = FrameCompressor(level=1)
+                fh.write(compressor.compress(data))
+                fh.write(compressor.end())
+            else:
+                fh.writelines(data)
+        paths.append(path)
+    return paths, size
+
+
+def read_sequential(paths):
+    count = 0
+    for path in paths:
+        with open_datalog(path) as fh:
+            count += sum(1 for _ in PacketReader(fh))
+    return count
+
+
+def read_merged(paths, processes):
+    merge = DatalogMerge(paths, processes=processes)
+    last = 0
+    count = 0
+    for packet in merge:
+        packet_time = packet.header.time
+        assert packet_time >= last
+        last = packet_time
+        count += 1
+    return count
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def main():
+    options = docopt.docopt(__doc__)
+    packets = int(options['--packets'])
+    file_counts = [int(each) for each in options['--files'].split(',')]
+    process_counts = [int(each) for each in options['--processes'].split(',')]
+
+    print '%-8s %-22s %10s %8s %12s %8s' % ('files', 'mode', 'packets', 'seconds', 'packets/s', 'MB/s')
+    for files in file_counts:
+        directory = tempfile.mkdtemp()
+        try:
+            paths, size = write_files(directory, files, packets, options['--compressed'])
+            mb = size / 1e6
+            runs = [('sequential, no merge', read_sequential, (paths,))]
+            runs.extend(('merge, %d processes' % processes, read_merged, (paths, processes))
+                        for processes in process_counts)
+            for name, func, args in runs:
+                count, seconds = timed(func, *args)
+                print '%-8d %-22s %10d %8.2f %12.0f %8.1f' % (files, name, count, seconds, count / seconds,
+                                                              mb / seconds)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
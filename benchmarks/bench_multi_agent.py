@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""
+Compare the memory and CPU footprint of port agents hosted in one process
+with one process per agent. Each agent is a TCP port agent connected to a
+simulated instrument sending a short record at a fixed rate.
+
+Usage:
+    bench_multi_agent.py [--agents=<count>] [--seconds=<seconds>] [--rate=<hz>]
+    bench_multi_agent.py worker <count> <seconds> <rate>
+
+Options:
+    --agents=<count>    Number of port agents [default: 50]
+    --seconds=<seconds> Measurement time [default: 30]
+    --rate=<hz>         Records per second from each instrument [default: 10]
+"""
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import docopt
+from twisted.internet import reactor
+from twisted.internet.protocol import Factory
+from twisted.internet.protocol import Protocol
+from twisted.internet.task import LoopingCall
+
+
+class Instrument(Protocol):
+    def connectionMade(self):
+        self.count = 0
+        self.loop = LoopingCall(self.send)
+        self.loop.start(1.0 / self.factory.rate)
+
+    def send(self):
+        self.count += 1
+        self.transport.write('SAMPLE,%d,1.2345,6.7890\r\n' % self.count)
+
+    def connectionLost(self, reason=None):
+        if self.loop.running:
+            self.loop.stop()
+
+
+def rss_kb():
+    with open('/proc/self/status') as fh:
+        for line in fh:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def cpu_seconds():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def worker(count, seconds, rate):
+    from ooi_port_agent.agents import TcpPortAgent
+
+    factory = Factory()
+    factory.protocol = Instrument
+    factory.rate = rate
+    instrument = reactor.listenTCP(0, factory, interface='127.0.0.1')
+
+    for index in xrange(count):
+        TcpPortAgent({
+            'type': 'tcp',
+            'name': 'bench%03d' % index,
+            'port': 0,
+            'commandport': 0,
+            'sniffport': 0,
+            'ttl': 30,
+            'instaddr': '127.0.0.1',
+            'instport': instrument.getHost().port,
+        }).start()
+
+    start = {}
+
+    def begin():
+        start['cpu'] = cpu_seconds()
+
+    def finish():
+        result = {'rss_kb': rss_kb(), 'cpu': cpu_seconds() - start['cpu']}
+        sys.stdout.write(json.dumps(result) + '\n')
+        sys.stdout.flush()
+        os._exit(0)
+
+    # let connections settle before measuring
+    reactor.callLater(2, begin)
+    reactor.callLater(2 + seconds, finish)
+    reactor.run()
+
+
+def run_workers(processes, count, seconds, rate):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    workdir = tempfile.mkdtemp()
+    try:
+        children = []
+        for index in xrange(processes):
+            cwd = os.path.join(workdir, str(index))
+            os.mkdir(cwd)
+            command = [sys.executable, '-m', 'benchmarks.bench_multi_agent', 'worker', str(count), str(seconds), str(rate)]
+            children.append(subprocess.Popen(command, cwd=cwd, env=env, stdout=subprocess.PIPE))
+        results = [json.loads(child.communicate()[0].splitlines()[-1]) for child in children]
+    finally:
+        shutil.rmtree(workdir)
+    return sum(each['rss_kb'] for each in results), sum(each['cpu'] for each in results)
+
+
+def main():
+    options = docopt.docopt(__doc__)
+    if options['worker']:
+        worker(int(options['<count>']), float(options['<seconds>']), float(options['<rate>']))
+        return
+
+    count = int(options['--agents'])
+    seconds = float(options['--seconds'])
+    rate = float(options['--rate'])
+
+    for label, processes, per_process in (('one process', 1, count), ('process per agent', count, 1)):
+        rss, cpu = run_workers(processes, per_process, seconds, rate)
+        print '%-18s %4d agents: RSS %8d KB (%6d KB/agent) CPU %6.2fs (%5.2f%% of a core/agent)' % (
+            label, count, rss, rss / count, cpu, 100.0 * cpu / seconds / count)
+
+
+if __name__ == '__main__':
+    main()
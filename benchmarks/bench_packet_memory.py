@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""
+Measure memory held per decoded packet and decode throughput
+
+Usage:
+    bench_packet_memory.py [--count=<packets>] [--payload=<bytes>]
+
+Options:
+    --count=<packets>   Number of packets to decode and retain [default: 200000]
+    --payload=<bytes>   Payload size of each packet [default: 32]
+"""
+import gc
+import resource
+import sys
+import time
+
+import docopt
+
+from ooi_port_agent.common import PacketType
+from ooi_port_agent.packet import Packet
+from ooi_port_agent.packet import PacketDecoder
+
+
+def object_size(obj):
+    """
+    Size of an object including its instance dictionary, if it has one
+    """
+    size = sys.getsizeof(obj)
+    instance_dict = getattr(obj, '__dict__', None)
+    if instance_dict is not None:
+        size += sys.getsizeof(instance_dict)
+    return size
+
+
+def max_rss():
+    # ru_maxrss is reported in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def main():
+    options = docopt.docopt(__doc__)
+    count = int(options['--count'])
+    payload_size = int(options['--payload'])
+
+    data = Packet.create('x' * payload_size, PacketType.FROM_INSTRUMENT)[0].data * count
+    gc.collect()
+
+    before = max_rss()
+    start = time.time()
+    packets = PacketDecoder().feed(data)
+    elapsed = time.time() - start
+    after = max_rss()
+
+    packet = packets[0]
+    header_bytes = object_size(packet.header)
+    packet_bytes = object_size(packet)
+    payload_bytes = sys.getsizeof(packet.payload)
+
+    print 'packets decoded:      %d (%d byte payloads)' % (len(packets), payload_size)
+    print 'PacketHeader:         %d bytes' % header_bytes
+    print 'Packet:               %d bytes' % packet_bytes
+    print 'payload string:       %d bytes' % payload_bytes
+    print 'objects per packet:   %d bytes' % (header_bytes + packet_bytes + payload_bytes)
+    print 'RSS growth per packet: %.1f bytes' % ((after - before) / float(len(packets)))
+    print 'decode rate:          %.0f packets/s' % (len(packets) / elapsed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+Compare datalog read throughput of Packet.packet_from_fh and PacketReader
+
+Usage:
+    bench_packet_reader.py [--size=<mb>] [--block=<bytes>] [--junk=<fraction>]
+
+Options:
+    --size=<mb>        Size of the generated datalog in MB [default: 4]
+    --junk=<fraction>  Probability of writing junk between packets [default: 0.01]
+    --block=<bytes>    PacketReader block size [default: 1048576]
+"""
+import os
+import random
+import tempfile
+import time
+
+import docopt
+
+from ooi_port_agent.common import PacketType
+from ooi_port_agent.packet import Packet
+from ooi_port_agent.packet import PacketReader
+
+
+def make_datalog(path, size, junk):
+    """
+    Write a synthetic datalog: mostly short ASCII records with occasional large
+    binary payloads, heartbeats and a little inter-packet junk
+    """
+    rand = random.Random(0)
+    written = 0
+    with open(path, 'wb') as fh:
+        while written < size:
+            roll = rand.random()
+            if roll < 0.01:
+                data = Packet.create(os.urandom(4096), PacketType.FROM_INSTRUMENT)[0].data
+            elif roll < 0.02:
+                data = Packet.create('HB', PacketType.PA_HEARTBEAT)[0].data
+            elif roll < 0.02 + junk:
+                data = 'junk' * rand.randint(1, 64)
+            else:
+                record = 'SAMPLE,%d,%.4f,%.4f,%.4f\r\n' % (written, rand.random(), rand.random(), rand.random())
+                data = Packet.create(record * rand.randint(1, 4), PacketType.FROM_INSTRUMENT)[0].data
+            fh.write(data)
+            written += len(data)
+    return written
+
+
+def read_packet_from_fh(path):
+    count = 0
+    with open(path, 'rb') as fh:
+        while Packet.packet_from_fh(fh) is not None:
+            count += 1
+    return count
+
+
+def read_packet_reader(path, block_size):
+    with open(path, 'rb') as fh:
+        reader = PacketReader(fh, block_size=block_size)
+        count = sum(1 for _ in reader)
+    return count
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def main():
+    options = docopt.docopt(__doc__)
+    size = int(float(options['--size']) * 1e6)
+    block_size = int(options['--block'])
+    junk = float(options['--junk'])
+
+    fd, path = tempfile.mkstemp(suffix='.datalog')
+    os.close(fd)
+    try:
+        size = make_datalog(path, size, junk)
+        mb = size / 1e6
+        print 'datalog: %.1f MB' % mb
+
+        count, elapsed = timed(read_packet_from_fh, path)
+        print '%-22s %8d packets %8.2f s %8.2f MB/s' % ('Packet.packet_from_fh', count, elapsed, mb / elapsed)
+
+        count, elapsed = timed(read_packet_reader, path, block_size)
+        print '%-22s %8d packets %8.2f s %8.2f MB/s' % ('PacketReader', count, elapsed, mb / elapsed)
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
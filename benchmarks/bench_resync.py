@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Measure framing throughput on streams containing false sync words
+
+Usage:
+    bench_resync.py [--size=<mb>] [--chunk=<bytes>]
+
+Options:
+    --size=<mb>        Approximate size of each generated stream in MB [default: 4]
+    --chunk=<bytes>    Size of each simulated network read [default: 4096]
+"""
+import random
+import struct
+import time
+
+import docopt
+
+from ooi_port_agent.common import PacketType
+from ooi_port_agent.packet import Packet
+from ooi_port_agent.packet import PacketDecoder
+from ooi_port_agent.packet import PacketHeader
+
+
+def fake_header(rand, packet_size=0xffff):
+    """
+    A false sync followed by a header which passes every plausibility check
+    """
+    return struct.pack('>3sBHHII', PacketHeader.sync, PacketType.FROM_INSTRUMENT, packet_size,
+                       rand.randint(0, 0xff), rand.randint(0, 2 ** 32 - 1), rand.randint(0, 2 ** 32 - 1))
+
+
+def make_stream(size, junk):
+    """
+    Generate packets separated by junk
+    :param junk: function returning the junk to insert before each packet
+    :return: (stream, number of packets)
+    """
+    rand = random.Random(0)
+    parts = []
+    written = 0
+    count = 0
+    while written < size:
+        record = 'SAMPLE,%d,%.4f,%.4f\r\n' % (count, rand.random(), rand.random())
+        data = junk(rand) + Packet.create(record, PacketType.FROM_INSTRUMENT)[0].data
+        parts.append(data)
+        written += len(data)
+        count += 1
+    return ''.join(parts), count
+
+
+def frame(stream, chunk_size, verify):
+    decoder = PacketDecoder(verify=verify)
+    count = 0
+    start = time.time()
+    for index in xrange(0, len(stream), chunk_size):
+        count += len(decoder.feed(stream[index:index + chunk_size]))
+    return count, time.time() - start, decoder
+
+
+def main():
+    options = docopt.docopt(__doc__)
+    size = int(float(options['--size']) * 1e6)
+    chunk_size = int(options['--chunk'])
+
+    scenarios = [
+        ('clean', lambda rand: ''),
+        ('sparse false syncs', lambda rand: fake_header(rand, rand.randint(16, 0xffff)) if rand.random() < 0.05 else ''),
+        ('dense false syncs', lambda rand: ''.join(fake_header(rand) for _ in xrange(4))),
+    ]
+
+    for name, junk in scenarios:
+        stream, expected = make_stream(size, junk)
+        mb = len(stream) / 1e6
+        print '%s: %.1f MB, %d packets' % (name, mb, expected)
+        for verify in (False, True):
+            count, elapsed, decoder = frame(stream, chunk_size, verify)
+            print '    verify=%-5s %8d packets %8.2f MB/s %8d resyncs %8d bad checksums' % (
+                verify, count, mb / elapsed, decoder.resyncs, decoder.bad_checksums)
+
+
+if __name__ == '__main__':
+    main()
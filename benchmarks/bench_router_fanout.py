@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+Measure Router.got_data throughput as the number of clients grows
+
+Usage:
+    bench_router_fanout.py [--packets=<count>] [--batch=<count>]
+
+Options:
+    --packets=<count>   Number of packets routed per run [default: 50000]
+    --batch=<count>     Number of packets per got_data call [default: 10]
+"""
+import time
+
+import docopt
+from twisted.internet.abstract import FileDescriptor
+
+from ooi_port_agent.common import EndpointType
+from ooi_port_agent.common import Format
+from ooi_port_agent.common import PacketType
+from ooi_port_agent.packet import Packet
+from ooi_port_agent.router import Router
+
+
+class FakeTransport(FileDescriptor):
+    """
+    Twisted's buffered write path, with the buffer discarded instead of sent
+    """
+    connected = 1
+
+    def startWriting(self):
+        pass
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+    def reset(self):
+        self._tempDataBuffer = []
+        self._tempDataLen = 0
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.transport = FakeTransport()
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def writeSequence(self, data):
+        self.transport.writeSequence(data)
+
+
+def make_router(num_clients):
+    router = Router()
+    # discard ASCII output instead of handing it to a stopped reactor
+    router.formatter.deliver = lambda *args: None
+    router.add_route(PacketType.ALL, EndpointType.LOGGER, data_format=Format.ASCII)
+    router.add_route(PacketType.ALL, EndpointType.DATALOGGER, data_format=Format.PACKET)
+    router.add_route(PacketType.FROM_INSTRUMENT, EndpointType.CLIENT, data_format=Format.PACKET)
+    router.add_route(PacketType.FROM_DRIVER, EndpointType.INSTRUMENT, data_format=Format.RAW)
+    router.register(EndpointType.DATALOGGER, FakeClient())
+    router.register(EndpointType.INSTRUMENT, FakeClient())
+    for _ in xrange(num_clients):
+        router.register(EndpointType.CLIENT, FakeClient())
+    return router
+
+
+def main():
+    options = docopt.docopt(__doc__)
+    count = int(options['--packets'])
+    batch = int(options['--batch'])
+
+    packets = [Packet.create('SAMPLE,%d,1.2345,6.7890\r\n' % i, PacketType.FROM_INSTRUMENT)[0] for i in xrange(count)]
+    batches = [packets[index:index + batch] for index in xrange(0, count, batch)]
+
+    for num_clients in (1, 10, 100):
+        router = make_router(num_clients)
+        start = time.time()
+        clients = [output.endpoint for output in router.outputs.itervalues()]
+        for each in batches:
+            router.got_data(each)
+            for client in clients:
+                client.transport.reset()
+        elapsed = time.time() - start
+        router.formatter.stop()
+        print '%4d clients: %9.0f packets/s %9.0f writes/s %9d writes saved' % (
+            num_clients, count / elapsed, count * (num_clients + 1) / elapsed, router.writes_saved)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+"""
+Compare delivering routed packets to local readers over TCP loopback with the
+shared memory ring. Each reader runs in its own process and consumes every
+packet. Reports wall time until all readers are done and the CPU time used by
+the port agent process and by the readers.
+
+Usage:
+    bench_shm.py [--readers=<count>] [--packets=<count>] [--size=<bytes>] [--batch=<count>]
+    bench_shm.py agent <transport> <readers> <packets> <size> <batch>
+    bench_shm.py reader <transport> <address> <total>
+
+Options:
+    --readers=<count>   Number of reader processes [default: 4]
+    --packets=<count>   Number of packets routed [default: 200000]
+    --size=<bytes>      Payload size [default: 100]
+    --batch=<count>     Packets per got_data call [default: 50]
+"""
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import docopt
+from twisted.internet import reactor
+from twisted.internet.protocol import Factory
+from twisted.internet.protocol import Protocol
+
+from ooi_port_agent.common import EndpointType
+from ooi_port_agent.common import Format
+from ooi_port_agent.common import PacketType
+from ooi_port_agent.packet import Packet
+from ooi_port_agent.router import Router
+from ooi_port_agent.shm import ShmReader
+from ooi_port_agent.shm import ShmRing
+
+
+def cpu_seconds():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def read_tcp(port, total):
+    sock = socket.create_connection(('127.0.0.1', int(port)))
+    received = 0
+    while received < total:
+        data = sock.recv(0x10000)
+        if not data:
+            break
+        received += len(data)
+    return received, 0
+
+
+def read_shm(path, total):
+    reader = ShmReader(path)
+    received = 0
+    while received + reader.lost < total and reader.wait():
+        received += len(reader.read())
+    return received, reader.lost
+
+
+def reader(transport, address, total):
+    """
+    Count the bytes received, decoding costs the same for either transport
+    """
+    read = read_tcp if transport == 'tcp' else read_shm
+    received, lost = read(address, total)
+    print json.dumps({'cpu': cpu_seconds(), 'bytes': received, 'lost': lost})
+
+
+class Client(Protocol):
+    def connectionMade(self):
+        self.factory.router.register(EndpointType.CLIENT, self)
+
+    def connectionLost(self, reason=None):
+        self.factory.router.deregister(EndpointType.CLIENT, self)
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def writeSequence(self, data):
+        self.transport.writeSequence(data)
+
+
+def agent(transport, readers, count, size, batch):
+    """
+    Route count packets to readers over transport, print the results as JSON
+    """
+    router = Router()
+    router.add_route(PacketType.FROM_INSTRUMENT, EndpointType.CLIENT, data_format=Format.PACKET)
+    packets = Packet.create('x' * size, PacketType.FROM_INSTRUMENT) * batch
+    batches = count // batch
+    total = len(packets[0].data) * batch * batches
+    tempdir = tempfile.mkdtemp()
+
+    if transport == 'tcp':
+        factory = Factory()
+        factory.protocol = Client
+        factory.router = router
+        address = str(reactor.listenTCP(0, factory, interface='127.0.0.1').getHost().port)
+        connected = lambda: len(router.clients[EndpointType.CLIENT])
+    else:
+        address = os.path.join(tempdir, 'ring')
+        ring = ShmRing(address)
+        router.register(EndpointType.CLIENT, ring)
+        connected = lambda: len(ring.wakeups.readers)
+
+    command = [sys.executable, '-m', 'benchmarks.bench_shm', 'reader', transport, address, str(total)]
+    procs = [subprocess.Popen(command, stdout=subprocess.PIPE) for _ in xrange(readers)]
+    result = {}
+
+    def wait_for_readers():
+        if connected() < readers:
+            reactor.callLater(0.05, wait_for_readers)
+            return
+        result['start'] = time.time()
+        result['cpu'] = cpu_seconds()
+        send(batches)
+
+    def send(remaining):
+        router.got_data(packets)
+        if remaining > 1:
+            reactor.callLater(0, send, remaining - 1)
+        else:
+            finish()
+
+    def finish():
+        # keep the reactor running until the readers have received everything
+        if any(proc.poll() is None for proc in procs):
+            reactor.callLater(0.001, finish)
+            return
+        result['seconds'] = time.time() - result['start']
+        result['cpu'] = cpu_seconds() - result['cpu']
+        reactor.stop()
+
+    reactor.callWhenRunning(wait_for_readers)
+    reactor.run()
+
+    outputs = [json.loads(proc.stdout.read()) for proc in procs]
+    shutil.rmtree(tempdir)
+    result.update({
+        'bytes': total,
+        'reader_cpu': sum(each['cpu'] for each in outputs) / readers,
+        'lost': sum(each['lost'] for each in outputs),
+        'complete': all(each['bytes'] + each['lost'] == total for each in outputs),
+    })
+    print json.dumps(result)
+
+
+def main():
+    options = docopt.docopt(__doc__)
+    if options['reader']:
+        reader(options['<transport>'], options['<address>'], int(options['<total>']))
+        return
+    if options['agent']:
+        agent(options['<transport>'], int(options['<readers>']), int(options['<packets>']),
+              int(options['<size>']), int(options['<batch>']))
+        return
+
+    args = [options['--readers'], options['--packets'], options['--size'], options['--batch']]
+    for transport in ('tcp', 'shm'):
+        output = subprocess.check_output([sys.executable, '-m', 'benchmarks.bench_shm', 'agent', transport] + args)
+        result = json.loads(output.splitlines()[-1])
+        print '%s: %s readers, %.1f MB each, %.2fs (%.1f MB/s), agent cpu %.2fs, reader cpu %.2fs, lost %d bytes' % (
+            transport, options['--readers'], result['bytes'] / 1e6, result['seconds'],
+            result['bytes'] / 1e6 / result['seconds'], result['cpu'], result['reader_cpu'], result['lost'])
+
+
+if __name__ == '__main__':
+    main()
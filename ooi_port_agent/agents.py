@@ -1,29 +1,71 @@
 from __future__ import division
+from functools import partial
 import glob
 import json
 
 import re
+from twisted.internet.defer import gatherResults
+from twisted.internet.defer import maybeDeferred
+from twisted.internet.defer import succeed
 from twisted.internet.endpoints import TCP4ServerEndpoint
 from twisted.internet import reactor
 from twisted.python import log
-from twisted.python.logfile import DailyLogFile
+from twisted.web.server import Site
 
+import metrics
 import ooi_port_agent
 from common import EndpointType
 from common import PacketType
 from common import Format
+from common import DATALOG_COMPRESSION_LEVEL
+from common import DATALOG_FRAME_BYTES
+from common import DATALOG_FRAME_INTERVAL
+from common import DATALOG_INDEX_INTERVAL
+from common import DATALOG_PROBE_BYTES
+from common import DATALOG_SEGMENT_BYTES
+from common import DATALOG_SEGMENT_SECONDS
 from common import HEARTBEAT_INTERVAL
+from common import LOG_FLUSH_INTERVAL
+from common import LOG_FSYNC_INTERVAL
+from common import LOG_QUEUE_BYTES
 from common import NEWLINE
+from common import OUTPUT_BUDGET
+from common import OUTPUT_GRACE
+from common import ROUTER_FLUSH_BYTES
+from common import REPLAY_BATCH_BYTES
+from common import REPLAY_BATCH_PACKETS
+from common import REPLAY_BUDGET
+from common import ROUTER_FLUSH_DELAY
+from common import SHM_RING_SIZE
 from common import string_to_ntp_date_time
+from datalog import FrameCompressor
+from datalog import open_datalog
+from datalog import probe_packets
+from datalog import seek_window
+from datalog import SegmentStore
+from datalog import series_end_times
 from factories import DataFactory
 from factories import CommandFactory
+from factories import ReplayFactory
 from factories import InstrumentClientFactory
 from factories import DigiInstrumentClientFactory
 from factories import DigiCommandClientFactory
-from ooi_port_agent.web import get, put
+from host import get_host
+from logwriter import BufferedLogFile
+from logwriter import CompressedLogFile
+from logwriter import LogFile
+from merge import DatalogMerge
 from packet import Packet
 from packet import PacketHeader
+from packet import PacketDecoder
+from packet import PacketReader
+from playback import parse_speed
+from playback import Playback
+from replay import ReplayRing
 from router import Router
+from shm import ShmRing
+from subscription import parse_time
+from subscription import Subscription
 
 
 #################################################################################
@@ -34,13 +76,18 @@ from router import Router
 # exist on all machines
 #################################################################################
 class PortAgent(object):
-    _agent = 'http://localhost:8500/v1/agent/'
-
+    """
+    Base port agent. Constructing an agent only reads its config, raising KeyError or
+    ValueError if it is incomplete or invalid. Nothing is opened, listened on or registered
+    until start is called.
+    """
     def __init__(self, config):
         self.config = config
+        self.host = get_host()
         self.data_port = config['port']
         self.command_port = config['commandport']
         self.sniff_port = config['sniffport']
+        self.replay_port = config.get('replayport')
         self.name = config.get('name', str(self.command_port))
         self.refdes = config.get('refdes', config['type'])
         self.ttl = config['ttl']
@@ -48,27 +95,159 @@ class PortAgent(object):
         self.data_name = 'port-agent'
         self.command_name = 'command-port-agent'
         self.sniffer_name = 'sniff-port-agent'
+        self.replay_name = 'replay-port-agent'
         self.data_port_id = '%s-%s' % (self.data_name, self.refdes)
         self.command_port_id = '%s-%s' % (self.command_name, self.refdes)
         self.sniffer_port_id = '%s-%s' % (self.sniffer_name, self.refdes)
-
-        self.router = Router()
+        self.replay_port_id = '%s-%s' % (self.replay_name, self.refdes)
+        self.service_ids = [self.data_port_id, self.command_port_id, self.sniffer_port_id]
+
+        self.router = Router(flush_bytes=config.get('flush_bytes', ROUTER_FLUSH_BYTES),
+                             flush_delay=config.get('flush_delay', ROUTER_FLUSH_DELAY),
+                             policies=config.get('output_policies'),
+                             budget=config.get('output_budget', OUTPUT_BUDGET),
+                             grace=config.get('output_grace', OUTPUT_GRACE),
+                             name=self.name,
+                             scheduler=self.host.scheduler,
+                             formatter=self.host.formatter)
+        self.consul = self.host.consul
+        self.listening_ports = []
+        self.connectors = []
+        self.stopped = False
         self.connections = set()
         self.clients = set()
+        self.metrics_port = config.get('metricsport')
+        self.shm_path = config.get('shm')
+        self.shm_ring = None
+        self.replay = None
+        self.loggers = []
+
+        # connection statistics, see metrics.collect
+        self.instrument_connects = 0
+        self.instrument_disconnects = 0
+        self.client_connects = 0
+        self.client_disconnects = 0
 
-        self._register_loggers()
         self._create_routes()
-        self._start_servers()
-        self._heartbeat()
         self.num_connections = 0
-        log.msg('Base PortAgent initialization complete')
+
+    def start(self):
+        """
+        Open the logs and listening ports, register with Consul, connect to the instrument
+        and join the host. If any of these fail the agent is stopped and the error raised.
+        :return: this port agent
+        """
+        try:
+            self._register_loggers()
+            self.router.start()
+            self._start_servers()
+            self._heartbeat()
+            self.host.scheduler.add(HEARTBEAT_INTERVAL, self._heartbeat)
+            self._start_inst_connection()
+        except Exception:
+            self.stop()
+            raise
+        self.host.add(self)
+        log.msg('%s started: %s' % (type(self).__name__, self.name))
+        return self
+
+    def stop(self):
+        """
+        Shut down this port agent without affecting any other agents in the process.
+        Listening ports and instrument connections are closed, Consul services deregistered
+        and the router stopped. Clients, including sniffers, and the log files are closed once
+        the ASCII formatter has written the last of their output. The reactor is stopped when
+        no agents remain.
+        :return: deferred firing once the listening ports and log files are closed
+        """
+        if self.stopped:
+            return succeed(None)
+        self.stopped = True
+        log.msg('Stopping port agent: %s' % self.name)
+
+        self.host.scheduler.remove(HEARTBEAT_INTERVAL, self._heartbeat)
+        closed = gatherResults([maybeDeferred(port.stopListening) for port in self.listening_ports])
+        for connector in self.connectors:
+            connector.factory.stopTrying()
+            connector.disconnect()
+        if self.shm_ring is not None:
+            self.router.deregister(EndpointType.CLIENT, self.shm_ring)
+            self.shm_ring.close()
+        self.router.stop()
+        for service_id in self.service_ids:
+            self.consul.deregister_service(service_id, caller='stop: ')
+        drained = self.router.formatter.drain()
+        drained.addCallback(lambda _: self._close_clients())
+        drained.addCallback(lambda _: self._close_loggers())
+        stopped = gatherResults([closed, drained])
+        stopped.addCallback(lambda _: self.host.remove(self))
+        return stopped
+
+    def _close_clients(self):
+        for client in list(self.clients):
+            client.transport.loseConnection()
+
+    def _start_inst_connection(self):
+        """
+        Overridden by agents connecting to an instrument
+        """
+        pass
+
+    def _connect(self, address, port, factory):
+        """
+        Connect to an instrument, keeping the connector so stop can close it
+        """
+        connector = reactor.connectTCP(address, port, factory)
+        self.connectors.append(connector)
+        return connector
+
+    def _open_log(self, log_file):
+        return LogFile(log_file, self.host.log_writer,
+                       flush_interval=self.config.get('log_flush_interval', LOG_FLUSH_INTERVAL),
+                       fsync_interval=self.config.get('log_fsync_interval', LOG_FSYNC_INTERVAL),
+                       queue_bytes=self.config.get('log_queue_bytes', LOG_QUEUE_BYTES))
+
+    def _open_datalog(self):
+        config = self.config
+        compression = config.get('datalog_compression')
+        name = '%s.datalog' % self.name
+        compressor = None
+        if compression is not None:
+            if compression != 'gzip':
+                raise ValueError('Unknown datalog compression: %r' % compression)
+            name += '.gz'
+            compressor = FrameCompressor(level=config.get('datalog_compression_level', DATALOG_COMPRESSION_LEVEL),
+                                         frame_bytes=config.get('datalog_frame_bytes', DATALOG_FRAME_BYTES),
+                                         frame_interval=config.get('datalog_frame_interval', DATALOG_FRAME_INTERVAL))
+
+        if config.get('datalog_segments'):
+            return self._open_log(SegmentStore(
+                name, '.',
+                segment_bytes=config.get('datalog_segment_bytes', DATALOG_SEGMENT_BYTES),
+                segment_seconds=config.get('datalog_segment_seconds', DATALOG_SEGMENT_SECONDS),
+                index_interval=config.get('datalog_index_interval', DATALOG_INDEX_INTERVAL),
+                retain_bytes=config.get('datalog_retain_bytes'),
+                retain_seconds=config.get('datalog_retain_seconds'),
+                compressor=compressor))
+        if compressor is not None:
+            return self._open_log(CompressedLogFile(name, '.', compressor))
+        return self._open_log(BufferedLogFile(name, '.'))
 
     def _register_loggers(self):
-        self.data_logger = DailyLogFile('%s.datalog' % self.name, '.')
-        self.ascii_logger = DailyLogFile('%s.log' % self.name, '.')
+        self.data_logger = self._open_datalog()
+        self.ascii_logger = self._open_log(BufferedLogFile('%s.log' % self.name, '.'))
+        self.loggers = [self.data_logger, self.ascii_logger]
         self.router.register(EndpointType.DATALOGGER, self.data_logger)
         self.router.register(EndpointType.LOGGER, self.ascii_logger)
 
+    def _close_loggers(self):
+        # connections closed by stop may still report status, deregister before closing
+        for endpoint_type, logger in ((EndpointType.DATALOGGER, getattr(self, 'data_logger', None)),
+                                      (EndpointType.LOGGER, getattr(self, 'ascii_logger', None))):
+            if logger is not None:
+                self.router.deregister(endpoint_type, logger)
+                logger.close()
+
     def _create_routes(self):
         # Register the logger and datalogger to receive all messages
         self.router.add_route(PacketType.ALL, EndpointType.LOGGER, data_format=Format.ASCII)
@@ -99,11 +278,8 @@ class PortAgent(object):
         self.router.add_route(PacketType.DIGI_RSP, EndpointType.CLIENT, data_format=Format.PACKET)
         self.router.add_route(PacketType.DIGI_RSP, EndpointType.COMMAND, data_format=Format.RAW)
 
-    @staticmethod
-    def done(response, caller=''):
-        log.msg(caller + 'http response: %s' % response.code)
-
     def data_port_cb(self, port):
+        self.listening_ports.append(port)
         self.data_port = port.getHost().port
 
         values = {
@@ -113,11 +289,12 @@ class PortAgent(object):
             'Check': {'TTL': '%ss' % self.ttl},
             'Tags': [self.refdes]
         }
-        put(self._agent + 'service/register', json.dumps(values)).addCallback(self.done, caller='data_port_cb: ')
+        self.consul.register_service(values, caller='data_port_cb: ')
 
         log.msg('data_port_cb: port is', self.data_port)
 
     def command_port_cb(self, port):
+        self.listening_ports.append(port)
         self.command_port = port.getHost().port
 
         values = {
@@ -128,11 +305,12 @@ class PortAgent(object):
             'Tags': [self.refdes]
         }
 
-        put(self._agent + 'service/register', json.dumps(values)).addCallback(self.done, caller='command_port_cb: ')
+        self.consul.register_service(values, caller='command_port_cb: ')
 
         log.msg('command_port_cb: port is', self.command_port)
 
     def sniff_port_cb(self, port):
+        self.listening_ports.append(port)
         self.sniff_port = port.getHost().port
 
         values = {
@@ -143,7 +321,7 @@ class PortAgent(object):
             'Tags': [self.refdes]
         }
 
-        put(self._agent + 'service/register', json.dumps(values)).addCallback(self.done, caller='sniff_port_cb: ')
+        self.consul.register_service(values, caller='sniff_port_cb: ')
 
         log.msg('sniff_port_cb: port is', self.sniff_port)
 
@@ -162,37 +340,76 @@ class PortAgent(object):
         sniff_deferred = self.sniff_endpoint.listen(DataFactory(self, PacketType.UNKNOWN, EndpointType.LOGGER))
         sniff_deferred.addCallback(self.sniff_port_cb)
 
+        replay_budget = int(self.config.get('replay_budget', REPLAY_BUDGET))
+        if replay_budget:
+            self.replay = ReplayRing(replay_budget)
+            self.router.register(EndpointType.CLIENT, self.replay)
+
+            if self.replay_port is not None:
+                self.replay_endpoint = TCP4ServerEndpoint(reactor, int(self.replay_port))
+                replay_deferred = self.replay_endpoint.listen(
+                    ReplayFactory(self, PacketType.FROM_DRIVER, EndpointType.CLIENT))
+                replay_deferred.addCallback(self.replay_port_cb)
+
+        if self.shm_path is not None:
+            self.shm_ring = ShmRing(self.shm_path, int(self.config.get('shm_size', SHM_RING_SIZE)))
+            self.router.register(EndpointType.CLIENT, self.shm_ring)
+            log.msg('shm ring is', self.shm_path)
+
+        if self.metrics_port is not None:
+            self.metrics_endpoint = TCP4ServerEndpoint(reactor, int(self.metrics_port))
+            metrics_deferred = self.metrics_endpoint.listen(Site(metrics.MetricsResource(partial(metrics.collect, self))))
+            metrics_deferred.addCallback(self.metrics_port_cb)
+
+    def replay_port_cb(self, port):
+        self.listening_ports.append(port)
+        self.replay_port = port.getHost().port
+
+        values = {
+            'ID': self.replay_port_id,
+            'Name': self.replay_name,
+            'Port': self.replay_port,
+            'Check': {'TTL': '%ss' % self.ttl},
+            'Tags': [self.refdes]
+        }
+        self.service_ids.append(self.replay_port_id)
+        self.consul.register_service(values, caller='replay_port_cb: ')
+
+        log.msg('replay_port_cb: port is', self.replay_port)
+
+    def metrics_port_cb(self, port):
+        self.listening_ports.append(port)
+        self.metrics_port = port.getHost().port
+        log.msg('metrics_port_cb: port is', self.metrics_port)
+
     def _heartbeat(self):
         packets = Packet.create('HB', PacketType.PA_HEARTBEAT)
         self.router.got_data(packets)
 
         # Set TTL Check Status
-        check_string = self._agent + 'check/pass/service:'
-        get(check_string + self.data_port_id).addCallback(
-            self.done, caller='%s TTL check status: ' % self.data_port_id)
-        get(check_string + self.command_port_id).addCallback(
-            self.done, caller='%s TTL check status: ' % self.command_port_id)
-        get(check_string + self.sniffer_port_id).addCallback(
-            self.done, caller='%s TTL check status: ' % self.sniffer_port_id)
-
-        reactor.callLater(HEARTBEAT_INTERVAL, self._heartbeat)
+        for service_id in self.service_ids:
+            self.consul.pass_check(service_id, caller='%s TTL check status: ' % service_id)
 
     def client_connected(self, connection):
         log.msg('CLIENT CONNECTED FROM ', connection)
         self.clients.add(connection)
+        self.client_connects += 1
 
     def client_disconnected(self, connection):
         self.clients.remove(connection)
+        self.client_disconnects += 1
         log.msg('CLIENT DISCONNECTED FROM ', connection)
 
     def instrument_connected(self, connection):
         log.msg('CONNECTED TO ', connection)
         self.connections.add(connection)
+        self.instrument_connects += 1
         if len(self.connections) == self.num_connections:
             self.router.got_data(Packet.create('CONNECTED', PacketType.PA_STATUS))
 
     def instrument_disconnected(self, connection):
         self.connections.remove(connection)
+        self.instrument_disconnects += 1
         log.msg('DISCONNECTED FROM ', connection)
         self.router.got_data(Packet.create('DISCONNECTED', PacketType.PA_STATUS))
 
@@ -201,6 +418,11 @@ class PortAgent(object):
         command_protocol.register_command('get_state', self.get_state)
         command_protocol.register_command('get_config', self.get_config)
         command_protocol.register_command('get_version', self.get_version)
+        command_protocol.register_command('get_outputs', self.get_outputs)
+        command_protocol.register_command('get_stats', self.get_stats)
+        command_protocol.register_command('subscribe', self.subscribe)
+        command_protocol.register_command('unsubscribe', self.subscribe)
+        command_protocol.register_command('tail', self.tail)
 
     def get_state(self, *args):
         log.msg('get_state: %r %d' % (self.connections, self.num_connections))
@@ -214,6 +436,57 @@ class PortAgent(object):
     def get_version(self, *args):
         return Packet.create(ooi_port_agent.__version__, PacketType.PA_CONFIG)
 
+    def get_outputs(self, *args):
+        return Packet.create(json.dumps(self.router.output_stats()), PacketType.PA_STATUS)
+
+    def get_stats(self, command, output_format='json', *args):
+        """
+        Cumulative router and agent counters
+        usage: get_stats [json|prometheus]
+        """
+        stats = metrics.collect(self)
+        if output_format == 'prometheus':
+            return Packet.create(metrics.format_prometheus(stats), PacketType.PA_STATUS)
+        if output_format == 'json':
+            return Packet.create(metrics.format_json(stats), PacketType.PA_STATUS)
+        return Packet.create('Unknown stats format: %r' % output_format, PacketType.PA_FAULT)
+
+    def subscribe(self, command, name=None, *args):
+        """
+        Filter the packets sent to a connected client or sniffer
+        usage: subscribe <host:port> [type=<type>[,<type>...]] [start=<time>] [end=<time>] [prefix=<prefix>] [regex=<regex>]
+               unsubscribe <host:port>
+        """
+        output = self.router.find_output(name) if name is not None else None
+        if output is None:
+            return Packet.create('%s: no endpoint named %r, see get_outputs' % (command, name), PacketType.PA_FAULT)
+
+        subscription = None
+        if command == 'subscribe':
+            try:
+                subscription = Subscription.parse(args)
+            except ValueError as e:
+                return Packet.create('%s: %s' % (command, e), PacketType.PA_FAULT)
+
+        self.router.subscribe(output, subscription)
+        return Packet.create(' '.join((command, name) + args), PacketType.PA_STATUS)
+
+
+    def tail(self, command, count='10', *args):
+        """
+        The most recent packets sent to clients, in the ASCII log format
+        usage: tail [count]
+        """
+        if self.replay is None:
+            return Packet.create('tail: replay is disabled for this port agent', PacketType.PA_FAULT)
+        try:
+            count = int(count)
+        except ValueError:
+            return Packet.create('tail: invalid count: %r' % count, PacketType.PA_FAULT)
+
+        packets = PacketDecoder().feed(''.join(self.replay.tail(count)))
+        return Packet.create(''.join(packet.logstring + NEWLINE for packet in packets), PacketType.PA_STATUS)
+
 
 class TcpPortAgent(PortAgent):
     """
@@ -227,12 +500,10 @@ class TcpPortAgent(PortAgent):
         self.inst_addr = config['instaddr']
         self.inst_port = config['instport']
         self.num_connections = 1
-        self._start_inst_connection()
-        log.msg('TcpPortAgent initialization complete')
 
     def _start_inst_connection(self):
         factory = InstrumentClientFactory(self, PacketType.FROM_INSTRUMENT, EndpointType.INSTRUMENT)
-        reactor.connectTCP(self.inst_addr, self.inst_port, factory)
+        self._connect(self.inst_addr, self.inst_port, factory)
 
 
 class RsnPortAgent(TcpPortAgent):
@@ -241,17 +512,16 @@ class RsnPortAgent(TcpPortAgent):
     def __init__(self, config):
         super(RsnPortAgent, self).__init__(config)
         self.inst_cmd_port = config['digiport']
-        self._start_inst_command_connection()
         self.num_connections = 2
-        log.msg('RsnPortAgent initialization complete')
 
     def _start_inst_connection(self):
         factory = DigiInstrumentClientFactory(self, PacketType.FROM_INSTRUMENT, EndpointType.INSTRUMENT)
-        reactor.connectTCP(self.inst_addr, self.inst_port, factory)
+        self._connect(self.inst_addr, self.inst_port, factory)
+        self._start_inst_command_connection()
 
     def _start_inst_command_connection(self):
         factory = DigiCommandClientFactory(self, PacketType.DIGI_RSP, EndpointType.DIGI)
-        reactor.connectTCP(self.inst_addr, self.inst_cmd_port, factory)
+        self._connect(self.inst_addr, self.inst_cmd_port, factory)
 
     def register_commands(self, command_protocol):
         super(RsnPortAgent, self).register_commands(command_protocol)
@@ -275,18 +545,39 @@ class BotptPortAgent(PortAgent):
         self.inst_rx_port = config['rxport']
         self.inst_tx_port = config['txport']
         self.inst_addr = config['instaddr']
-        self._start_inst_connection()
         self.num_connections = 2
-        log.msg('BotptPortAgent initialization complete')
 
     def _start_inst_connection(self):
         rx_factory = InstrumentClientFactory(self, PacketType.FROM_INSTRUMENT, EndpointType.INSTRUMENT_DATA)
         tx_factory = InstrumentClientFactory(self, PacketType.UNKNOWN, EndpointType.INSTRUMENT)
-        reactor.connectTCP(self.inst_addr, self.inst_rx_port, rx_factory)
-        reactor.connectTCP(self.inst_addr, self.inst_tx_port, tx_factory)
+        self._connect(self.inst_addr, self.inst_rx_port, rx_factory)
+        self._connect(self.inst_addr, self.inst_tx_port, tx_factory)
 
 
 class DatalogReadingPortAgent(PortAgent):
+    """
+    Replay recorded port agent datalogs to clients.
+
+    Replay starts once a client connects. Packets are pushed by a Playback registered as
+    a producer with the router, in batches as fast as the clients drain them, or paced by
+    their timestamps when speed is set: 'realtime', a multiple of real time such as 10,
+    or 'max' (the default) for unthrottled.
+
+    With start and/or end set, as ISO8601 UTC times or NTP seconds, only the packets stamped
+    within that window are replayed. Files wholly outside the window are skipped without being
+    decoded and each file is read from the start of the window, see datalog.bisect_time.
+
+    Files are replayed one after the other in name order, or with merge set, all at once
+    merged in timestamp order, decoded by merge_processes worker processes, see merge.DatalogMerge.
+    The worker processes are started with the agent, before the reactor runs.
+    """
+    # stop the agent once every file has been replayed
+    stop_when_done = True
+    # packets carry the time they were recorded, files can be searched by time
+    timestamped = True
+    # files hold port agent packets and can be merged
+    mergeable = True
+
     def __init__(self, config):
         super(DatalogReadingPortAgent, self).__init__(config)
         self.files = []
@@ -294,9 +585,36 @@ class DatalogReadingPortAgent(PortAgent):
             self.files.extend(glob.glob(each))
 
         self.files.sort()
-        self._filehandle = None
         self.target_types = [PacketType.FROM_INSTRUMENT, PacketType.PA_CONFIG]
+        # replay window, NTP seconds or None
+        self.window_start = self._window_time(config.get('start'))
+        self.window_end = self._window_time(config.get('end'))
+        self.merge = None
+        merging = config.get('merge', False)
+        if merging and not self.mergeable:
+            raise ValueError('Only port agent datalogs can be merged')
+        if merging:
+            processes = config.get('merge_processes')
+            if reactor.running:
+                # forked decoder processes would inherit the reactor's sockets and threads
+                log.msg('Reactor running, merging datalogs in this process')
+                processes = 0
+            self.merge = DatalogMerge(self.files, self.window_start, self.window_end, packet_types=self.target_types,
+                                      processes=processes, dedupe=config.get('merge_dedupe', False))
+        packets = self._merged() if merging else self._packets()
+        self.playback = Playback(self.router, packets, speed=parse_speed(config.get('speed')),
+                                 batch_packets=config.get('replay_batch_packets', REPLAY_BATCH_PACKETS),
+                                 batch_bytes=config.get('replay_batch_bytes', REPLAY_BATCH_BYTES),
+                                 done=self._done, ready=self.merge.ready if self.merge is not None else None)
+        self.router.registerProducer(self.playback)
+
+    def start(self):
+        if self.merge is not None:
+            # fork the decoder processes before this agent opens its ports or the reactor runs
+            self.merge.start()
+        super(DatalogReadingPortAgent, self).start()
         self._start_when_ready()
+        return self
 
     def _register_loggers(self):
         """
@@ -304,47 +622,89 @@ class DatalogReadingPortAgent(PortAgent):
         """
         pass
 
+    def stop(self):
+        self.playback.stopProducing()
+        if self.merge is not None:
+            self.merge.close()
+        return super(DatalogReadingPortAgent, self).stop()
+
     def _start_when_ready(self):
-        log.msg('waiting for a client connection', self.router.clients[EndpointType.INSTRUMENT_DATA])
-        if len(self.router.clients[EndpointType.CLIENT]) > 0:
-            self._read()
+        if self.stopped:
+            return
+        log.msg('waiting for a client connection')
+        # connected clients only, the replay ring and shared memory ring are also CLIENT endpoints
+        if self.clients:
+            self.playback.start()
         else:
             reactor.callLater(1.0, self._start_when_ready)
 
-    def _read(self):
-        """
-        Read one packet, publish if appropriate, then return.
-        We must not read all packets in a loop here, or we will not actually publish them until the end...
-        """
-        if self._filehandle is None and not self.files:
-            log.msg('Completed reading specified port agent logs, exiting...')
-            reactor.stop()
-            return
+    def _done(self):
+        if self.playback.failed:
+            log.msg('Unable to read specified port agent logs, stopped after %d packets' %
+                    self.playback.packets_sent)
+        else:
+            log.msg('Completed reading specified port agent logs (%d packets)' % self.playback.packets_sent)
+        if self.stop_when_done or self.playback.failed:
+            log.msg('exiting...')
+            self.stop()
 
-        if self._filehandle is None:
-            name = self.files.pop(0)
-            log.msg('Begin reading:', name)
-            self._filehandle = open(name, 'r')
+    @staticmethod
+    def _window_time(value):
+        if value is None:
+            return None
+        return parse_time(value)
 
-        packet = Packet.packet_from_fh(self._filehandle)
-        if packet is not None:
-            if packet.header.packet_type in self.target_types:
-                self.router.got_data([packet])
+    def _packets(self):
+        """
+        Generate the packets to replay from each file in turn
+        """
+        ends = series_end_times(self.files)
+        for name in self.files:
+            with open_datalog(name, self.window_start) as filehandle:
+                probe = self._probe if self.timestamped else None
+                if not seek_window(name, filehandle, self.window_start, self.window_end, probe, ends.get(name)):
+                    log.msg('Skipping, outside the replay window:', name)
+                    continue
+                log.msg('Begin reading:', name)
+                for packet in self._read_file(filehandle):
+                    packet_time = packet.header.time
+                    # packets stamped 0 are always replayed
+                    if packet_time:
+                        if self.window_start is not None and packet_time < self.window_start:
+                            continue
+                        if self.window_end is not None and packet_time > self.window_end:
+                            break
+                    if packet.header.packet_type in self.target_types:
+                        yield packet
+
+    def _merged(self):
+        """
+        Generate the packets to replay from every file, merged in timestamp order
+        """
+        log.msg('Begin merging %d files' % len(self.files))
+        for packet in self.merge:
+            yield packet
+        log.msg('Merged %d packets, dropped %d duplicates' % (self.merge.packets, self.merge.duplicates))
 
-        else:
-            self._filehandle.close()
-            self._filehandle = None
+    def _probe(self, filehandle, offset):
+        """
+        :return: list of (offset, NTP time) of the records in the block of the file at offset
+        """
+        return probe_packets(filehandle, offset)
 
-        # allow the reactor loop to process other events
-        reactor.callLater(0.01, self._read)
+    def _read_file(self, filehandle):
+        return PacketReader(filehandle)
 
 
 class DigiDatalogAsciiPortAgent(DatalogReadingPortAgent):
+    stop_when_done = False
+    mergeable = False
+    read_size = 0x10000
+
     def __init__(self, config):
-        super(DigiDatalogAsciiPortAgent, self).__init__(config)
         self.ooi_ts_regex = re.compile(r'<OOI-TS (.+?) [TX][NS]>\r\n(.*?)<\\OOI-TS>', re.DOTALL)
-        self.buffer = ''
         self.MAXBUF = 65535
+        super(DigiDatalogAsciiPortAgent, self).__init__(config)
 
         # special case for RSN archived data
         # if all files have date_UTC in filename then sort by that
@@ -358,80 +718,62 @@ class DigiDatalogAsciiPortAgent(DatalogReadingPortAgent):
         if all((search_utc(f) for f in self.files)):
             self.files.sort(key=search_utc)
 
-    def _read(self):
+    def _probe(self, filehandle, offset):
+        filehandle.seek(offset)
+        data = filehandle.read(DATALOG_PROBE_BYTES)
+        records = []
+        for match in self.ooi_ts_regex.finditer(data):
+            try:
+                records.append((offset + match.start(), string_to_ntp_date_time(match.group(1))))
+            except ValueError:
+                pass
+        return records
+
+    def _read_file(self, filehandle):
         """
-        Read a chunk of data and inspect it for a complete DIGI ASCII record. When found, publish.
+        Generate a packet for each complete DIGI ASCII record
         """
-        if self._filehandle is None and not self.files:
-            log.msg('Completed reading specified port agent logs')
-            return
-
-        if self._filehandle is None:
-            name = self.files.pop(0)
-            log.msg('Begin reading:', name)
-            self._filehandle = open(name, 'r')
-
-        chunk = self._filehandle.read(1024)
-        if chunk != '':
-            self.buffer += chunk
+        buf = ''
+        while True:
+            chunk = filehandle.read(self.read_size)
+            if chunk == '':
+                return
+            buf += chunk
             new_index = 0
-            for match in self.ooi_ts_regex.finditer(self.buffer):
+            for match in self.ooi_ts_regex.finditer(buf):
                 payload = match.group(2)
                 try:
                     packet_time = string_to_ntp_date_time(match.group(1))
                     header = PacketHeader(packet_type=PacketType.FROM_INSTRUMENT, payload_size=len(payload),
                                           packet_time=packet_time)
                     header.set_checksum(payload)
-                    packet = Packet(payload=payload, header=header)
-                    self.router.got_data([packet])
+                    yield Packet(payload=payload, header=header)
                 except ValueError:
                     log.err('Unable to extract timestamp from record: %r' % match.group())
                 new_index = match.end()
 
             if new_index > 0:
-                self.buffer = self.buffer[new_index:]
+                buf = buf[new_index:]
 
-            if len(self.buffer) > self.MAXBUF:
-                self.buffer = self.buffer[-self.MAXBUF:]
-
-        else:
-            self._filehandle.close()
-            self._filehandle = None
-
-        # allow the reactor loop to process other events
-        reactor.callLater(0.01, self._read)
+            if len(buf) > self.MAXBUF:
+                buf = buf[-self.MAXBUF:]
 
 
 class ChunkyDatalogPortAgent(DatalogReadingPortAgent):
-    def __init__(self, config):
-        super(ChunkyDatalogPortAgent, self).__init__(config)
+    # packets are stamped 0, only files named with their start time are windowed
+    timestamped = False
+    mergeable = False
 
-    def _read(self):
+    def _read_file(self, filehandle):
         """
-        Read one line at a time, publish as a packet with TS of 0
+        Read 1024 bytes at a time, publish as a packet with TS of 0
         It is expected that the driver will use the internal timestamp
         of the record as the definitive timestamp
         """
-        if self._filehandle is None and not self.files:
-            log.msg('Completed reading specified port agent logs, exiting...')
-            reactor.stop()
-            return
-
-        if self._filehandle is None:
-            name = self.files.pop(0)
-            log.msg('Begin reading:', name)
-            self._filehandle = open(name, 'r')
-
-        data = self._filehandle.read(1024)
-        if data != '':
+        while True:
+            data = filehandle.read(1024)
+            if data == '':
+                return
             header = PacketHeader(packet_type=PacketType.FROM_INSTRUMENT, payload_size=len(data), packet_time=0)
             header.set_checksum(data)
-            packet = [Packet(payload=data, header=header)]
-            self.router.got_data(packet)
-
-        else:
-            self._filehandle.close()
-            self._filehandle = None
-
-        # allow the reactor loop to process other events
-        reactor.callLater(0.01, self._read)
+            yield Packet(payload=data, header=header)
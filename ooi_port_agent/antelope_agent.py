@@ -10,6 +10,7 @@ from antelope.orb import OrbIncompleteException
 from antelope.orb import ORBOLDEST
 from common import PacketType, NEWLINE
 from packet import Packet
+from packet import PacketBatch
 import cPickle as pickle
 
 def get_one(orb):
@@ -18,7 +19,7 @@ def get_one(orb):
         orb_packet = Pkt.Packet(srcname, pkttime, data)
         return create_packets(orb_packet, pktid)
     except OrbIncompleteException:
-        return []
+        return PacketBatch([], PacketType.PICKLED_FROM_INSTRUMENT)
 
 
 class OrbThread(threading.Thread):
@@ -30,7 +31,7 @@ class OrbThread(threading.Thread):
     def run(self):
         while self.port_agent.keep_going:
             if not self.port_agent._pause:
-                reactor.callFromThread(self.port_agent.router.got_data, get_one(self.orb))
+                reactor.callFromThread(self.port_agent.router.got_batch, get_one(self.orb))
                 time.sleep(.0001)
             else:
                 time.sleep(.001)
@@ -42,12 +43,15 @@ class AntelopePortAgent(PortAgent):
         self.inst_addr = config['instaddr']
         self.inst_port = config['instport']
         self.keep_going = False
-        self.orb = Orb('%s:%d' % (self.inst_addr, self.inst_port))
-        self.orb.connect()
-        log.msg('Opened orb: %s' % self.orb)
+        self.orb = None
         self.orb_thread = None
         self._pause = False
         self.router.registerProducer(self)
+
+    def _start_inst_connection(self):
+        self.orb = Orb('%s:%d' % (self.inst_addr, self.inst_port))
+        self.orb.connect()
+        log.msg('Opened orb: %s' % self.orb)
         reactor.addSystemEventTrigger('before', 'shutdown', self._orb_stop)
 
     def _register_loggers(self):
@@ -118,7 +122,7 @@ class AntelopePortAgent(PortAgent):
         return Packet.create(msg + NEWLINE, PacketType.PA_STATUS)
 
     def _orb_get(self, *args):
-        self.router.got_data(get_one(self.orb))
+        self.router.got_batch(get_one(self.orb))
 
     def get_state(self, *args):
         if self.orb_thread is not None:
@@ -138,7 +142,7 @@ class AntelopePortAgent(PortAgent):
 
 
 def create_packets(orb_packet, pktid):
-    packets = []
+    payloads = []
     for channel in orb_packet.channels:
         d = {'calib': channel.calib,
              'calper': channel.calper,
@@ -155,6 +159,6 @@ def create_packets(orb_packet, pktid):
              'pktid': pktid,
              }
 
-        packets.extend(Packet.create(pickle.dumps(d, protocol=-1), PacketType.PICKLED_FROM_INSTRUMENT))
-    return packets
+        payloads.append(pickle.dumps(d, protocol=-1))
+    return PacketBatch(payloads, PacketType.PICKLED_FROM_INSTRUMENT)
 
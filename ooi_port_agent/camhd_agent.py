@@ -17,11 +17,9 @@ class CamhdPortAgent(PortAgent):
         self.req_port = config['reqport']
         self.sub_port = config['subport']
         self.inst_addr = config['instaddr']
-        self._start_inst_connection()
         # ZMQ does not expose the connection state of the underlying sockets
         # so we must always assume connected
         self.num_connections = 0
-        log.msg('CamhdPortAgent initialization complete')
 
     def _start_inst_connection(self):
         self.factory = ZmqFactory()
@@ -0,0 +1,182 @@
+"""
+Compiled packet codec
+Implemented in cython for speed, pure python equivalents live in packet.py
+"""
+import struct
+
+DEF HEADER_SIZE = 16
+DEF MAX_PACKET_SIZE = 0xffff
+
+
+cdef inline unsigned long unpack_uint32(const unsigned char[:] data, Py_ssize_t index):
+    return (<unsigned long> data[index] << 24 | <unsigned long> data[index + 1] << 16 |
+            <unsigned long> data[index + 2] << 8 | <unsigned long> data[index + 3])
+
+
+cdef inline void pack_uint32(unsigned char* data, unsigned long value):
+    data[0] = (value >> 24) & 0xff
+    data[1] = (value >> 16) & 0xff
+    data[2] = (value >> 8) & 0xff
+    data[3] = value & 0xff
+
+
+def encode_header(unsigned int packet_type, payload, unsigned long ts_high, unsigned long ts_low):
+    """
+    Pack a packet header, computing the checksum in a single pass over header and payload
+    :param packet_type: packet type
+    :param payload: payload string
+    :param ts_high: NTP integer seconds
+    :param ts_low: NTP fractional seconds
+    :return: packed header
+    """
+    cdef const unsigned char[:] data = payload
+    cdef Py_ssize_t size = len(payload)
+    cdef Py_ssize_t packet_size = size + HEADER_SIZE
+    cdef unsigned char header[HEADER_SIZE]
+    cdef unsigned char checksum = 0
+    cdef Py_ssize_t i
+
+    if packet_size > MAX_PACKET_SIZE or packet_type > 0xff:
+        raise struct.error('packet type or size out of range')
+
+    header[0] = 0xA3
+    header[1] = 0x9D
+    header[2] = 0x7A
+    header[3] = packet_type
+    header[4] = (packet_size >> 8) & 0xff
+    header[5] = packet_size & 0xff
+    header[6] = 0
+    header[7] = 0
+    pack_uint32(header + 8, ts_high)
+    pack_uint32(header + 12, ts_low)
+
+    for i in range(HEADER_SIZE):
+        checksum ^= header[i]
+    for i in range(size):
+        checksum ^= data[i]
+    header[7] = checksum
+
+    return (<char*> header)[:HEADER_SIZE]
+
+
+def scan_buffer(data_buffer, Py_ssize_t offset=0):
+    """
+    Locate every complete packet in a buffer
+    :param data_buffer: string or bytearray
+    :param offset: index at which to start searching
+    :return: (records, offset) where records is a list of
+             (offset, packet_type, packet_size, checksum, ts_high, ts_low, valid)
+             and offset is the index at which the next scan should start
+    """
+    cdef const unsigned char[:] data = data_buffer
+    cdef Py_ssize_t end = len(data_buffer)
+    cdef Py_ssize_t index, stop, i
+    cdef unsigned int packet_size
+    cdef unsigned char checksum
+    records = []
+
+    while True:
+        index = offset
+        while index + 2 < end and not (data[index] == 0xA3 and data[index + 1] == 0x9D and data[index + 2] == 0x7A):
+            index += 1
+
+        if index + 2 >= end:
+            # retain a possible partial sync at the end of the buffer
+            return records, max(offset, end - 2)
+
+        offset = index
+        if end - index < HEADER_SIZE:
+            break
+
+        packet_size = data[index + 4] << 8 | data[index + 5]
+        if packet_size < HEADER_SIZE:
+            # not a real sync, resume the search from the next byte
+            offset = index + 1
+            continue
+
+        stop = index + packet_size
+        if stop > end:
+            break
+
+        checksum = 0
+        for i in range(index, stop):
+            checksum ^= data[i]
+
+        records.append((index, data[index + 3], packet_size, data[index + 6] << 8 | data[index + 7],
+                        unpack_uint32(data, index + 8), unpack_uint32(data, index + 12), checksum == 0))
+        offset = stop
+
+    return records, offset
+
+
+def xor_prefix(data, unsigned char seed=0):
+    """
+    Compute the running XOR of a string
+    :param data: input string
+    :param seed: XOR of all bytes preceding data
+    :return: bytearray where element i is the XOR of seed and data[:i + 1]
+    """
+    result = bytearray(data)
+    cdef unsigned char[:] view = result
+    cdef Py_ssize_t i
+    for i in range(view.shape[0]):
+        seed ^= view[i]
+        view[i] = seed
+    return result
+
+
+def scan_verified(data_buffer, prefix, Py_ssize_t offset, unsigned int max_type):
+    """
+    Locate every complete packet with a plausible header and a valid checksum.
+    Candidates which fail either check are skipped by resuming the search one byte
+    past their sync. prefix[i] must hold the XOR of data_buffer[:i] so that each
+    checksum is verified in constant time.
+    :param data_buffer: string or bytearray
+    :param prefix: running XOR of data_buffer, one element longer than data_buffer
+    :param offset: index at which to start searching
+    :param max_type: largest valid packet type
+    :return: (records, offset, resyncs, bad_checksums), see scan_buffer
+    """
+    cdef const unsigned char[:] data = data_buffer
+    cdef const unsigned char[:] xor = prefix
+    cdef Py_ssize_t end = len(data_buffer)
+    cdef Py_ssize_t index, stop
+    cdef unsigned int packet_size
+    cdef unsigned long resyncs = 0, bad_checksums = 0
+    records = []
+
+    while True:
+        index = offset
+        while index + 2 < end and not (data[index] == 0xA3 and data[index + 1] == 0x9D and data[index + 2] == 0x7A):
+            index += 1
+
+        if index + 2 >= end:
+            # retain a possible partial sync at the end of the buffer
+            return records, max(offset, end - 2), resyncs, bad_checksums
+
+        offset = index
+        if end - index < HEADER_SIZE:
+            break
+
+        packet_size = data[index + 4] << 8 | data[index + 5]
+        # a valid checksum never exceeds one byte
+        if packet_size < HEADER_SIZE or data[index + 3] > max_type or data[index + 6] != 0:
+            resyncs += 1
+            offset = index + 1
+            continue
+
+        stop = index + packet_size
+        if stop > end:
+            break
+
+        if xor[index] != xor[stop]:
+            resyncs += 1
+            bad_checksums += 1
+            offset = index + 1
+            continue
+
+        records.append((index, data[index + 3], packet_size, data[index + 7],
+                        unpack_uint32(data, index + 8), unpack_uint32(data, index + 12), True))
+        offset = stop
+
+    return records, offset, resyncs, bad_checksums
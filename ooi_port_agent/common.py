@@ -11,6 +11,70 @@ MAX_RECONNECT_DELAY = 240
 # Interval at which router statistics are logged
 ROUTER_STATS_INTERVAL = 10
 
+# Router output coalescing: bytes pending before an endpoint is flushed early
+# and the maximum time output is held (None flushes after every read)
+ROUTER_FLUSH_BYTES = 0x10000
+ROUTER_FLUSH_DELAY = None
+
+# Bytes held for a paused endpoint before its slow consumer policy drops data
+OUTPUT_BUDGET = 0x400000
+
+# Seconds an endpoint with the disconnect policy may remain paused
+OUTPUT_GRACE = 30
+
+# Supervisor: seconds between worker statistics reports, between rebalancing passes
+# and the maximum delay before a crashed worker is restarted
+WORKER_STATS_INTERVAL = 5
+WORKER_REBALANCE_INTERVAL = 60
+MAX_WORKER_RESTART_DELAY = 60
+
+# Rebalancing: weight of the newest sample in each agent's smoothed byte rate, and the
+# imbalance between the busiest and idlest worker, as a fraction of the busiest worker's
+# rate and in bytes per second, below which agents are not moved
+RATE_SMOOTHING = 0.3
+REBALANCE_TOLERANCE = 0.2
+REBALANCE_MIN_RATE = 1024
+
+# Default size of the data region of a shared memory ring
+SHM_RING_SIZE = 0x400000
+
+# Bytes of recent client packets each port agent keeps for replay to reconnecting clients
+REPLAY_BUDGET = 0x400000
+
+# Log writer thread: maximum seconds before written data is flushed to the file and,
+# unless None, synced to disk, bytes queued per log file before its router output is
+# paused, and the size of each log file's write buffer
+LOG_FLUSH_INTERVAL = 1
+LOG_FSYNC_INTERVAL = None
+LOG_QUEUE_BYTES = 0x400000
+LOG_BUFFER_SIZE = 0x100000
+
+# Compressed datalogs: zlib level, and the uncompressed bytes or seconds after which
+# a compressed frame is ended
+DATALOG_COMPRESSION_LEVEL = 6
+DATALOG_FRAME_BYTES = 0x100000
+DATALOG_FRAME_INTERVAL = 60
+
+# Segmented datalogs: size and age at which a segment is ended, and packets between
+# entries of each segment's time index
+DATALOG_SEGMENT_BYTES = 0x4000000
+DATALOG_SEGMENT_SECONDS = 3600
+DATALOG_INDEX_INTERVAL = 1000
+
+# Most packets and bytes routed per batch when replaying datalogs
+REPLAY_BATCH_PACKETS = 1000
+REPLAY_BATCH_BYTES = 0x40000
+# Seconds between checks for the next packet when replaying datalogs decoded by worker processes
+REPLAY_POLL_INTERVAL = 0.01
+
+# Bytes read at each step of a time search of a plain datalog, room for two packets of the maximum size
+DATALOG_PROBE_BYTES = 0x20000
+
+# Bytes of a datalog decoded per chunk when merging datalogs, and chunks of each file
+# requested ahead of the merge
+MERGE_CHUNK_BYTES = 0x40000
+MERGE_PREFETCH = 2
+
 # Command to set the DIGI timestamps to binary mode, sent automatically upon every DIGI connection
 BINARY_TIMESTAMP = 'time 2\n'
 
@@ -34,6 +98,7 @@ class Enumeration(object):
     _keys = None
     _values = None
     _dict = None
+    _names = None
 
     @classmethod
     def values(cls):
@@ -63,13 +128,16 @@ class Enumeration(object):
         """Return if this item in the enum values"""
         return item in cls.values()
 
+    @classmethod
+    def names(cls):
+        """Return a dict mapping the values of this enum to their keys."""
+        if cls._names is None:
+            cls._names = {value: key for key, value in cls.dict().items()}
+        return cls._names
+
     @classmethod
     def get_key(cls, value, default=None):
-        d = cls.dict()
-        for key in d:
-            if d[key] == value:
-                return key
-        return default
+        return cls.names().get(value, default)
 
 
 class AgentTypes(Enumeration):
@@ -90,6 +158,14 @@ class Format(Enumeration):
     ASCII = 'ascii'
 
 
+class OutputPolicy(Enumeration):
+    """Enumeration describing the handling of endpoints which cannot keep up"""
+    PAUSE = 'pause'
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEWEST = 'drop_newest'
+    DISCONNECT = 'disconnect'
+
+
 class EndpointType(Enumeration):
     INSTRUMENT = 'instrument'  # TCP/RSN
     INSTRUMENT_DATA = 'instrument_data'  # BOTPT
@@ -116,16 +192,6 @@ class PacketType(Enumeration):
     PICKLED_FROM_INSTRUMENT = 10
 
 
-class RouterStat(Enumeration):
-    ADD_ROUTE = 0
-    ADD_CLIENT = 1
-    DEL_CLIENT = 2
-    PACKET_IN = 3
-    PACKET_OUT = 4
-    BYTES_IN = 5
-    BYTES_OUT = 6
-
-
 def string_to_ntp_date_time(datestr):
     """
     Extract an ntp date from a ISO8601 formatted date string.
@@ -0,0 +1,675 @@
+"""
+Datalog storage formats.
+
+A compressed datalog is a series of gzip members, called frames, each holding the packed
+packets written over at most DATALOG_FRAME_BYTES of data or DATALOG_FRAME_INTERVAL seconds.
+Concatenated members are a valid gzip file, so gunzip and zcat read it whole, and every frame
+can be decompressed on its own starting from its first byte. Frames end on packet boundaries.
+
+Each flush of the writer ends with a zlib sync flush, so everything flushed can be read while
+the frame is still open, including from a file whose writer has died. A writer restarted after
+dying appends new frames following the frame left open. Readers read the open frame up to its
+last flush and continue at the next frame header, counting any bytes they cannot decompress.
+
+open_datalog recognises the gzip magic and returns a file-like object producing the packed
+packets, so PacketReader, Packet.packet_from_fh and the datalog agents read either format.
+
+A segmented datalog store writes a series of segment files <name>.<YYYYmmddTHHMMSS.ffffff>Z,
+named for the UTC time each was opened, plain or compressed. Every segment has a sidecar
+index <segment>.idx listing every index_interval-th packet, all integers little endian:
+
+    offset  size  field
+         0     8  magic 'PAINDEX\0'
+         8     4  version (1)
+        12     4  index interval, packets between entries
+        16    20  entries, each:
+                      0  4  packet time, NTP seconds (header ts_high)
+                      4  4  packet time, NTP fraction (header ts_low)
+                      8  8  offset in the segment file
+                     16  1  packet type
+                     17  3  reserved
+
+Decoding may start at the offset of any entry: in a plain segment it is the position of the
+packet's sync bytes, in a compressed segment a frame starts there and the packet is the first
+in the frame. Entries are in file order, their times follow the packet times, which are
+normally non-decreasing, so an entry at or before a given time is found by binary search.
+A partial entry at the end of the index, from a writer which has died, is ignored.
+
+A replay may be limited to a time window without decoding the data before it. Files named with
+their start time are skipped by name, and a plain file by the times of its first and last
+packets, read from one block at each end. Within a plain file the start of the window is found
+by a binary search over the packet headers, see bisect_time, within an indexed file by its index.
+"""
+import bisect
+import calendar
+import datetime
+import os
+import re
+import struct
+import time
+import zlib
+
+import ntplib
+from twisted.python import log
+
+from common import DATALOG_COMPRESSION_LEVEL
+from common import DATALOG_FRAME_BYTES
+from common import DATALOG_FRAME_INTERVAL
+from common import DATALOG_INDEX_INTERVAL
+from common import DATALOG_PROBE_BYTES
+from common import DATALOG_SEGMENT_BYTES
+from common import DATALOG_SEGMENT_SECONDS
+from packet import header_struct
+from packet import PacketDecoder
+
+
+GZIP_MAGIC = '\x1f\x8b'
+# gzip member header up to the deflate compression method, the start of every frame
+FRAME_HEADER = GZIP_MAGIC + '\x08'
+# zlib window bits selecting a gzip header and trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+INDEX_MAGIC = 'PAINDEX\0'
+INDEX_VERSION = 1
+INDEX_SUFFIX = '.idx'
+index_header_struct = struct.Struct('<8sII')
+index_entry_struct = struct.Struct('<IIQB3x')
+SEGMENT_TIME_FORMAT = '%Y%m%dT%H%M%S.%fZ'
+# start time in a datalog file name, a segment time or an RSN archive <YYYYmmddTHHMMSS>_UTC stamp
+FILENAME_TIME = re.compile(r'(\d{8}T\d{6})(?:\.(\d{1,6}))?(?:Z|_UTC)')
+
+
+#################################################################################
+# Compressed datalogs
+#################################################################################
+
+
+class FrameCompressor(object):
+    """
+    Compress datalog data into independently decompressible gzip frames
+    """
+    def __init__(self, level=DATALOG_COMPRESSION_LEVEL, frame_bytes=DATALOG_FRAME_BYTES,
+                 frame_interval=DATALOG_FRAME_INTERVAL, clock=time.time):
+        """
+        :param level: zlib compression level
+        :param frame_bytes: uncompressed bytes after which a frame is ended
+        :param frame_interval: seconds after which a frame is ended at the next write
+        :param clock: callable returning the current time
+        """
+        self.level = level
+        self.frame_bytes = frame_bytes
+        self.frame_interval = frame_interval
+        self.clock = clock
+        self.compressor = None
+        self.frame_size = 0
+        self.frame_start = None
+        self.unsynced = False
+
+        self.frames = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    @property
+    def ratio(self):
+        return self.bytes_in / float(self.bytes_out) if self.bytes_out else 0.0
+
+    def _output(self, data):
+        self.bytes_out += len(data)
+        return data
+
+    def compress(self, chunks):
+        """
+        Compress whole packets, starting a new frame if the current one is too old
+        :param chunks: list of strings of packed packets
+        :return: compressed data to append to the file
+        """
+        output = []
+        if self.compressor is not None and self.clock() - self.frame_start >= self.frame_interval:
+            output.append(self.end())
+
+        if self.compressor is None:
+            self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, GZIP_WBITS)
+            self.frame_start = self.clock()
+            self.frame_size = 0
+            self.frames += 1
+
+        compress = self.compressor.compress
+        for chunk in chunks:
+            output.append(self._output(compress(chunk)))
+            self.frame_size += len(chunk)
+            self.bytes_in += len(chunk)
+        self.unsynced = True
+
+        if self.frame_size >= self.frame_bytes:
+            output.append(self.end())
+        return ''.join(output)
+
+    def sync(self):
+        """
+        :return: compressed data completing everything compressed so far, the frame stays open
+        """
+        if self.compressor is None or not self.unsynced:
+            return ''
+        self.unsynced = False
+        return self._output(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    def end(self):
+        """
+        :return: compressed data ending the current frame, '' if no frame is open
+        """
+        if self.compressor is None:
+            return ''
+        compressor = self.compressor
+        self.compressor = None
+        self.unsynced = False
+        return self._output(compressor.flush())
+
+
+class FrameReader(object):
+    """
+    Read-only file-like object returning the decompressed contents of a compressed datalog.
+    A truncated frame yields the data it holds, reading continues at the next frame header.
+    """
+    block_size = 0x40000
+
+    def __init__(self, file_handle):
+        """
+        :param file_handle: compressed datalog opened in binary mode, positioned at a frame start
+        """
+        self.file_handle = file_handle
+        self.decompressor = zlib.decompressobj(GZIP_WBITS)
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+        self.frames = 1
+        # compressed bytes given to the current frame's decompressor
+        self.frame_input = 0
+        # data kept while searching for the next frame header, None while reading a frame
+        self.resync = None
+        # frames ended without their trailer and compressed bytes which could not be decompressed
+        self.truncated_frames = 0
+        self.bytes_skipped = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _start_frame(self):
+        self.decompressor = zlib.decompressobj(GZIP_WBITS)
+        self.frames += 1
+        self.frame_input = 0
+
+    def _decompress(self, data):
+        output = []
+        while data:
+            if self.resync is not None:
+                data = self._find_frame(self.resync + data)
+                continue
+            decompressor = self.decompressor.copy()
+            try:
+                output.append(self.decompressor.decompress(data))
+            except zlib.error:
+                # a frame left open by a writer which died is followed by the frames written after
+                # its restart, a frame which fails from its first byte is skipped
+                end = _header_offset(data, 1 if not self.frame_input else 0)
+                try:
+                    output.append(decompressor.decompress(data[:end]))
+                except zlib.error:
+                    self.bytes_skipped += end
+                self.truncated_frames += 1
+                log.msg('%s: frame %d is truncated, continuing at the next frame' %
+                        (getattr(self.file_handle, 'name', 'datalog'), self.frames))
+                self.resync = ''
+                data = data[end:]
+                continue
+            self.frame_input += len(data)
+            # data following the end of a frame starts the next one
+            data = self.decompressor.unused_data
+            if data:
+                self._start_frame()
+        return ''.join(output)
+
+    def _find_frame(self, data):
+        """
+        Skip data up to the next frame header
+        :return: data from the frame header, '' until one is found
+        """
+        start = data.find(FRAME_HEADER)
+        if start < 0:
+            # a partial header at the end is kept for the next block
+            end = _header_offset(data, 0)
+            self.bytes_skipped += end
+            self.resync = data[end:]
+            return ''
+        self.bytes_skipped += start
+        self.resync = None
+        self._start_frame()
+        return data[start:]
+
+    def read(self, size=-1):
+        """
+        :param size: maximum bytes returned, all remaining data if negative
+        :return: decompressed data, '' at the end of the file
+        """
+        chunks = [self.buffer]
+        available = len(self.buffer)
+        while (size < 0 or available < size) and not self.eof:
+            block = self.file_handle.read(self.block_size)
+            if not block:
+                self.eof = True
+                break
+            data = self._decompress(block)
+            chunks.append(data)
+            available += len(data)
+
+        data = ''.join(chunks)
+        if 0 <= size < len(data):
+            data, self.buffer = data[:size], data[size:]
+        else:
+            self.buffer = ''
+        self.position += len(data)
+        return data
+
+    def tell(self):
+        """
+        :return: offset in the decompressed data
+        """
+        return self.position
+
+    def close(self):
+        self.file_handle.close()
+
+
+def _header_offset(data, start):
+    """
+    :return: offset of the first frame header in data from start, else of a partial header ending
+        the data, else the length of the data
+    """
+    offset = data.find(FRAME_HEADER, start)
+    if offset >= 0:
+        return offset
+    for size in xrange(len(FRAME_HEADER) - 1, 0, -1):
+        if len(data) - size >= start and data.endswith(FRAME_HEADER[:size]):
+            return len(data) - size
+    return len(data)
+
+
+def is_compressed(file_handle):
+    """
+    :return: True if the file starts with the gzip magic, the file position is preserved
+    """
+    position = file_handle.tell()
+    magic = file_handle.read(len(GZIP_MAGIC))
+    file_handle.seek(position)
+    return magic == GZIP_MAGIC
+
+
+def open_datalog(path, start_time=None):
+    """
+    Open a datalog for reading, compressed or not
+    :param start_time: NTP time, if the datalog has an index start at the last indexed packet before it
+    :return: file-like object supporting read, tell and close
+    """
+    file_handle = open(path, 'rb')
+    compressed = is_compressed(file_handle)
+    if start_time is not None and os.path.exists(path + INDEX_SUFFIX):
+        file_handle.seek(search_index(path + INDEX_SUFFIX, start_time))
+    if compressed:
+        return FrameReader(file_handle)
+    return file_handle
+
+
+#################################################################################
+# Segmented datalogs
+#################################################################################
+
+
+def ntp_time(ts_high, ts_low):
+    return ts_high + ts_low / 4294967296.0
+
+
+def read_index(path):
+    """
+    :return: (index interval, list of (NTP time, offset, packet type))
+    """
+    with open(path, 'rb') as fh:
+        data = fh.read()
+    magic, version, interval = index_header_struct.unpack_from(data)
+    if magic != INDEX_MAGIC or version != INDEX_VERSION:
+        raise ValueError('%s is not a datalog index' % path)
+    entries = []
+    for offset in xrange(index_header_struct.size, len(data) - index_entry_struct.size + 1, index_entry_struct.size):
+        ts_high, ts_low, position, packet_type = index_entry_struct.unpack_from(data, offset)
+        entries.append((ntp_time(ts_high, ts_low), position, packet_type))
+    return interval, entries
+
+
+class IndexEntries(object):
+    """
+    Sequence of the entry times in an index file, read on demand so bisect reads O(log n) entries
+    """
+    def __init__(self, file_handle):
+        self.file_handle = file_handle
+        file_handle.seek(0, os.SEEK_END)
+        self.count = (file_handle.tell() - index_header_struct.size) // index_entry_struct.size
+
+    def __len__(self):
+        return self.count
+
+    def entry(self, index):
+        self.file_handle.seek(index_header_struct.size + index * index_entry_struct.size)
+        return index_entry_struct.unpack(self.file_handle.read(index_entry_struct.size))
+
+    def __getitem__(self, index):
+        ts_high, ts_low, _, _ = self.entry(index)
+        return ntp_time(ts_high, ts_low)
+
+
+def search_index(path, packet_time):
+    """
+    Binary search an index file
+    :return: offset of the last indexed packet stamped before packet_time, 0 if there is none
+    """
+    with open(path, 'rb') as fh:
+        magic, version, _ = index_header_struct.unpack(fh.read(index_header_struct.size))
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError('%s is not a datalog index' % path)
+        entries = IndexEntries(fh)
+        index = bisect.bisect_left(entries, packet_time)
+        if index == 0:
+            return 0
+        return entries.entry(index - 1)[2]
+
+
+def list_segments(path):
+    """
+    :param path: segmented store path, directory and name
+    :return: sorted list of the segment files of the store
+    """
+    directory, name = os.path.split(path)
+    matcher = re.compile(re.escape(name) + r'\.\d{8}T\d{6}\.\d{6}Z$')
+    return sorted(os.path.join(directory, each) for each in os.listdir(directory or '.') if matcher.match(each))
+
+
+class SegmentStore(object):
+    """
+    Datalog written as a series of indexed segments, for use as the file of a logwriter.LogFile.
+
+    A new segment is started at the first write once the current one holds segment_bytes
+    or was opened segment_seconds ago. When a segment is started the oldest segments are
+    deleted while the store exceeds retain_bytes or they were last written more than
+    retain_seconds ago. Writes must hold whole packets.
+    """
+    def __init__(self, name, directory, segment_bytes=DATALOG_SEGMENT_BYTES, segment_seconds=DATALOG_SEGMENT_SECONDS,
+                 index_interval=DATALOG_INDEX_INTERVAL, retain_bytes=None, retain_seconds=None, compressor=None,
+                 clock=time.time):
+        """
+        :param name: segment file name prefix
+        :param directory: directory holding the segments
+        :param segment_bytes: size at which a segment is ended, compressed size for compressed segments
+        :param segment_seconds: age at which a segment is ended
+        :param index_interval: packets between index entries
+        :param retain_bytes: total size of the segments and indexes kept, None for no limit
+        :param retain_seconds: age of the segments kept, None for no limit
+        :param compressor: FrameCompressor to write compressed segments, None to write plain
+        :param clock: callable returning the current time
+        """
+        self.path = os.path.join(directory, name)
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.index_interval = index_interval
+        self.retain_bytes = retain_bytes
+        self.retain_seconds = retain_seconds
+        self.compressor = compressor
+        self.clock = clock
+        self.closed = False
+
+        self.segment = None
+        self.segment_path = None
+        self.index = None
+        self.opened = None
+        # bytes written to the current segment and packets in it
+        self.position = 0
+        self.packets = 0
+        self.segments = 0
+        self.deleted = 0
+
+    def __repr__(self):
+        return 'SegmentStore(%r)' % self.path
+
+    def _open(self, now):
+        stamp = datetime.datetime.utcfromtimestamp(now).strftime(SEGMENT_TIME_FORMAT)
+        self.segment_path = '%s.%s' % (self.path, stamp)
+        self.segment = open(self.segment_path, 'ab')
+        self.index = open(self.segment_path + INDEX_SUFFIX, 'wb')
+        self.index.write(index_header_struct.pack(INDEX_MAGIC, INDEX_VERSION, self.index_interval))
+        self.opened = now
+        self.position = self.segment.tell()
+        self.packets = 0
+        self.segments += 1
+
+    def _close_segment(self):
+        if self.segment is not None:
+            self._emit_end()
+            self.segment.close()
+            self.index.close()
+            self.segment = None
+            self.index = None
+
+    def _emit(self, chunks):
+        if self.compressor is not None:
+            data = self.compressor.compress(chunks)
+            self.segment.write(data)
+            self.position += len(data)
+        else:
+            self.segment.writelines(chunks)
+            self.position += sum(map(len, chunks))
+
+    def _emit_end(self):
+        if self.compressor is not None:
+            data = self.compressor.end()
+            self.segment.write(data)
+            self.position += len(data)
+
+    def writelines(self, chunks):
+        """
+        Write whole packets, indexing every index_interval-th packet
+        """
+        now = self.clock()
+        if self.segment is None or self.position >= self.segment_bytes or now - self.opened >= self.segment_seconds:
+            self._close_segment()
+            self._open(now)
+            self.apply_retention(now)
+
+        interval = self.index_interval
+        header_size = header_struct.size
+        pending = []
+        entries = []
+        for chunk in chunks:
+            start = 0
+            offset = 0
+            end = len(chunk)
+            while offset + header_size <= end:
+                _, packet_type, packet_size, _, ts_high, ts_low = header_struct.unpack_from(chunk, offset)
+                if self.packets % interval == 0:
+                    if offset > start:
+                        pending.append(chunk[start:offset])
+                        start = offset
+                    if pending:
+                        self._emit(pending)
+                        pending = []
+                    # an indexed packet starts a new frame in a compressed segment
+                    self._emit_end()
+                    entries.append(index_entry_struct.pack(ts_high, ts_low, self.position, packet_type))
+                self.packets += 1
+                offset += max(packet_size, header_size)
+            pending.append(chunk if start == 0 else chunk[start:])
+
+        if pending:
+            self._emit(pending)
+        self.index.writelines(entries)
+
+    def flush(self):
+        if self.segment is not None:
+            if self.compressor is not None:
+                data = self.compressor.sync()
+                self.segment.write(data)
+                self.position += len(data)
+            self.segment.flush()
+            self.index.flush()
+
+    def fsync(self):
+        if self.segment is not None:
+            os.fsync(self.segment.fileno())
+            os.fsync(self.index.fileno())
+
+    def close(self):
+        self._close_segment()
+        self.closed = True
+
+    def apply_retention(self, now):
+        """
+        Delete the oldest segments, never the current one, while the retention limits are exceeded
+        """
+        if self.retain_bytes is None and self.retain_seconds is None:
+            return
+        segments = [each for each in list_segments(self.path) if each != self.segment_path]
+        sizes = {}
+        total = 0
+        for segment in segments + [self.segment_path]:
+            sizes[segment] = sum(os.path.getsize(each) for each in (segment, segment + INDEX_SUFFIX)
+                                 if os.path.exists(each))
+            total += sizes[segment]
+
+        for segment in segments:
+            expired = self.retain_seconds is not None and os.path.getmtime(segment) < now - self.retain_seconds
+            if not expired and (self.retain_bytes is None or total <= self.retain_bytes):
+                break
+            for each in (segment, segment + INDEX_SUFFIX):
+                try:
+                    os.unlink(each)
+                except OSError as e:
+                    log.msg('Unable to delete datalog segment %s: %s' % (each, e))
+            total -= sizes[segment]
+            self.deleted += 1
+
+
+#################################################################################
+# Time windows
+#################################################################################
+
+
+def filename_time(path):
+    """
+    :return: NTP time a datalog was started according to its file name, None if the name holds no time
+    """
+    match = FILENAME_TIME.search(os.path.basename(path))
+    if match is None:
+        return None
+    started = datetime.datetime.strptime(match.group(1), '%Y%m%dT%H%M%S')
+    fraction = int((match.group(2) or '').ljust(6, '0')) / 1e6
+    return ntplib.system_to_ntp_time(calendar.timegm(started.timetuple()) + fraction)
+
+
+def series_end_times(paths):
+    """
+    Find when datalogs named with their start time ended: at the start of the next file in the
+    same series, named alike but for the time.
+    :return: dict of path to NTP time, for each path followed by another in its series
+    """
+    series = {}
+    for path in paths:
+        started = filename_time(path)
+        if started is not None:
+            directory, name = os.path.split(path)
+            series.setdefault((directory, FILENAME_TIME.sub('', name)), []).append((started, path))
+
+    ends = {}
+    for files in series.itervalues():
+        files.sort()
+        for (started, path), (next_started, _) in zip(files, files[1:]):
+            if next_started > started:
+                ends[path] = next_started
+    return ends
+
+
+def probe_packets(file_handle, offset, size=DATALOG_PROBE_BYTES):
+    """
+    Find the packets in one block of a plain datalog
+    :return: list of (offset, NTP time) of the complete packets with a valid checksum starting in the
+             size bytes at offset
+    """
+    file_handle.seek(offset)
+    decoder = PacketDecoder(verify=True)
+    decoder.stream_offset = offset
+    return [(position, packet.header.time) for position, packet in decoder.decode(file_handle.read(size))]
+
+
+def time_bounds(file_handle, probe=probe_packets, size=DATALOG_PROBE_BYTES):
+    """
+    Read the times of the first and last records of a plain file, the file position is preserved
+    :param probe: callable(file_handle, offset) returning the (offset, NTP time) of the records in a block
+    :return: (first, last) NTP times, (None, None) if no record is found
+    """
+    position = file_handle.tell()
+    file_handle.seek(0, os.SEEK_END)
+    end = file_handle.tell()
+    head = probe(file_handle, 0)
+    tail = probe(file_handle, max(0, end - size))
+    file_handle.seek(position)
+    if not head or not tail:
+        return None, None
+    return head[0][1], tail[-1][1]
+
+
+def bisect_time(file_handle, start_time, probe=probe_packets, low=0, size=DATALOG_PROBE_BYTES):
+    """
+    Binary search a plain file for the records stamped start_time or later, reading one block
+    per step. The file is left positioned at the returned offset.
+    :param probe: callable(file_handle, offset) returning the (offset, NTP time) of the records in a block
+    :param low: offset of a record stamped before start_time, or of the start of the file
+    :return: offset of a record stamped before start_time, or low. Reading from there reaches every
+             record stamped start_time or later provided the record times never decrease.
+    """
+    file_handle.seek(0, os.SEEK_END)
+    high = file_handle.tell()
+    while high - low > size:
+        middle = (low + high) // 2
+        before = [offset for offset, record_time in probe(file_handle, middle)
+                  if record_time < start_time and offset < high]
+        if before:
+            low = before[-1]
+        else:
+            high = middle
+    file_handle.seek(low)
+    return low
+
+
+def seek_window(path, file_handle, start=None, end=None, probe=probe_packets, named_end=None):
+    """
+    Position a datalog opened with open_datalog(path, start) at the start of a time window
+    :param probe: callable(file_handle, offset) returning the (offset, NTP time) of the records in a block,
+                  None if the records are not timestamped
+    :param named_end: time the file ended according to the name of the next file of its series
+    :return: False if the file holds no records within the window
+    """
+    if start is None and end is None:
+        return True
+
+    first, last = filename_time(path), named_end
+    # compressed files cannot seek, they are positioned by their index, if any, when opened
+    searchable = probe is not None and hasattr(file_handle, 'seek')
+    if searchable:
+        first_record, last_record = time_bounds(file_handle, probe)
+        if first_record is not None:
+            first, last = first_record, last_record
+
+    if end is not None and first is not None and first > end:
+        return False
+    if start is not None and last is not None and last < start:
+        return False
+    if searchable and start is not None:
+        bisect_time(file_handle, start, probe, low=file_handle.tell())
+    return True
@@ -1,23 +1,306 @@
 #!/usr/bin/env python
-from agents import Packet
+"""
+Usage:
+    decoder.py [--format=<format>] [--type=<types>] [--start=<time>] [--end=<time>] [--processes=<count>] <files>...
+    decoder.py --stats [--json] [--gap=<seconds>] [--type=<types>] [--start=<time>] [--end=<time>] [--processes=<count>] <files>...
+
+Options:
+    -h, --help              Show this screen.
+    --format=<format>       Output format: ascii, json, raw or csv [default: ascii]
+    --type=<types>          Comma separated packet types, by name or number (default: all)
+    --start=<time>          Decode packets from this time, ISO8601 UTC or NTP seconds
+    --end=<time>            Decode packets up to this time, ISO8601 UTC or NTP seconds
+    --processes=<count>     Processes decoding the files, 0 decodes in this process (default: one per CPU)
+    --stats                 Summarize the packets of each type instead of printing them
+    --json                  Print the summary as JSON
+    --gap=<seconds>         Count intervals longer than this between packets of a type as gaps [default: 60]
+
+Decode port agent datalogs, plain, compressed or segments, to standard output in the order of
+the files given. Output formats, one line per packet except raw:
+
+    ascii   <NTP time> : <type> : <CRC OK|CRC BAD> : <payload repr>
+    json    {"payload": ..., "time": ..., "type": ..., "valid": ...}, the payload bytes as latin-1
+    raw     the payloads concatenated
+    csv     time,type,size,checksum,valid with a header line
+
+The files are decoded and formatted a chunk at a time by a pool of worker processes, a few files
+ahead of the output, so memory use is bounded whatever the size of the files, see merge.ChunkPool.
+Files outside the time window are skipped and plain and indexed datalogs are read from its start,
+see datalog.seek_window.
+
+With --stats the packets of each type are counted with their bytes, checksum failures and the
+gaps, intervals longer than --gap seconds, between consecutive packets of the type.
+"""
+import datetime
+import errno
+import json
 import sys
+from json.encoder import encode_basestring_ascii
+from functools import partial
+
+from docopt import docopt
+import ntplib
+from twisted.python import log
+
+from common import DATE_FORMAT
+from common import MERGE_CHUNK_BYTES
+from common import PacketType
+from datalog import series_end_times
+from merge import ChunkDecoder
+from merge import ChunkPool
+from packet import Packet
+from packet import PacketHeader
+from packet import scan_buffer
+from subscription import parse_packet_type
+from subscription import parse_time
+
+
+OUTPUT_FORMATS = ('ascii', 'json', 'raw', 'csv')
+CSV_HEADER = 'time,type,size,checksum,valid\n'
+
+
+def ntp_to_iso(ntp_time):
+    if ntp_time is None:
+        return None
+    return datetime.datetime.utcfromtimestamp(ntplib.ntp_to_system_time(ntp_time)).strftime(DATE_FORMAT)
+
+
+#################################################################################
+# Decoding
+#################################################################################
+
+
+class FileDecoder(object):
+    """
+    Format the packets of one datalog, a chunk at a time
+    """
+    def __init__(self, path, start=None, end=None, packet_types=None, named_end=None, chunk_bytes=MERGE_CHUNK_BYTES,
+                 output_format='ascii'):
+        """
+        :param output_format: one of OUTPUT_FORMATS, see ChunkDecoder for the other parameters
+        """
+        self.decoder = ChunkDecoder(path, start, end, packet_types, named_end, chunk_bytes)
+        self.format = getattr(self, '_format_' + output_format)
+
+    def next_chunk(self):
+        """
+        :return: formatted packets of the next chunk of the file, None once the file is exhausted
+        """
+        data = self.decoder.next_chunk()
+        if data is None:
+            return None
+        records, _ = scan_buffer(data)
+        return self.format(data, records)
+
+    def close(self):
+        self.decoder.close()
+
+    @staticmethod
+    def _format_ascii(data, records):
+        header_size = PacketHeader.header_size
+        trusted = PacketHeader.trusted
+        lines = []
+        for offset, packet_type, packet_size, checksum, ts_high, ts_low, valid in records:
+            header = trusted(packet_type, packet_size, checksum, ts_high, ts_low)
+            packet = Packet(payload=data[offset + header_size:offset + packet_size], header=header, valid=valid)
+            lines.append(packet.logstring)
+        lines.append('')
+        return '\n'.join(lines)
+
+    @staticmethod
+    def _format_json(data, records):
+        # formatted directly rather than with json.dumps, which is several times slower per packet
+        header_size = PacketHeader.header_size
+        get_key = PacketType.get_key
+        lines = []
+        for offset, packet_type, packet_size, _, ts_high, ts_low, valid in records:
+            payload = data[offset + header_size:offset + packet_size].decode('latin-1')
+            lines.append('{"payload": %s, "time": %r, "type": "%s", "valid": %s}' % (
+                encode_basestring_ascii(payload), ts_high + ts_low / 4294967296.0,
+                get_key(packet_type, 'UNKNOWN'), 'true' if valid else 'false'))
+        lines.append('')
+        return '\n'.join(lines)
+
+    @staticmethod
+    def _format_raw(data, records):
+        header_size = PacketHeader.header_size
+        return ''.join([data[offset + header_size:offset + packet_size]
+                        for offset, _, packet_size, _, _, _, _ in records])
+
+    @staticmethod
+    def _format_csv(data, records):
+        get_key = PacketType.get_key
+        return ''.join(['%.6f,%s,%d,%d,%d\n' % (ts_high + ts_low / 4294967296.0, get_key(packet_type, 'UNKNOWN'),
+                                                 packet_size, checksum, valid)
+                        for _, packet_type, packet_size, checksum, ts_high, ts_low, valid in records])
+
+
+#################################################################################
+# Statistics
+#################################################################################
+
+
+def new_type_stats():
+    return {'packets': 0, 'bytes': 0, 'bad_checksums': 0, 'gaps': 0, 'max_gap': 0.0, 'first': None, 'last': None}
+
+
+class FileStats(object):
+    """
+    Summarize the packets of one datalog, returned as a single chunk once the file is read
+    """
+    def __init__(self, path, start=None, end=None, packet_types=None, named_end=None, chunk_bytes=MERGE_CHUNK_BYTES,
+                 gap=60):
+        """
+        :param gap: seconds between consecutive packets of a type counted as a gap, see ChunkDecoder
+                    for the other parameters
+        """
+        self.decoder = ChunkDecoder(path, start, end, packet_types, named_end, chunk_bytes)
+        self.gap = gap
+        self.done = False
+
+    def next_chunk(self):
+        """
+        :return: {'types': {packet type: statistics}, 'bytes_skipped': count}, None once returned
+        """
+        if self.done:
+            return None
+        self.done = True
+        gap = self.gap
+        types = {}
+        for data in iter(self.decoder.next_chunk, None):
+            records, _ = scan_buffer(data)
+            for _, packet_type, packet_size, _, ts_high, ts_low, valid in records:
+                stats = types.get(packet_type)
+                if stats is None:
+                    stats = types[packet_type] = new_type_stats()
+                stats['packets'] += 1
+                stats['bytes'] += packet_size
+                if not valid:
+                    stats['bad_checksums'] += 1
+                if ts_high or ts_low:
+                    packet_time = ts_high + ts_low / 4294967296.0
+                    last = stats['last']
+                    if last is None:
+                        stats['first'] = packet_time
+                    elif packet_time - last > gap:
+                        stats['gaps'] += 1
+                        stats['max_gap'] = max(stats['max_gap'], packet_time - last)
+                    stats['last'] = packet_time
+        return {'types': types, 'bytes_skipped': self.decoder.bytes_skipped}
+
+    def close(self):
+        self.decoder.close()
+
+
+def combine_stats(total, stats, gap):
+    """
+    Add the statistics of a file to the total of the files before it
+    """
+    total['files'] += 1
+    total['bytes_skipped'] += stats['bytes_skipped']
+    for packet_type, each in stats['types'].iteritems():
+        combined = total['types'].setdefault(packet_type, new_type_stats())
+        # the interval from the previous file
+        if combined['last'] is not None and each['first'] is not None and each['first'] - combined['last'] > gap:
+            combined['gaps'] += 1
+            combined['max_gap'] = max(combined['max_gap'], each['first'] - combined['last'])
+        for key in ('packets', 'bytes', 'bad_checksums', 'gaps'):
+            combined[key] += each[key]
+        combined['max_gap'] = max(combined['max_gap'], each['max_gap'])
+        if combined['first'] is None:
+            combined['first'] = each['first']
+        if each['last'] is not None:
+            combined['last'] = each['last']
+
+
+def format_stats(total, as_json=False):
+    types = []
+    for packet_type in sorted(total['types']):
+        stats = dict(total['types'][packet_type], type=PacketType.get_key(packet_type, 'UNKNOWN'))
+        stats['first'] = ntp_to_iso(stats['first'])
+        stats['last'] = ntp_to_iso(stats['last'])
+        types.append(stats)
+
+    if as_json:
+        return json.dumps({'files': total['files'], 'bytes_skipped': total['bytes_skipped'], 'types': types},
+                          sort_keys=True, indent=2) + '\n'
+
+    lines = ['%-24s %12s %14s %10s %8s %12s  %-27s %-27s' % ('type', 'packets', 'bytes', 'bad crc', 'gaps',
+                                                              'longest gap', 'first', 'last')]
+    for stats in types:
+        lines.append('%-24s %12d %14d %10d %8d %12.1f  %-27s %-27s' % (
+            stats['type'], stats['packets'], stats['bytes'], stats['bad_checksums'], stats['gaps'],
+            stats['max_gap'], stats['first'] or '-', stats['last'] or '-'))
+    lines.append('%d files, %d bytes skipped' % (total['files'], total['bytes_skipped']))
+    return '\n'.join(lines) + '\n'
+
+
+#################################################################################
+# Command line
+#################################################################################
+
+
+def decode(files, factory, args=(), start=None, end=None, packet_types=None, processes=None):
+    """
+    Run a FileDecoder or FileStats over every file, in file order
+    :param factory: FileDecoder or FileStats
+    :param args: factory arguments following the ChunkDecoder arguments
+    :return: generator of the chunks of every file in turn
+    """
+    ends = series_end_times(files)
+    jobs = [(path, start, end, packet_types, ends.get(path), MERGE_CHUNK_BYTES) + tuple(args) for path in files]
+    pool = ChunkPool(jobs, factory=factory, processes=processes)
+    pool.start()
+    # keep every worker busy with the files following the one being output
+    ahead = max(1, 2 * pool.processes)
+    try:
+        for index in xrange(len(jobs)):
+            for each in xrange(index, min(len(jobs), index + ahead)):
+                pool.open(each)
+            for chunk in iter(partial(pool.next_chunk, index), None):
+                yield chunk
+    finally:
+        pool.close()
 
 
 def main():
-    # check that there is only one parameter on the command line
-    if len(sys.argv) < 2:
-        sys.stderr.write('Expected one or more files to decode, got 0!\n')
+    options = docopt(__doc__)
+    # unreadable files are reported on stderr
+    log.addObserver(lambda event: sys.stderr.write(log.textFromEventDict(event) + '\n'))
+    files = options['<files>']
+    output_format = options['--format']
+    try:
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError('Unknown output format: %s' % output_format)
+        kwargs = {
+            'start': parse_time(options['--start']) if options['--start'] else None,
+            'end': parse_time(options['--end']) if options['--end'] else None,
+            'packet_types': [parse_packet_type(each) for each in options['--type'].split(',')]
+            if options['--type'] else None,
+            'processes': int(options['--processes']) if options['--processes'] is not None else None,
+        }
+        gap = float(options['--gap'])
+    except ValueError as e:
+        sys.stderr.write('%s\n' % e)
         sys.exit(1)
 
-    files = sys.argv[1:]
+    try:
+        if options['--stats']:
+            total = {'files': 0, 'bytes_skipped': 0, 'types': {}}
+            for stats in decode(files, FileStats, (gap,), **kwargs):
+                combine_stats(total, stats, gap)
+            sys.stdout.write(format_stats(total, options['--json']))
+        else:
+            if output_format == 'csv':
+                sys.stdout.write(CSV_HEADER)
+            for chunk in decode(files, FileDecoder, (output_format,), **kwargs):
+                sys.stdout.write(chunk)
+        sys.stdout.flush()
+    except IOError as e:
+        # output piped to a command which has exited, such as head
+        if e.errno != errno.EPIPE:
+            raise
 
-    for filename in files:
-        with open(filename, "rb") as fh:
-            while True:
-                packet = Packet.packet_from_fh(fh)
-                if packet is None:
-                    break
-                print packet
 
 if __name__ == '__main__':
     main()
@@ -8,6 +8,7 @@ from protocols import CommandProtocol
 from protocols import DigiInstrumentProtocol
 from protocols import DigiCommandProtocol
 from protocols import PortAgentClientProtocol
+from protocols import ReplayClientProtocol
 
 
 #################################################################################
@@ -69,6 +70,13 @@ class DataFactory(Factory):
         return p
 
 
+class ReplayFactory(DataFactory):
+    """
+    Subclasses DataFactory to utilize the ReplayClientProtocol for clients resuming a stream
+    """
+    protocol = ReplayClientProtocol
+
+
 class CommandFactory(DataFactory):
     """
     Subclasses DataFactory to utilize the CommandProtocol for incoming command connections
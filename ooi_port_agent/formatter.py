@@ -0,0 +1,145 @@
+#################################################################################
+# ASCII Formatter
+#################################################################################
+import Queue
+import threading
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.defer import succeed
+from twisted.python import log
+
+from common import NEWLINE
+
+
+def format_packets(packets):
+    """
+    Format packets as ASCII log lines
+    :param packets: iterable of Packet
+    :return: string containing one line per packet
+    """
+    return ''.join([packet.logstring + NEWLINE for packet in packets])
+
+
+class AsciiFormatter(object):
+    """
+    Formats packets for ASCII endpoints on a worker thread.
+
+    The router submits, once per batch of routed packets, a list of (packet, clients)
+    pairs. The worker drains everything queued since its last pass, formats each run
+    of consecutive packets bound for the same clients into a single string and hands
+    it back to the reactor thread, where it is written to each client in one call.
+
+    Submitting never blocks the reactor: once max_queue batches are waiting the new
+    batch is dropped and counted in dropped_batches and dropped_packets.
+    """
+    max_queue = 10000
+    # seconds between attempts to queue a drain marker while the queue is full
+    drain_retry = 0.1
+
+    def __init__(self, deliver=None):
+        """
+        :param deliver: callable used to run writes on the reactor thread, reactor.callFromThread by default
+        """
+        self.deliver = deliver if deliver is not None else reactor.callFromThread
+        self.queue = Queue.Queue(maxsize=self.max_queue)
+        self.thread = None
+        self.dropped_batches = 0
+        self.dropped_packets = 0
+
+    def submit(self, items):
+        """
+        Queue packets for formatting, dropping them if the worker has fallen behind
+        :param items: list of (packet, clients), clients is a tuple of endpoints
+        :return: False if the items were dropped
+        """
+        if self.thread is None:
+            self.start()
+        try:
+            self.queue.put_nowait(items)
+        except Queue.Full:
+            self.dropped_batches += 1
+            self.dropped_packets += len(items)
+            return False
+        return True
+
+    def drain(self):
+        """
+        :return: deferred firing on the reactor thread once everything submitted so far has been written
+        """
+        if self.thread is None:
+            return succeed(None)
+        drained = Deferred()
+        self._queue_marker(drained)
+        return drained
+
+    def _queue_marker(self, drained):
+        try:
+            self.queue.put_nowait(drained)
+        except Queue.Full:
+            reactor.callLater(self.drain_retry, self._queue_marker, drained)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='AsciiFormatter')
+        self.thread.daemon = True
+        self.thread.start()
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while True:
+            batches = [self.queue.get()]
+            try:
+                while True:
+                    batches.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+
+            items = []
+            for batch in batches:
+                if batch is None:
+                    self.format(items)
+                    return
+                if isinstance(batch, Deferred):
+                    # drain marker, fired after the writes of everything queued before it
+                    self.format(items)
+                    items = []
+                    self.deliver(batch.callback, None)
+                    continue
+                items.extend(batch)
+
+            self.format(items)
+
+    def format(self, items):
+        """
+        Format runs of packets bound for the same clients and deliver them
+        """
+        run = []
+        run_clients = None
+        for packet, clients in items:
+            if clients != run_clients and run:
+                self._deliver(run, run_clients)
+                run = []
+            run_clients = clients
+            run.append(packet)
+
+        if run:
+            self._deliver(run, run_clients)
+
+    def _deliver(self, packets, clients):
+        try:
+            data = format_packets(packets)
+        except Exception:
+            log.err()
+            return
+        self.deliver(self.write, clients, data)
+
+    @staticmethod
+    def write(clients, data):
+        for client in clients:
+            client.write(data)
@@ -0,0 +1,108 @@
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+
+from formatter import AsciiFormatter
+from logwriter import LogWriter
+from web import ConsulClient
+
+
+#################################################################################
+# Agent Host
+#
+# Services shared by every port agent running in a process
+#################################################################################
+
+
+class Scheduler(object):
+    """
+    Run periodic callbacks, sharing a single timer between all callbacks with the same interval
+    """
+    def __init__(self, clock=reactor):
+        self.clock = clock
+        self.loops = {}
+        self.callbacks = {}
+
+    def add(self, interval, func):
+        """
+        Call func every interval seconds, starting one interval from now
+        """
+        callbacks = self.callbacks.setdefault(interval, [])
+        callbacks.append(func)
+        if interval not in self.loops:
+            loop = LoopingCall(self._run, interval)
+            loop.clock = self.clock
+            loop.start(interval, now=False)
+            self.loops[interval] = loop
+
+    def remove(self, interval, func):
+        callbacks = self.callbacks.get(interval, [])
+        if func in callbacks:
+            callbacks.remove(func)
+        if not callbacks and interval in self.loops:
+            self.loops.pop(interval).stop()
+            self.callbacks.pop(interval, None)
+
+    def _run(self, interval):
+        for func in list(self.callbacks.get(interval, ())):
+            try:
+                func()
+            except Exception:
+                log.err(None, 'Scheduled call failed: %r' % func)
+
+    def stop(self):
+        for loop in self.loops.itervalues():
+            loop.stop()
+        self.loops.clear()
+        self.callbacks.clear()
+
+
+class AgentHost(object):
+    """
+    Shared reactor services for the port agents in this process: one timer per interval,
+    one ASCII formatter thread, one log writer thread and one Consul client with
+    persistent connections.
+    Each port agent keeps its own Router.
+
+    The reactor is stopped once the last agent added to the host has stopped,
+    unless exit_when_empty is False.
+    """
+    exit_when_empty = True
+
+    def __init__(self, scheduler=None, formatter=None, consul=None, log_writer=None):
+        self.scheduler = scheduler if scheduler is not None else Scheduler()
+        self.formatter = formatter if formatter is not None else AsciiFormatter()
+        self.log_writer = log_writer if log_writer is not None else LogWriter()
+        self.consul = consul if consul is not None else ConsulClient()
+        self.agents = []
+
+    def add(self, agent):
+        self.agents.append(agent)
+
+    def remove(self, agent):
+        if agent in self.agents:
+            self.agents.remove(agent)
+            if not self.agents and self.exit_when_empty and reactor.running:
+                log.msg('All port agents stopped, exiting...')
+                reactor.stop()
+
+
+_host = None
+
+
+def set_host(host):
+    """
+    Replace the AgentHost used by port agents in this process, before any are created
+    """
+    global _host
+    _host = host
+
+
+def get_host():
+    """
+    Return the AgentHost shared by all port agents in this process
+    """
+    global _host
+    if _host is None:
+        _host = AgentHost()
+    return _host
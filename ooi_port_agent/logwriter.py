@@ -0,0 +1,370 @@
+import os
+import Queue
+import threading
+import time
+
+from twisted.internet import reactor
+from twisted.python import log
+from twisted.python.logfile import DailyLogFile
+
+from common import LOG_BUFFER_SIZE
+from common import LOG_FLUSH_INTERVAL
+from common import LOG_FSYNC_INTERVAL
+from common import LOG_QUEUE_BYTES
+
+
+#################################################################################
+# Log Writer
+#################################################################################
+
+
+class BufferedLogFile(DailyLogFile):
+    """
+    DailyLogFile written through a large buffer, flushed explicitly by the LogWriter
+    """
+    buffer_size = LOG_BUFFER_SIZE
+
+    def _openFile(self):
+        # let DailyLogFile create the file and apply its mode, then reopen it buffered
+        DailyLogFile._openFile(self)
+        self._file.close()
+        self._file = open(self.path, 'ab', self.buffer_size)
+
+    def writelines(self, chunks):
+        """
+        Write a batch of chunks, rotating first if the date has changed since the last write
+        """
+        if self.shouldRotate():
+            self.flush()
+            self.rotate()
+        self._file.writelines(self.encode(chunks))
+        self.lastDate = max(self.lastDate, self.toDate())
+
+    def encode(self, chunks):
+        """
+        :return: list of strings written to the file for chunks
+        """
+        return chunks
+
+    def fsync(self):
+        os.fsync(self._file.fileno())
+
+
+class CompressedLogFile(BufferedLogFile):
+    """
+    BufferedLogFile storing its data as gzip frames, see datalog
+    """
+    def __init__(self, name, directory, compressor):
+        """
+        :param compressor: datalog.FrameCompressor
+        """
+        self.compressor = compressor
+        BufferedLogFile.__init__(self, name, directory)
+
+    def encode(self, chunks):
+        return [self.compressor.compress(chunks)]
+
+    def flush(self):
+        self._file.write(self.compressor.sync())
+        self._file.flush()
+
+    def rotate(self):
+        # the rotated file ends with a complete frame
+        self._file.write(self.compressor.end())
+        BufferedLogFile.rotate(self)
+
+    def close(self):
+        self._file.write(self.compressor.end())
+        BufferedLogFile.close(self)
+
+
+class LogFile(object):
+    """
+    Router endpoint for a log file written by a LogWriter thread.
+
+    The file is a BufferedLogFile, a CompressedLogFile or a datalog.SegmentStore,
+    any object providing writelines, flush, fsync, close, closed and path.
+
+    Writes on the reactor thread only queue the data. When more than queue_bytes
+    are waiting the endpoint pauses its router Output, which then applies its slow
+    consumer policy, and resumes it once the writer has caught up to half that.
+    The writer flushes the file at least every flush_interval seconds after it
+    was written to and, unless fsync_interval is None, syncs it to disk at least
+    every fsync_interval seconds.
+    """
+    def __init__(self, log_file, writer, flush_interval=LOG_FLUSH_INTERVAL,
+                 fsync_interval=LOG_FSYNC_INTERVAL, queue_bytes=LOG_QUEUE_BYTES):
+        """
+        :param log_file: file written, only used by the writer thread once queued
+        :param writer: LogWriter performing the writes
+        :param flush_interval: maximum seconds written data stays in the file buffer
+        :param fsync_interval: maximum seconds between a write and fsync, None to never fsync
+        :param queue_bytes: bytes queued for the writer before the router output is paused
+        """
+        self.log_file = log_file
+        self.path = self.log_file.path
+        self.writer = writer
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.queue_bytes = queue_bytes
+        # the router Output registers itself as our producer
+        self.transport = self
+        self.producer = None
+        self.paused = False
+        self.closed = False
+
+        # updated on the reactor thread
+        self.queued_batches = 0
+        self.queued_bytes = 0
+        self.pauses = 0
+        # updated on the writer thread
+        self.written_batches = 0
+        self.written_bytes = 0
+        self.writes = 0
+        self.flushes = 0
+        self.fsyncs = 0
+        self.errors = 0
+        self.latency = 0.0
+        self.latency_max = 0.0
+        self.write_seconds = 0.0
+        self.flush_due = None
+        self.fsync_due = None
+
+    def __repr__(self):
+        return 'LogFile(%r)' % self.path
+
+    @property
+    def depth(self):
+        """
+        Batches queued and not yet written
+        """
+        return self.queued_batches - self.written_batches
+
+    @property
+    def backlog(self):
+        """
+        Bytes queued and not yet written
+        """
+        return self.queued_bytes - self.written_bytes
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def write(self, data):
+        self.writeSequence([data])
+
+    def writeSequence(self, sequence):
+        """
+        Queue data for the writer thread, the list must not be modified afterwards
+        """
+        if self.closed:
+            return
+        self.queued_batches += 1
+        self.queued_bytes += sum(map(len, sequence))
+        self.writer.submit((self, sequence, self.writer.clock()))
+        if not self.paused and self.backlog > self.queue_bytes:
+            self.paused = True
+            self.pauses += 1
+            if self.producer is not None:
+                self.producer.pauseProducing()
+
+    def check_resume(self):
+        """
+        Called on the reactor thread after the writer has written data while paused
+        """
+        if self.paused and self.backlog <= self.queue_bytes // 2:
+            self.paused = False
+            if self.producer is not None:
+                self.producer.resumeProducing()
+
+    def close(self):
+        """
+        Stop accepting data, the writer closes the file once everything queued is written
+        """
+        if not self.closed:
+            self.closed = True
+            self.producer = None
+            self.writer.submit((self, None, self.writer.clock()))
+
+    def stats(self):
+        return {
+            'name': self.path,
+            'queue_depth': self.depth,
+            'queued_bytes': self.backlog,
+            'bytes': self.written_bytes,
+            'writes': self.writes,
+            'flushes': self.flushes,
+            'fsyncs': self.fsyncs,
+            'pauses': self.pauses,
+            'errors': self.errors,
+            'write_latency': self.latency,
+            'write_latency_max': self.latency_max,
+            'write_seconds': self.write_seconds,
+        }
+
+
+class LogWriter(object):
+    """
+    Writes LogFile endpoints on a worker thread.
+
+    Each writeSequence on the reactor thread becomes one queue entry. The worker
+    drains everything queued since its last pass and writes each file's share with
+    a single writelines call, so writes are grouped more as the disk falls behind.
+    Latency is measured from the reactor queueing the data to it reaching the file buffer.
+    """
+    def __init__(self, deliver=None, clock=time.time):
+        """
+        :param deliver: callable used to run calls on the reactor thread, reactor.callFromThread by default
+        :param clock: callable returning the current time
+        """
+        self.deliver = deliver if deliver is not None else reactor.callFromThread
+        self.clock = clock
+        self.queue = Queue.Queue()
+        self.thread = None
+        # files written to and not yet flushed or synced, only used by the worker
+        self.dirty = set()
+
+    def submit(self, item):
+        """
+        Queue an item for the worker
+        :param item: (LogFile, list of strings or None to close the file, time queued)
+        """
+        if self.thread is None:
+            self.start()
+        self.queue.put(item)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='LogWriter')
+        self.thread.daemon = True
+        self.thread.start()
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        """
+        Write everything queued and flush all files
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while True:
+            try:
+                items = [self.queue.get(timeout=self.timeout())]
+            except Queue.Empty:
+                items = []
+            try:
+                while True:
+                    items.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+
+            if None in items:
+                self.process(items[:items.index(None)])
+                self.sync(force=True)
+                return
+            self.process(items)
+            self.sync()
+
+    def timeout(self):
+        """
+        :return: seconds until a dirty file must be flushed or synced, None if there are none
+        """
+        deadlines = []
+        for log_file in self.dirty:
+            deadlines.extend(due for due in (log_file.flush_due, log_file.fsync_due) if due is not None)
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - self.clock())
+
+    def process(self, items):
+        """
+        Write queued items, grouping the chunks for each file into one writelines call
+        """
+        batches = {}
+        order = []
+        for log_file, chunks, queued in items:
+            if log_file not in batches:
+                batches[log_file] = []
+                order.append(log_file)
+            batches[log_file].append((chunks, queued))
+
+        for log_file in order:
+            self._write(log_file, batches[log_file])
+
+    def _write(self, log_file, batches):
+        lines = []
+        size = 0
+        oldest = None
+        close = False
+        for chunks, queued in batches:
+            if chunks is None:
+                close = True
+                continue
+            lines.extend(chunks)
+            size += sum(map(len, chunks))
+            if oldest is None:
+                oldest = queued
+
+        if lines:
+            start = self.clock()
+            try:
+                log_file.log_file.writelines(lines)
+            except Exception:
+                log_file.errors += 1
+                log.err(None, 'Failed to write %r' % log_file)
+            now = self.clock()
+            log_file.writes += 1
+            log_file.write_seconds += now - start
+            log_file.latency = now - oldest
+            log_file.latency_max = max(log_file.latency_max, log_file.latency)
+
+            self.dirty.add(log_file)
+            if log_file.flush_due is None:
+                log_file.flush_due = now + log_file.flush_interval
+            if log_file.fsync_due is None and log_file.fsync_interval is not None:
+                log_file.fsync_due = now + log_file.fsync_interval
+
+        log_file.written_batches += len(batches)
+        log_file.written_bytes += size
+        if log_file.paused:
+            self.deliver(log_file.check_resume)
+
+        if close:
+            self._sync(log_file, True, log_file.fsync_due is not None)
+            log_file.log_file.close()
+
+    def sync(self, force=False):
+        """
+        Flush, or flush and sync, the files whose deadlines have passed
+        :param force: flush every dirty file and sync those due a sync
+        """
+        now = self.clock()
+        for log_file in list(self.dirty):
+            fsync = log_file.fsync_due is not None and (force or log_file.fsync_due <= now)
+            flush = fsync or force or (log_file.flush_due is not None and log_file.flush_due <= now)
+            if flush:
+                self._sync(log_file, flush, fsync)
+
+    def _sync(self, log_file, flush, fsync):
+        if flush:
+            log_file.flush_due = None
+        if fsync:
+            log_file.fsync_due = None
+        if log_file.flush_due is None and log_file.fsync_due is None:
+            self.dirty.discard(log_file)
+        if log_file.log_file.closed:
+            return
+        try:
+            log_file.log_file.flush()
+            log_file.flushes += 1
+            if fsync:
+                log_file.log_file.fsync()
+                log_file.fsyncs += 1
+        except Exception:
+            log_file.errors += 1
+            log.err(None, 'Failed to flush %r' % log_file)
@@ -0,0 +1,419 @@
+"""
+Chronological merge of many datalogs.
+
+Each file is decoded by a ChunkDecoder into chunks of whole packed packets, within the time
+window and of the packet types requested. With processes set the decoders run in a pool of
+worker processes, each owning a share of the files and keeping their decoders open, so reading,
+decompressing, framing and filtering is spread over several cores. The merging process requests
+the next chunk of a file as it consumes one, keeping up to prefetch chunks of every file in
+flight, which bounds the memory used whatever the number of files or how much their times
+overlap.
+
+Start the worker processes before the reactor runs, they are forked from the merging process.
+An event driven consumer checks ready before taking each packet, so it never waits on a worker.
+
+The packets of each file are expected in time order, as written by a port agent. The streams
+are merged with a heap on the packet timestamps, ties are kept in file order, then in the
+order of the files as given.
+"""
+import heapq
+import multiprocessing
+from collections import deque
+from Queue import Empty
+
+from twisted.python import log
+
+from common import MERGE_CHUNK_BYTES
+from common import MERGE_PREFETCH
+from datalog import open_datalog
+from datalog import seek_window
+from datalog import series_end_times
+from packet import Packet
+from packet import PacketHeader
+from packet import scan_buffer
+
+
+#################################################################################
+# Merge
+#################################################################################
+
+
+class ChunkDecoder(object):
+    """
+    Read the packets of one datalog within a time window, as chunks of packed packets
+    """
+    def __init__(self, path, start=None, end=None, packet_types=None, named_end=None, chunk_bytes=MERGE_CHUNK_BYTES):
+        """
+        :param path: datalog, plain, compressed or segment
+        :param start: NTP time of the first packets returned, None from the start of the file
+        :param end: NTP time of the last packets returned, None to the end of the file
+        :param packet_types: packet types returned, None for all
+        :param named_end: time the file ended according to the name of the next file of its series
+        :param chunk_bytes: bytes of the file decoded per chunk
+        """
+        self.path = path
+        self.start = start
+        self.end = end
+        self.packet_types = packet_types and frozenset(packet_types)
+        self.chunk_bytes = chunk_bytes
+        # data read following the last whole packet
+        self.buffer = ''
+        # bytes discarded while searching for sync
+        self.bytes_skipped = 0
+        self.file_handle = open_datalog(path, start)
+        self.done = not seek_window(path, self.file_handle, start, end, named_end=named_end)
+
+    def next_chunk(self):
+        """
+        :return: string of whole packed packets, None once the file is exhausted
+        """
+        while not self.done:
+            block = self.file_handle.read(self.chunk_bytes)
+            if not block:
+                break
+            data = self.buffer + block
+            records, offset = scan_buffer(data)
+            self.buffer = data[offset:]
+            self.bytes_skipped += offset - sum(record[2] for record in records)
+            if not records:
+                continue
+            if self.start is None and self.end is None and self.packet_types is None:
+                first = records[0]
+                last = records[-1]
+                return data[first[0]:last[0] + last[2]]
+            chunk = self._filter(data, records)
+            if chunk:
+                return chunk
+
+        self.close()
+        return None
+
+    def _filter(self, data, records):
+        """
+        :return: the packets of the records within the window and of the types requested
+        """
+        start = self.start
+        end = self.end
+        packet_types = self.packet_types
+        kept = []
+        for offset, packet_type, packet_size, _, ts_high, ts_low, _ in records:
+            # packets stamped 0 are always kept
+            if ts_high or ts_low:
+                packet_time = ts_high + ts_low / 4294967296.0
+                if start is not None and packet_time < start:
+                    continue
+                if end is not None and packet_time > end:
+                    self.done = True
+                    break
+            if packet_types is None or packet_type in packet_types:
+                kept.append(data[offset:offset + packet_size])
+        return ''.join(kept)
+
+    def close(self):
+        self.done = True
+        self.file_handle.close()
+
+
+def decode_worker(requests, results, factory=ChunkDecoder):
+    """
+    Worker process loop: serve (job index, factory arguments) requests with (job index, chunk, error)
+    results, in the order requested. None stops the worker.
+    :param factory: callable returning an object with next_chunk and close methods, ChunkDecoder by default
+    """
+    decoders = {}
+    for index, args in iter(requests.get, None):
+        try:
+            if index not in decoders:
+                decoders[index] = factory(*args)
+            decoder = decoders[index]
+            chunk = decoder.next_chunk() if decoder is not None else None
+        except Exception as e:
+            chunk = None
+            results.put((index, None, '%s: %s' % (type(e).__name__, e)))
+        else:
+            results.put((index, chunk, None))
+        if chunk is None:
+            # further requests for an exhausted job are answered with None
+            decoders[index] = None
+
+
+class ChunkPool(object):
+    """
+    Produce the chunks of many jobs, such as the files decoded by ChunkDecoder, in a pool of worker
+    processes. Each worker owns a fixed share of the jobs and keeps their decoders open. Once a job
+    is opened up to prefetch of its chunks are requested ahead of the consumer, a new chunk is
+    requested as each one is consumed.
+    """
+    def __init__(self, jobs, factory=ChunkDecoder, processes=None, prefetch=MERGE_PREFETCH):
+        """
+        :param jobs: list of argument tuples for factory, the first naming the job in errors
+        :param factory: callable returning an object with next_chunk and close methods
+        :param processes: number of worker processes, 0 to decode in this process, None for one per CPU
+        :param prefetch: chunks of each opened job requested ahead of the consumer
+        """
+        self.jobs = jobs
+        self.factory = factory
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = min(processes, len(jobs))
+        self.prefetch = prefetch
+
+        self.workers = []
+        self.requests = []
+        self.results = None
+        self.decoders = {}
+        # chunks received and not yet consumed, per job
+        self.chunks = [deque() for _ in jobs]
+        self.opened = set()
+        self.finished = set()
+        self.errors = 0
+
+    def start(self):
+        if self.processes and not self.workers:
+            self.results = multiprocessing.Queue()
+            for _ in xrange(self.processes):
+                requests = multiprocessing.Queue()
+                worker = multiprocessing.Process(target=decode_worker, args=(requests, self.results, self.factory))
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+                self.requests.append(requests)
+
+    def close(self):
+        """
+        Stop the workers without waiting for them, close may be called from the reactor
+        """
+        for requests in self.requests:
+            requests.put(None)
+            # a sentinel for a worker which is terminated below must not hold up exit
+            requests.cancel_join_thread()
+        if self.results is not None:
+            # workers exit once their buffered results are read
+            self._collect()
+            self.results.cancel_join_thread()
+            for chunks in self.chunks:
+                chunks.clear()
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = []
+        self.requests = []
+        for decoder in self.decoders.itervalues():
+            decoder.close()
+        self.decoders = {}
+
+    def open(self, index):
+        """
+        Start decoding a job ahead of its consumer
+        """
+        if index not in self.opened:
+            self.opened.add(index)
+            if self.workers:
+                for _ in xrange(self.prefetch):
+                    self._request(index)
+
+    def _request(self, index):
+        self.requests[index % self.processes].put((index, self.jobs[index]))
+
+    def _check_workers(self):
+        if not all(worker.is_alive() for worker in self.workers):
+            raise RuntimeError('Datalog decoder worker process died')
+
+    def _receive(self):
+        """
+        Wait for the next chunk produced by a worker
+        """
+        while True:
+            try:
+                return self.results.get(timeout=1)
+            except Empty:
+                self._check_workers()
+
+    def _collect(self):
+        """
+        Store the chunks already produced by the workers, without waiting
+        """
+        while True:
+            try:
+                received, data, error = self.results.get_nowait()
+            except Empty:
+                return
+            if received not in self.finished:
+                self.chunks[received].append((data, error))
+
+    def ready(self, index):
+        """
+        :return: True if next_chunk will return without waiting for a worker
+        """
+        if index in self.finished or not self.workers:
+            return True
+        self.open(index)
+        if not self.chunks[index]:
+            self._collect()
+            if not self.chunks[index]:
+                self._check_workers()
+                return False
+        return True
+
+    def _decode(self, index):
+        """
+        Produce the next chunk of a job in this process
+        """
+        try:
+            if index not in self.decoders:
+                self.decoders[index] = self.factory(*self.jobs[index])
+            return self.decoders[index].next_chunk(), None
+        except Exception as e:
+            return None, '%s: %s' % (type(e).__name__, e)
+
+    def next_chunk(self, index):
+        """
+        :return: next chunk of a job, None once the job is exhausted
+        """
+        if index in self.finished:
+            return None
+        self.open(index)
+
+        if not self.workers:
+            chunk, error = self._decode(index)
+        else:
+            chunks = self.chunks[index]
+            while not chunks:
+                received, data, error = self._receive()
+                if received not in self.finished:
+                    self.chunks[received].append((data, error))
+            chunk, error = chunks.popleft()
+            if chunk is not None:
+                self._request(index)
+
+        if error is not None:
+            self.errors += 1
+            log.msg('Unable to read %s: %s' % (self.jobs[index][0], error))
+        if chunk is None:
+            self.finished.add(index)
+            self.chunks[index].clear()
+            self.decoders.pop(index, None)
+        return chunk
+
+
+class DatalogMerge(object):
+    """
+    Iterate over the packets of many datalogs in timestamp order.
+
+    With dedupe set, packets identical in time, type and payload to one already returned are
+    dropped, such as those of the same port found in overlapping captures. Close the merge to
+    stop its worker processes if it is not iterated to the end.
+
+    Iteration starts the worker processes if start was not called first. A consumer which must
+    not block, such as one running in the reactor, starts the merge before the reactor runs and
+    only takes the next packet while ready returns True.
+    """
+    def __init__(self, files, start=None, end=None, packet_types=None, processes=None, dedupe=False,
+                 chunk_bytes=MERGE_CHUNK_BYTES, prefetch=MERGE_PREFETCH):
+        """
+        :param files: datalog paths
+        :param start: NTP time of the first packets returned, None for no limit
+        :param end: NTP time of the last packets returned, None for no limit
+        :param packet_types: packet types returned, None for all
+        :param processes: number of worker processes, 0 to decode in this process, None for one per CPU
+        :param dedupe: drop exact duplicate packets
+        :param chunk_bytes: bytes of a file decoded per chunk
+        :param prefetch: chunks of each file requested ahead of the merge
+        """
+        self.files = list(files)
+        ends = series_end_times(self.files)
+        jobs = [(path, start, end, packet_types, ends.get(path), chunk_bytes) for path in self.files]
+        self.pool = ChunkPool(jobs, processes=processes, prefetch=prefetch)
+        self.dedupe = dedupe
+        # files whose next chunk is needed before the next packet can be merged
+        self.pending = set(xrange(len(self.files)))
+
+        self.packets = 0
+        self.duplicates = 0
+
+    @property
+    def errors(self):
+        return self.pool.errors
+
+    def start(self):
+        """
+        Start the worker processes and request the first chunks of every file
+        """
+        self.pool.start()
+        for index in xrange(len(self.files)):
+            self.pool.open(index)
+
+    def ready(self):
+        """
+        :return: True if the next packet can be merged without waiting for a worker process
+        """
+        return all(self.pool.ready(index) for index in self.pending)
+
+    def __iter__(self):
+        self.start()
+        try:
+            for packet in self._merge():
+                yield packet
+        finally:
+            self.close()
+
+    def close(self):
+        self.pool.close()
+
+    def _chunk_packets(self, index, data):
+        """
+        :return: deque of (ts_high, ts_low, file index, Packet) for each packet of a chunk
+        """
+        header_size = PacketHeader.header_size
+        trusted = PacketHeader.trusted
+        packets = deque()
+        records, _ = scan_buffer(data)
+        for offset, packet_type, packet_size, checksum, ts_high, ts_low, valid in records:
+            header = trusted(packet_type, packet_size, checksum, ts_high, ts_low)
+            payload = data[offset + header_size:offset + packet_size]
+            packets.append((ts_high, ts_low, index, Packet(payload=payload, header=header, valid=valid)))
+        return packets
+
+    def _merge(self):
+        # the heap holds the next packet of each file, the rest of its chunk waits here
+        chunks = [deque() for _ in self.files]
+        heap = []
+        pending = self.pending
+        dedupe = self.dedupe
+        last_time = None
+        seen = set()
+        while True:
+            if pending:
+                for index in sorted(pending):
+                    chunk = chunks[index]
+                    while not chunk:
+                        data = self.pool.next_chunk(index)
+                        if data is None:
+                            break
+                        chunk = chunks[index] = self._chunk_packets(index, data)
+                    if chunk:
+                        heapq.heappush(heap, chunk.popleft())
+                pending.clear()
+            if not heap:
+                return
+
+            # ties are broken by file index, at most one packet of each file is on the heap
+            ts_high, ts_low, index, packet = heapq.heappop(heap)
+            chunk = chunks[index]
+            if chunk:
+                heapq.heappush(heap, chunk.popleft())
+            else:
+                pending.add(index)
+
+            if dedupe:
+                # duplicates share a timestamp, so are merged next to each other
+                if (ts_high, ts_low) != last_time:
+                    last_time = (ts_high, ts_low)
+                    seen.clear()
+                key = (packet.header.packet_type, packet.payload)
+                if key in seen:
+                    self.duplicates += 1
+                    continue
+                seen.add(key)
+            self.packets += 1
+            yield packet
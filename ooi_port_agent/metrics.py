@@ -0,0 +1,197 @@
+import json
+
+from twisted.web.resource import Resource
+
+from common import PacketType
+
+
+#################################################################################
+# Metrics
+#################################################################################
+
+TYPE_COUNT_FIELDS = ('packets_in', 'bytes_in', 'packets_out', 'bytes_out')
+
+PACKET_TYPE_METRICS = (
+    ('packets_in', 'port_agent_packets_in_total', 'Packets received by the router'),
+    ('bytes_in', 'port_agent_bytes_in_total', 'Bytes received by the router, including headers'),
+    ('packets_out', 'port_agent_packets_out_total', 'Packets routed to endpoints'),
+    ('bytes_out', 'port_agent_bytes_out_total', 'Bytes routed to endpoints, including headers'),
+)
+
+ENDPOINT_TYPE_METRICS = (
+    ('endpoints', 'port_agent_endpoints_registered_total', 'Endpoints registered with the router'),
+    ('chunks', 'port_agent_endpoint_chunks_total', 'Chunks delivered to endpoints'),
+    ('bytes', 'port_agent_endpoint_bytes_total', 'Bytes delivered to endpoints'),
+    ('writes', 'port_agent_endpoint_writes_total', 'Write calls made to endpoints'),
+    ('pauses', 'port_agent_endpoint_pauses_total', 'Times an endpoint transport paused output'),
+    ('dropped_chunks', 'port_agent_endpoint_dropped_chunks_total', 'Chunks dropped by slow consumer policies'),
+    ('dropped_bytes', 'port_agent_endpoint_dropped_bytes_total', 'Bytes dropped by slow consumer policies'),
+    ('disconnects', 'port_agent_endpoint_disconnects_total', 'Endpoints disconnected as slow consumers'),
+)
+
+ENDPOINT_METRICS = (
+    ('bytes', 'counter', 'port_agent_client_bytes_total', 'Bytes delivered to this endpoint'),
+    ('dropped_bytes', 'counter', 'port_agent_client_dropped_bytes_total', 'Bytes dropped for this endpoint'),
+    ('buffered', 'gauge', 'port_agent_client_buffered_bytes', 'Bytes written since the endpoint transport paused'),
+    ('held_bytes', 'gauge', 'port_agent_client_held_bytes', 'Bytes held while the endpoint is paused'),
+    ('high_water', 'gauge', 'port_agent_client_high_water_bytes', 'Most bytes buffered or held at once'),
+)
+
+CONNECTION_METRICS = (
+    ('instrument_connects', 'counter', 'port_agent_instrument_connects_total', 'Instrument connections made'),
+    ('instrument_disconnects', 'counter', 'port_agent_instrument_disconnects_total', 'Instrument connections lost'),
+    ('client_connects', 'counter', 'port_agent_client_connects_total', 'Client connections accepted'),
+    ('client_disconnects', 'counter', 'port_agent_client_disconnects_total', 'Client connections closed'),
+    ('instrument_connections', 'gauge', 'port_agent_instrument_connections', 'Open instrument connections'),
+    ('client_connections', 'gauge', 'port_agent_client_connections', 'Open client connections'),
+)
+
+LOGGER_METRICS = (
+    ('bytes', 'counter', 'port_agent_log_bytes_total', 'Bytes written to this log file'),
+    ('writes', 'counter', 'port_agent_log_writes_total', 'Batched writes made to this log file'),
+    ('fsyncs', 'counter', 'port_agent_log_fsyncs_total', 'Times this log file was synced to disk'),
+    ('errors', 'counter', 'port_agent_log_errors_total', 'Failed writes and flushes of this log file'),
+    ('queue_depth', 'gauge', 'port_agent_log_queue_depth', 'Batches queued for the log writer thread'),
+    ('queued_bytes', 'gauge', 'port_agent_log_queued_bytes', 'Bytes queued for the log writer thread'),
+    ('write_latency', 'gauge', 'port_agent_log_write_latency_seconds',
+     'Seconds the oldest data in the last write waited in the queue'),
+    ('write_latency_max', 'gauge', 'port_agent_log_write_latency_max_seconds', 'Longest write latency seen'),
+)
+
+
+def collect(port_agent):
+    """
+    Gather the cumulative counters of a port agent and its router.
+    Counters are only read here, nothing is accumulated per packet.
+    :param port_agent: PortAgent
+    :return: dict suitable for json.dumps or format_prometheus
+    """
+    router = port_agent.router
+
+    packet_types = {}
+    for packet_type, counts in router.type_counts.iteritems():
+        packet_types[PacketType.get_key(packet_type, str(packet_type))] = dict(zip(TYPE_COUNT_FIELDS, counts))
+
+    endpoint_types = {}
+    for endpoint_type, counts in router.endpoint_counts().iteritems():
+        endpoint_types[endpoint_type] = counts.as_dict()
+
+    return {
+        'name': port_agent.name,
+        'refdes': port_agent.refdes,
+        'connections': {
+            'instrument_connects': port_agent.instrument_connects,
+            'instrument_disconnects': port_agent.instrument_disconnects,
+            'client_connects': port_agent.client_connects,
+            'client_disconnects': port_agent.client_disconnects,
+            'instrument_connections': len(port_agent.connections),
+            'client_connections': len(port_agent.clients),
+        },
+        'router': {
+            'routes_added': router.routes_added,
+            'clients_added': router.clients_added,
+            'clients_removed': router.clients_removed,
+            'writes_saved': router.writes_saved,
+            'ascii_dropped': router.ascii_dropped,
+        },
+        'packet_types': packet_types,
+        'endpoint_types': endpoint_types,
+        'endpoints': router.output_stats(),
+        'loggers': [logger.stats() for logger in port_agent.loggers],
+    }
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _sample(name, labels, value):
+    label_text = ','.join('%s="%s"' % (key, _escape(labels[key])) for key in sorted(labels))
+    if not isinstance(value, float):
+        value = int(value)
+    return '%s{%s} %s' % (name, label_text, value)
+
+
+def _header(name, metric_type, description):
+    return ['# HELP %s %s' % (name, description), '# TYPE %s %s' % (name, metric_type)]
+
+
+def format_prometheus(stats):
+    """
+    Render the output of collect in the Prometheus text exposition format
+    :param stats: output of collect, or a list of them for several agents
+    """
+    if isinstance(stats, dict):
+        stats = [stats]
+    lines = []
+
+    for field, name, description in PACKET_TYPE_METRICS:
+        lines.extend(_header(name, 'counter', description))
+        for each in stats:
+            for packet_type in sorted(each['packet_types']):
+                labels = {'agent': each['name'], 'packet_type': packet_type}
+                lines.append(_sample(name, labels, each['packet_types'][packet_type][field]))
+
+    for field, name, description in ENDPOINT_TYPE_METRICS:
+        lines.extend(_header(name, 'counter', description))
+        for each in stats:
+            for endpoint_type in sorted(each['endpoint_types']):
+                labels = {'agent': each['name'], 'endpoint_type': endpoint_type}
+                lines.append(_sample(name, labels, each['endpoint_types'][endpoint_type][field]))
+
+    for field, metric_type, name, description in ENDPOINT_METRICS:
+        lines.extend(_header(name, metric_type, description))
+        for each in stats:
+            for endpoint in each['endpoints']:
+                labels = {'agent': each['name'], 'endpoint_type': endpoint['endpoint_type'], 'endpoint': endpoint['name']}
+                lines.append(_sample(name, labels, endpoint[field]))
+
+    for field, metric_type, name, description in LOGGER_METRICS:
+        lines.extend(_header(name, metric_type, description))
+        for each in stats:
+            for logger in each['loggers']:
+                lines.append(_sample(name, {'agent': each['name'], 'log': logger['name']}, logger[field]))
+
+    for field, metric_type, name, description in CONNECTION_METRICS:
+        lines.extend(_header(name, metric_type, description))
+        for each in stats:
+            lines.append(_sample(name, {'agent': each['name']}, each['connections'][field]))
+
+    name = 'port_agent_writes_saved_total'
+    lines.extend(_header(name, 'counter', 'Endpoint writes avoided by coalescing'))
+    for each in stats:
+        lines.append(_sample(name, {'agent': each['name']}, each['router']['writes_saved']))
+
+    name = 'port_agent_ascii_dropped_total'
+    lines.extend(_header(name, 'counter', 'Packets dropped from the ASCII logs while the formatter was behind'))
+    for each in stats:
+        lines.append(_sample(name, {'agent': each['name']}, each['router']['ascii_dropped']))
+
+    return '\n'.join(lines) + '\n'
+
+
+def format_json(stats):
+    return json.dumps(stats, sort_keys=True)
+
+
+class MetricsResource(Resource):
+    """
+    Serve port agent metrics over HTTP.
+    Any path ending in .json returns JSON, all others the Prometheus text format.
+    """
+    isLeaf = True
+
+    def __init__(self, collector):
+        """
+        :param collector: callable returning the output of collect, or a list of them
+        """
+        Resource.__init__(self)
+        self.collector = collector
+
+    def render_GET(self, request):
+        stats = self.collector()
+        if request.path.endswith('.json'):
+            request.setHeader('Content-Type', 'application/json')
+            return format_json(stats)
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return format_prometheus(stats)
@@ -0,0 +1,306 @@
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.internet.interfaces import IPushProducer
+from twisted.python import log
+from zope.interface import implements
+
+from common import EndpointType
+from common import OutputPolicy
+from common import OUTPUT_BUDGET
+from common import OUTPUT_GRACE
+
+
+#################################################################################
+# Router Outputs
+#################################################################################
+
+
+class Output(object):
+    """
+    Router state for a single registered endpoint.
+
+    Data routed to the endpoint is appended to a pending list and delivered with a
+    single writeSequence call when the router flushes the output. Endpoints which
+    do not provide writeSequence receive the pending data joined into one write.
+
+    The pending list object is never replaced, the router appends to it directly.
+
+    Endpoints with a transport register their Output as its streaming producer.
+    When the transport buffer fills, the transport pauses the Output and the
+    slow consumer policy decides what happens to further data:
+
+        PAUSE:       keep writing and pause the upstream producers via the router,
+                     disconnect the endpoint if more than budget bytes are written
+                     before it resumes. When there is nothing upstream to pause,
+                     such as the instrument connections of a live agent, the
+                     endpoint is treated as DISCONNECT instead.
+        DROP_OLDEST: hold up to budget bytes, discarding the oldest data
+        DROP_NEWEST: hold up to budget bytes, discarding new data
+        DISCONNECT:  hold up to budget bytes, disconnect the endpoint if it is
+                     still paused after grace seconds or the budget is exceeded
+
+    Held data is written when the transport resumes the Output. The transport only
+    resumes the Output once its buffer has drained, so the bytes written while the
+    Output is paused are those still waiting in the transport.
+    """
+    implements(IPushProducer)
+
+    default_policies = {
+        EndpointType.CLIENT: OutputPolicy.PAUSE,
+        EndpointType.INSTRUMENT: OutputPolicy.PAUSE,
+        EndpointType.INSTRUMENT_DATA: OutputPolicy.PAUSE,
+        EndpointType.DIGI: OutputPolicy.PAUSE,
+        EndpointType.COMMAND: OutputPolicy.DISCONNECT,
+    }
+    default_policy = OutputPolicy.DROP_OLDEST
+
+    def __init__(self, endpoint, endpoint_type, policy=None, budget=OUTPUT_BUDGET, grace=OUTPUT_GRACE,
+                 upstream=None):
+        """
+        :param endpoint: endpoint object, must contain a "write" method
+        :param endpoint_type: value of EndpointType enumeration
+        :param policy: value of OutputPolicy enumeration, None for the endpoint type default
+        :param budget: maximum bytes held while the endpoint is paused
+        :param grace: seconds a DISCONNECT endpoint may remain paused
+        :param upstream: object notified via output_paused/output_resumed under the PAUSE policy,
+                         output_paused returns False if there was nothing to pause
+        """
+        if policy is None:
+            policy = self.default_policies.get(endpoint_type, self.default_policy)
+        if not OutputPolicy.has(policy):
+            raise ValueError('Unknown output policy: %r' % policy)
+
+        self.endpoint = endpoint
+        self.endpoint_type = endpoint_type
+        self.policy = policy
+        self.budget = budget
+        self.grace = grace
+        self.upstream = upstream
+        self.subscription = None
+        self.pending = []
+        self.closed = False
+
+        # data held while paused, under paused_policy, the policy applied since the last pause
+        self.paused = False
+        self.paused_policy = None
+        self.held = deque()
+        self.held_bytes = 0
+        self._disconnect_call = None
+
+        # number of chunks and bytes delivered and the number of calls used to deliver them
+        self.chunks = 0
+        self.bytes = 0
+        self.writes = 0
+        # slow consumer statistics
+        self.pauses = 0
+        self.dropped_chunks = 0
+        self.dropped_bytes = 0
+        # bytes written since the transport paused the Output, it has drained them once it resumes
+        self.buffered = 0
+        self.high_water = 0
+        self.disconnected = False
+
+        write_sequence = getattr(endpoint, 'writeSequence', None)
+        if write_sequence is None:
+            write_sequence = self._join_write
+        self._write_sequence = write_sequence
+
+        self.transport = getattr(endpoint, 'transport', None)
+        self.name = self._describe()
+        if self.transport is not None:
+            self.transport.registerProducer(self, True)
+
+    def __repr__(self):
+        return 'Output(%s, %s)' % (self.endpoint_type, self.name)
+
+    def _describe(self):
+        try:
+            peer = self.transport.getPeer()
+            return '%s:%d' % (peer.host, peer.port)
+        except AttributeError:
+            return getattr(self.endpoint, 'path', repr(self.endpoint))
+
+    @property
+    def writes_saved(self):
+        return self.chunks - self.writes
+
+    def _join_write(self, sequence):
+        self.endpoint.write(''.join(sequence))
+
+    def _deliver(self, sequence):
+        size = sum(map(len, sequence))
+        self.chunks += len(sequence)
+        self.bytes += size
+        self.writes += 1
+        self._write_sequence(sequence)
+        if self.paused:
+            self.buffered += size
+            if self.buffered > self.high_water:
+                self.high_water = self.buffered
+            if self.buffered > self.budget:
+                self.disconnect()
+
+    def _hold(self, sequence):
+        held = self.held
+        for data in sequence:
+            held.append(data)
+            self.held_bytes += len(data)
+
+        if self.paused_policy == OutputPolicy.DROP_OLDEST:
+            while self.held_bytes > self.budget:
+                self._drop(held.popleft())
+        else:
+            while self.held_bytes > self.budget:
+                self._drop(held.pop())
+            if self.paused_policy == OutputPolicy.DISCONNECT and self.dropped_chunks:
+                self.disconnect()
+
+        if self.held_bytes > self.high_water:
+            self.high_water = self.held_bytes
+
+    def _drop(self, data):
+        self.held_bytes -= len(data)
+        self.dropped_chunks += 1
+        self.dropped_bytes += len(data)
+
+    def append(self, data):
+        """
+        Queue data for the next flush
+        """
+        self.pending.append(data)
+
+    def flush(self):
+        """
+        Deliver all pending data to the endpoint
+        """
+        if self.pending:
+            pending = self.pending[:]
+            del self.pending[:]
+            if self.paused and self.paused_policy != OutputPolicy.PAUSE:
+                self._hold(pending)
+            else:
+                self._deliver(pending)
+
+    def write(self, data):
+        """
+        Deliver data immediately, after anything already pending.
+        Data formatted in the background may arrive after the endpoint was deregistered, it is dropped.
+        """
+        if self.closed:
+            return
+        self.append(data)
+        self.flush()
+
+    def discard(self):
+        """
+        Drop all pending and held data
+        """
+        del self.pending[:]
+        self.held.clear()
+        self.held_bytes = 0
+
+    def disconnect(self):
+        """
+        Drop the connection to a slow consumer
+        """
+        self._cancel_disconnect()
+        if not self.disconnected:
+            self.disconnected = True
+            log.msg('Disconnecting slow consumer: %r dropped: %d bytes' % (self, self.dropped_bytes))
+            self.discard()
+            abort = getattr(self.transport, 'abortConnection', None) or self.transport.loseConnection
+            abort()
+
+    def _cancel_disconnect(self):
+        if self._disconnect_call is not None:
+            if self._disconnect_call.active():
+                self._disconnect_call.cancel()
+            self._disconnect_call = None
+
+    def close(self):
+        """
+        The endpoint has been deregistered, release any held data and upstream pause
+        """
+        self.closed = True
+        self._cancel_disconnect()
+        self.discard()
+        if self.paused:
+            self.paused = False
+            if self.paused_policy == OutputPolicy.PAUSE:
+                self.upstream.output_resumed(self)
+
+    def stats(self):
+        return {
+            'name': self.name,
+            'endpoint_type': self.endpoint_type,
+            'policy': self.policy,
+            'paused_policy': self.paused_policy if self.paused else None,
+            'subscription': ' '.join(self.subscription.describe()) if self.subscription is not None else None,
+            'budget': self.budget,
+            'chunks': self.chunks,
+            'bytes': self.bytes,
+            'writes': self.writes,
+            'paused': self.paused,
+            'pauses': self.pauses,
+            'held_bytes': self.held_bytes,
+            'buffered': self.buffered,
+            'high_water': self.high_water,
+            'dropped_chunks': self.dropped_chunks,
+            'dropped_bytes': self.dropped_bytes,
+            'disconnected': self.disconnected,
+        }
+
+    def pauseProducing(self):
+        if self.paused:
+            return
+        self.paused = True
+        self.pauses += 1
+        policy = self.policy
+        if policy == OutputPolicy.PAUSE and (self.upstream is None or not self.upstream.output_paused(self)):
+            # nothing upstream could be paused, bound the endpoint instead
+            policy = OutputPolicy.DISCONNECT
+        self.paused_policy = policy
+        if policy == OutputPolicy.DISCONNECT:
+            self._disconnect_call = reactor.callLater(self.grace, self.disconnect)
+
+    def resumeProducing(self):
+        if not self.paused:
+            return
+        self.paused = False
+        self.buffered = 0
+        self._cancel_disconnect()
+        if self.paused_policy == OutputPolicy.PAUSE:
+            self.upstream.output_resumed(self)
+        elif self.held:
+            held = list(self.held)
+            self.held.clear()
+            self.held_bytes = 0
+            self._deliver(held)
+
+    def stopProducing(self):
+        self.close()
+
+
+class Counts(object):
+    """
+    Cumulative totals for a group of outputs
+    """
+    fields = ('endpoints', 'chunks', 'bytes', 'writes', 'pauses', 'dropped_chunks', 'dropped_bytes', 'disconnects')
+
+    def __init__(self, other=None):
+        for field in self.fields:
+            setattr(self, field, getattr(other, field, 0))
+
+    def add(self, output):
+        self.endpoints += 1
+        self.chunks += output.chunks
+        self.bytes += output.bytes
+        self.writes += output.writes
+        self.pauses += output.pauses
+        self.dropped_chunks += output.dropped_chunks
+        self.dropped_bytes += output.dropped_bytes
+        self.disconnects += int(output.disconnected)
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.fields}
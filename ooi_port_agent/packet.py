@@ -2,7 +2,7 @@
 # Port Agent Packet
 #################################################################################
 import struct
-from datetime import datetime
+import time
 from common import PacketType
 
 # fall back to pure python LRC should we fail to import the C module
@@ -15,6 +15,143 @@ except ImportError:
         return seed
 
 
+# precompiled header layout, see PacketHeader
+header_struct = struct.Struct('>3sBHHII')
+
+
+def py_encode_header(packet_type, payload, ts_high, ts_low):
+    """
+    Pack a packet header, computing the checksum over header and payload
+    :param packet_type: packet type
+    :param payload: payload string
+    :param ts_high: NTP integer seconds
+    :param ts_low: NTP fractional seconds
+    :return: packed header
+    """
+    packet_size = header_struct.size + len(payload)
+    header = header_struct.pack(PacketHeader.sync, packet_type, packet_size, 0, ts_high, ts_low)
+    checksum = lrc(payload, lrc(header))
+    return header_struct.pack(PacketHeader.sync, packet_type, packet_size, checksum, ts_high, ts_low)
+
+
+def py_scan_buffer(data_buffer, offset=0):
+    """
+    Locate every complete packet in a buffer
+    :param data_buffer: string or bytearray
+    :param offset: index at which to start searching
+    :return: (records, offset) where records is a list of
+             (offset, packet_type, packet_size, checksum, ts_high, ts_low, valid)
+             and offset is the index at which the next scan should start
+    """
+    sync = PacketHeader.sync
+    header_size = header_struct.size
+    end = len(data_buffer)
+    view = memoryview(data_buffer)
+    records = []
+
+    while True:
+        sync_index = data_buffer.find(sync, offset)
+        if sync_index == -1:
+            # retain a possible partial sync at the end of the buffer
+            return records, max(offset, end - len(sync) + 1)
+
+        offset = sync_index
+        if end - sync_index < header_size:
+            break
+
+        _, packet_type, packet_size, checksum, ts_high, ts_low = header_struct.unpack_from(data_buffer, sync_index)
+        if packet_size < header_size:
+            # not a real sync, resume the search from the next byte
+            offset += 1
+            continue
+
+        stop = sync_index + packet_size
+        if stop > end:
+            break
+
+        valid = lrc(view[sync_index:stop].tobytes()) == 0
+        records.append((sync_index, packet_type, packet_size, checksum, ts_high, ts_low, valid))
+        offset = stop
+
+    return records, offset
+
+
+def py_xor_prefix(data, seed=0):
+    """
+    Compute the running XOR of a string
+    :param data: input string
+    :param seed: XOR of all bytes preceding data
+    :return: bytearray where element i is the XOR of seed and data[:i + 1]
+    """
+    result = bytearray(data)
+    for i in xrange(len(result)):
+        seed ^= result[i]
+        result[i] = seed
+    return result
+
+
+def py_scan_verified(data_buffer, prefix, offset, max_type):
+    """
+    Locate every complete packet with a plausible header and a valid checksum.
+    Candidates which fail either check are skipped by resuming the search one byte
+    past their sync. prefix[i] must hold the XOR of data_buffer[:i] so that each
+    checksum is verified in constant time.
+    :param data_buffer: string or bytearray
+    :param prefix: running XOR of data_buffer, one element longer than data_buffer
+    :param offset: index at which to start searching
+    :param max_type: largest valid packet type
+    :return: (records, offset, resyncs, bad_checksums), see py_scan_buffer
+    """
+    sync = PacketHeader.sync
+    header_size = header_struct.size
+    end = len(data_buffer)
+    records = []
+    resyncs = 0
+    bad_checksums = 0
+
+    while True:
+        sync_index = data_buffer.find(sync, offset)
+        if sync_index == -1:
+            # retain a possible partial sync at the end of the buffer
+            return records, max(offset, end - len(sync) + 1), resyncs, bad_checksums
+
+        offset = sync_index
+        if end - sync_index < header_size:
+            break
+
+        _, packet_type, packet_size, checksum, ts_high, ts_low = header_struct.unpack_from(data_buffer, sync_index)
+        # a valid checksum never exceeds one byte
+        if packet_size < header_size or packet_type > max_type or checksum > 0xff:
+            resyncs += 1
+            offset += 1
+            continue
+
+        stop = sync_index + packet_size
+        if stop > end:
+            break
+
+        if prefix[sync_index] != prefix[stop]:
+            resyncs += 1
+            bad_checksums += 1
+            offset += 1
+            continue
+
+        records.append((sync_index, packet_type, packet_size, checksum, ts_high, ts_low, True))
+        offset = stop
+
+    return records, offset, resyncs, bad_checksums
+
+
+# fall back to the pure python codec should we fail to import the C module
+try:
+    from ooi_port_agent.codec import encode_header, scan_buffer, scan_verified, xor_prefix
+except ImportError:
+    encode_header = py_encode_header
+    scan_buffer = py_scan_buffer
+    scan_verified = py_scan_verified
+    xor_prefix = py_xor_prefix
+
+
 class InvalidHeaderException(Exception):
     pass
 
@@ -32,9 +169,10 @@ class PacketHeader(object):
     TS_high (4 Bytes, unsigned) NTP time, high 4 bytes are integer seconds
     TS_low (4 Bytes, unsigned) low 4 bytes are fractional seconds
     """
+    __slots__ = ('_packet_type', '_packet_size', '_checksum', '_ts_high', '_ts_low', '_time', '_repr')
     sync = '\xA3\x9D\x7A'
-    header_format = '>3sBHHII'
-    header_size = struct.calcsize(header_format)
+    header_format = header_struct.format
+    header_size = header_struct.size
     checksum_format = '>H'
     checksum_size = struct.calcsize(checksum_format)
     checksum_index = 6
@@ -48,17 +186,31 @@ class PacketHeader(object):
         self._ts_low = ts_low
         self._time = packet_time
         self._repr = None
-        if packet_time is not None and any([ts_high is not None, ts_low is not None]):
+        if packet_time is not None and (ts_high is not None or ts_low is not None):
             raise InvalidHeaderException('Cannot supply ts_high/ts_low and packet_time')
-        if all([packet_time is None, ts_high is None, ts_low is None]):
+        if packet_time is None and ts_high is None and ts_low is None:
             raise InvalidHeaderException('Must supply a packet time!')
 
+    @classmethod
+    def trusted(cls, packet_type, packet_size, checksum, ts_high, ts_low):
+        """
+        Fast constructor for decode paths, the supplied fields are not validated
+        :param packet_size: total packet size (header + payload) as read from the wire
+        """
+        header = cls.__new__(cls)
+        header._packet_type = packet_type
+        header._packet_size = packet_size
+        header._checksum = checksum
+        header._ts_high = ts_high
+        header._ts_low = ts_low
+        header._time = None
+        header._repr = None
+        return header
+
     @staticmethod
     def from_buffer(data_buffer, offset=0):
-        _, packet_type, packet_size, checksum, ts_high, ts_low = struct.unpack_from(PacketHeader.header_format,
-                                                                                    data_buffer, offset)
-        return PacketHeader(packet_type=packet_type, payload_size=packet_size-PacketHeader.header_size,
-                            checksum=checksum, ts_high=ts_high, ts_low=ts_low)
+        _, packet_type, packet_size, checksum, ts_high, ts_low = header_struct.unpack_from(data_buffer, offset)
+        return PacketHeader.trusted(packet_type, packet_size, checksum, ts_high, ts_low)
 
     @property
     def packet_type(self):
@@ -89,58 +241,128 @@ class PacketHeader(object):
         if self._ts_low is None:
             if self._time is None:
                 raise InvalidHeaderException('No time supplied!')
-            self._ts_low = (self._time - int(self._time)) * self.frac_scale
+            self._ts_low = int((self._time - int(self._time)) * self.frac_scale)
         return self._ts_low
 
     @property
     def time(self):
         if self._time is None:
-            if any([self._ts_high is None, self._ts_high is None]):
+            if self._ts_high is None or self._ts_low is None:
                 raise InvalidHeaderException('No time supplied!')
             self._time = self._ts_high + float(self._ts_low) / self.frac_scale
         return self._time
 
     def set_checksum(self, payload):
-        self._checksum = lrc(repr(self), lrc(payload))
-        self._repr = None
+        self._repr = encode_header(self.packet_type, payload, self.ts_high, self.ts_low)
+        self._checksum = ord(self._repr[self.checksum_index + 1])
 
     def __repr__(self):
         if self._repr is None:
-            self._repr = struct.pack(self.header_format, self.sync, self.packet_type,
-                                     self.packet_size, self.checksum, self.ts_high, self.ts_low)
+            self._repr = header_struct.pack(self.sync, self.packet_type,
+                                            self.packet_size, self.checksum, self.ts_high, self.ts_low)
         return self._repr
 
 
+class NtpClock(object):
+    """
+    Source of NTP timestamps for new packets.
+
+    The clock is anchored to the wall clock once and then advanced using timer,
+    which may be a monotonic clock. It is re-anchored every reanchor_interval
+    seconds so that it follows any slew applied to the system clock by NTP.
+    """
+    # seconds between the NTP epoch (1900) and the unix epoch (1970)
+    ntp_delta = 2208988800
+    reanchor_interval = 60
+
+    def __init__(self, timer=None):
+        if timer is None:
+            timer = getattr(time, 'monotonic', time.time)
+        self.timer = timer
+        self._offset = None
+        self._next_anchor = None
+        self.anchor()
+
+    def anchor(self):
+        """
+        Recompute the offset between timer and NTP time from the wall clock
+        """
+        current = self.timer()
+        self._offset = time.time() + self.ntp_delta - current
+        self._next_anchor = current + self.reanchor_interval
+
+    def now(self):
+        """
+        :return: (ts_high, ts_low) the current NTP time as integer and fractional seconds
+        """
+        current = self.timer()
+        if current >= self._next_anchor:
+            self.anchor()
+        ntp_time = current + self._offset
+        ts_high = int(ntp_time)
+        return ts_high, int((ntp_time - ts_high) * PacketHeader.frac_scale)
+
+
+class FakeClock(object):
+    """
+    Deterministic replacement for NtpClock, starting at start (NTP seconds)
+    and advancing step seconds each time it is read
+    """
+    def __init__(self, start=0, step=0):
+        self.time = start
+        self.step = step
+
+    def now(self):
+        ntp_time = self.time
+        self.time += self.step
+        ts_high = int(ntp_time)
+        return ts_high, int((ntp_time - ts_high) * PacketHeader.frac_scale)
+
+
 class Packet(object):
     """
     This class encapsulates the data passing through the port agent
     The packet is composed of a PacketHeader + payload
     """
-    ntp_epoch = datetime(1900, 1, 1)
+    __slots__ = ('payload', 'header', '_valid', '_logstring')
+    clock = NtpClock()
     max_payload = 0xffff - PacketHeader.header_size
 
-    def __init__(self, payload=None, header=None):
+    def __init__(self, payload=None, header=None, valid=None):
         self.payload = payload
         self.header = header
+        self._valid = valid
         self._logstring = None
 
     @staticmethod
-    def create(payload, packet_type):
-        now = (datetime.utcnow() - Packet.ntp_epoch).total_seconds()
+    def create(payload, packet_type, clock=None):
+        """
+        Create the packet(s) required to carry payload
+        :param clock: source of the packet time, Packet.clock if not supplied
+        :return: list of Packet
+        """
+        ts_high, ts_low = (clock or Packet.clock).now()
         packets = []
 
         # if payload > max_payload break into multiple packets
         # a payload of size max_payload shall be followed by an empty packet
-        while len(payload) >= Packet.max_payload:
-            data_slice = payload[:Packet.max_payload]
-            payload = payload[Packet.max_payload:]
-            header = PacketHeader(packet_type=packet_type, payload_size=len(data_slice), packet_time=now)
-            header.set_checksum(data_slice)
-            packets.append(Packet(payload=data_slice, header=header))
-
-        header = PacketHeader(packet_type=packet_type, payload_size=len(payload), packet_time=now)
+        # fragments are sliced from a view so the remainder is never copied
+        max_payload = Packet.max_payload
+        if len(payload) >= max_payload:
+            view = memoryview(payload)
+            start = 0
+            while len(view) - start >= max_payload:
+                data_slice = view[start:start + max_payload].tobytes()
+                start += max_payload
+                header = PacketHeader(packet_type=packet_type, payload_size=len(data_slice),
+                                      ts_high=ts_high, ts_low=ts_low)
+                header.set_checksum(data_slice)
+                packets.append(Packet(payload=data_slice, header=header, valid=True))
+            payload = view[start:].tobytes()
+
+        header = PacketHeader(packet_type=packet_type, payload_size=len(payload), ts_high=ts_high, ts_low=ts_low)
         header.set_checksum(payload)
-        packets.append(Packet(payload=payload, header=header))
+        packets.append(Packet(payload=payload, header=header, valid=True))
 
         return packets
 
@@ -187,7 +409,9 @@ class Packet(object):
 
     @property
     def valid(self):
-        return lrc(self.data) == 0
+        if self._valid is None:
+            self._valid = lrc(self.data) == 0
+        return self._valid
 
     @property
     def data(self):
@@ -208,3 +432,300 @@ class Packet(object):
 
     def __repr__(self):
         return self.data
+
+
+class PacketBatch(object):
+    """
+    Encode a group of payloads of a single packet type into one contiguous buffer.
+
+    All packets in a batch share a timestamp. Payloads of max_payload bytes or more
+    are fragmented exactly as Packet.create does. The wire format of the whole batch
+    is available as a single string (data) for endpoints which receive packed
+    packets, and per packet views of the buffer are available without copying.
+    """
+    __slots__ = ('packet_type', 'ts_high', 'ts_low', 'buffer', 'offsets', 'payloads', '_data')
+
+    def __init__(self, payloads, packet_type, packet_time=None, clock=None):
+        self.packet_type = packet_type
+        if packet_time is None:
+            self.ts_high, self.ts_low = (clock or Packet.clock).now()
+        else:
+            self.ts_high = int(packet_time)
+            self.ts_low = int((packet_time - self.ts_high) * PacketHeader.frac_scale)
+        self._data = None
+
+        max_payload = Packet.max_payload
+        chunks = []
+        for payload in payloads:
+            # a payload of size max_payload shall be followed by an empty packet
+            start = 0
+            while len(payload) - start >= max_payload:
+                chunks.append(payload[start:start + max_payload])
+                start += max_payload
+            chunks.append(payload[start:] if start else payload)
+
+        header_size = PacketHeader.header_size
+        checksum_offset = PacketHeader.checksum_index + 1
+        sync = PacketHeader.sync
+        data_buffer = bytearray(header_size * len(chunks) + sum(len(chunk) for chunk in chunks))
+        offsets = [0]
+        offset = 0
+        for chunk in chunks:
+            header_stop = offset + header_size
+            stop = header_stop + len(chunk)
+            header_struct.pack_into(data_buffer, offset, sync, packet_type, header_size + len(chunk), 0,
+                                    self.ts_high, self.ts_low)
+            data_buffer[header_stop:stop] = chunk
+            # the checksum always fits in the low byte of the checksum field
+            data_buffer[offset + checksum_offset] = lrc(chunk, lrc(data_buffer[offset:header_stop]))
+            offsets.append(stop)
+            offset = stop
+
+        self.buffer = data_buffer
+        self.offsets = offsets
+        self.payloads = chunks
+
+    def __len__(self):
+        return len(self.payloads)
+
+    def __iter__(self):
+        """
+        Generate a Packet for each packet in the batch
+        """
+        header_size = PacketHeader.header_size
+        data_buffer = self.buffer
+        offsets = self.offsets
+        for index, payload in enumerate(self.payloads):
+            checksum = data_buffer[offsets[index] + PacketHeader.checksum_index + 1]
+            header = PacketHeader.trusted(self.packet_type, header_size + len(payload), checksum,
+                                          self.ts_high, self.ts_low)
+            yield Packet(payload=payload, header=header, valid=True)
+
+    @property
+    def size(self):
+        """
+        Total size of all packets in the batch
+        """
+        return len(self.buffer)
+
+    @property
+    def data(self):
+        """
+        All packets in the batch, packed, as a single string
+        """
+        if self._data is None:
+            self._data = str(self.buffer)
+        return self._data
+
+    @property
+    def raw(self):
+        """
+        All payloads in the batch as a single string
+        """
+        return ''.join(self.payloads)
+
+    def wire(self, index):
+        """
+        Return a view of the packed bytes of one packet in the batch
+        """
+        return memoryview(self.buffer)[self.offsets[index]:self.offsets[index + 1]]
+
+    def payload(self, index):
+        """
+        Return a view of the payload bytes of one packet in the batch
+        """
+        return memoryview(self.buffer)[self.offsets[index] + PacketHeader.header_size:self.offsets[index + 1]]
+
+
+class PacketAssembler(object):
+    """
+    Rebuild logical messages from the fragment chains produced by Packet.create.
+
+    A payload of max_payload bytes or more is carried by a chain of max_payload
+    sized packets terminated by a shorter, possibly empty, packet. Chains are
+    tracked per packet type. If a chain is interrupted by a packet with a
+    different timestamp, the partial message is returned as is and counted in
+    broken_chains.
+    """
+    def __init__(self):
+        self.chains = {}
+        self.broken_chains = 0
+
+    @property
+    def pending(self):
+        """
+        Number of payload bytes held in incomplete chains
+        """
+        return sum(len(payload) for _, fragments in self.chains.itervalues() for payload in fragments)
+
+    def feed(self, packets):
+        """
+        :param packets: iterable of Packet, in stream order
+        :return: list of (header, payload), where header is the header of the first packet in the chain
+        """
+        messages = []
+        max_payload = Packet.max_payload
+        chains = self.chains
+        for packet in packets:
+            header = packet.header
+            chain = chains.get(header.packet_type)
+
+            if chain is not None:
+                first, fragments = chain
+                if (first.ts_high, first.ts_low) != (header.ts_high, header.ts_low):
+                    self.broken_chains += 1
+                    messages.append((first, ''.join(fragments)))
+                    chain = None
+
+            if chain is None:
+                if len(packet.payload) < max_payload:
+                    chains.pop(header.packet_type, None)
+                    messages.append((header, packet.payload))
+                    continue
+                chain = chains[header.packet_type] = (header, [])
+
+            chain[1].append(packet.payload)
+            if len(packet.payload) < max_payload:
+                del chains[header.packet_type]
+                messages.append((chain[0], ''.join(chain[1])))
+
+        return messages
+
+
+class PacketDecoder(object):
+    """
+    Incrementally frame packets from a stream of bytes.
+
+    Incoming data is appended to a single growable buffer and packets are sliced
+    out of it in place, starting from a read offset. Consumed bytes are only
+    discarded once the buffer is empty or the consumed region is large relative
+    to what remains, so each received byte is copied a bounded number of times
+    regardless of how many packets are waiting in the buffer.
+
+    With verify set, a candidate packet is only accepted if its header is plausible
+    and its checksum is valid, otherwise the search resumes one byte past its sync.
+    Checksums are verified in constant time against a running XOR of the buffer,
+    so the cost of framing stays linear in the input no matter how many false
+    syncs it contains. Rejected candidates are counted in resyncs, those with a
+    plausible header but a bad checksum also in bad_checksums.
+    """
+    compact_threshold = 0x10000
+    max_packet_type = max(PacketType.values())
+
+    def __init__(self, verify=False):
+        self.buffer = bytearray()
+        self.offset = 0
+        # stream position of buffer[0]
+        self.stream_offset = 0
+        self.bytes_skipped = 0
+        self.verify = verify
+        # running XOR of buffer, prefix[i] is the XOR of buffer[:i]
+        self.prefix = bytearray(1) if verify else None
+        self.resyncs = 0
+        self.bad_checksums = 0
+
+    @property
+    def pending(self):
+        """
+        Number of buffered bytes not yet returned as part of a packet
+        """
+        return len(self.buffer) - self.offset
+
+    def feed(self, data):
+        """
+        Append data to the buffer and return all complete packets
+        :param data: string of received bytes
+        :return: list of Packet
+        """
+        return [packet for _, packet in self.decode(data)]
+
+    def decode(self, data):
+        """
+        Append data to the buffer and return all complete packets along with
+        the stream offset of each packet's sync bytes
+        :param data: string of received bytes
+        :return: list of (offset, Packet)
+        """
+        data_buffer = self.buffer
+        data_buffer.extend(data)
+        start = self.offset
+        if self.verify:
+            self.prefix.extend(xor_prefix(data, self.prefix[-1]))
+            records, offset, resyncs, bad_checksums = scan_verified(data_buffer, self.prefix, start,
+                                                                    self.max_packet_type)
+            self.resyncs += resyncs
+            self.bad_checksums += bad_checksums
+        else:
+            records, offset = scan_buffer(data_buffer, start)
+        header_size = PacketHeader.header_size
+        packets = []
+        framed = 0
+
+        view = memoryview(data_buffer)
+        for sync_index, packet_type, packet_size, checksum, ts_high, ts_low, valid in records:
+            header = PacketHeader.trusted(packet_type, packet_size, checksum, ts_high, ts_low)
+            payload = view[sync_index + header_size:sync_index + packet_size].tobytes()
+            packets.append((self.stream_offset + sync_index, Packet(payload=payload, header=header, valid=valid)))
+            framed += packet_size
+
+        # the buffer cannot be resized while a view is exported
+        del view
+        self.bytes_skipped += offset - start - framed
+        self.offset = offset
+        self._compact()
+        return packets
+
+    def _compact(self):
+        offset = self.offset
+        if offset == len(self.buffer) or (offset >= self.compact_threshold and offset * 2 >= len(self.buffer)):
+            del self.buffer[:offset]
+            if self.prefix is not None:
+                del self.prefix[:offset]
+            self.stream_offset += offset
+            self.offset = 0
+
+
+class PacketReader(object):
+    """
+    Iterate over the packets stored in a file, reading the file in large blocks.
+
+    Packets which straddle a block boundary are carried over by the underlying
+    PacketDecoder. After iteration, offset holds the file position of the last
+    packet returned, bytes_skipped the number of bytes discarded while searching
+    for sync and pending the size of any truncated packet at the end of the file.
+    See PacketDecoder for the verify option.
+    """
+    block_size = 0x100000
+
+    def __init__(self, file_handle, block_size=None, verify=False):
+        self.file_handle = file_handle
+        if block_size is not None:
+            self.block_size = block_size
+        self.decoder = PacketDecoder(verify=verify)
+        self.decoder.stream_offset = file_handle.tell()
+        self.offset = None
+
+    @property
+    def bytes_skipped(self):
+        return self.decoder.bytes_skipped
+
+    @property
+    def pending(self):
+        return self.decoder.pending
+
+    def __iter__(self):
+        for _, packet in self.packets_with_offsets():
+            yield packet
+
+    def packets_with_offsets(self):
+        """
+        Generate (offset, Packet) for each packet remaining in the file
+        """
+        while True:
+            block = self.file_handle.read(self.block_size)
+            if not block:
+                return
+
+            for offset, packet in self.decoder.decode(block):
+                self.offset = offset
+                yield offset, packet
@@ -0,0 +1,174 @@
+from twisted.internet import reactor
+from twisted.internet.interfaces import IPushProducer
+from twisted.python import log
+from zope.interface import implements
+
+from common import REPLAY_BATCH_BYTES
+from common import REPLAY_BATCH_PACKETS
+from common import REPLAY_POLL_INTERVAL
+
+
+#################################################################################
+# Playback
+#################################################################################
+
+
+def parse_speed(value):
+    """
+    Parse a playback speed
+    :param value: None, 'max' or 0 for unthrottled, 'realtime' for 1, or a multiple of real time such as 10 or '10x'
+    :return: multiple of real time, None for unthrottled
+    """
+    if value is None or value in ('max', 'unthrottled'):
+        return None
+    if value == 'realtime':
+        return 1.0
+    if isinstance(value, basestring):
+        value = value.rstrip('xX')
+    try:
+        speed = float(value)
+    except ValueError:
+        raise ValueError('Invalid playback speed: %r' % value)
+    if speed < 0:
+        raise ValueError('Invalid playback speed: %r' % value)
+    return speed or None
+
+
+class Playback(object):
+    """
+    Push recorded packets to a router as fast as its endpoints drain them.
+
+    Packets are routed in batches of up to batch_packets packets or batch_bytes bytes,
+    one batch per reactor iteration. Register the Playback as a producer with the
+    router: while an endpoint using the PAUSE policy is paused, so is the playback.
+
+    With a speed set, packets are paced by their timestamps at that multiple of real
+    time. The pacing is anchored at the first packet and again at each resume, so time
+    spent paused is not made up with a burst. Packets stamped 0 are never delayed.
+
+    With ready set, packets are only taken from the iterator while it can produce them
+    without blocking, otherwise the playback checks again after poll_interval.
+
+    If reading the packets fails the error is logged, the playback is marked failed and
+    ends as if every packet had been routed.
+    """
+    implements(IPushProducer)
+
+    def __init__(self, router, packets, speed=None, batch_packets=REPLAY_BATCH_PACKETS,
+                 batch_bytes=REPLAY_BATCH_BYTES, clock=reactor, done=None, ready=None,
+                 poll_interval=REPLAY_POLL_INTERVAL):
+        """
+        :param router: Router receiving the packets
+        :param packets: iterator of Packet
+        :param speed: multiple of real time, None for unthrottled
+        :param batch_packets: maximum packets routed per batch
+        :param batch_bytes: maximum bytes routed per batch
+        :param clock: IReactorTime used for scheduling
+        :param done: callable invoked once every packet has been routed
+        :param ready: callable returning False while the next packet would block, None if it never does
+        :param poll_interval: seconds before checking ready again
+        """
+        self.router = router
+        self.packets = packets
+        self.speed = speed
+        self.batch_packets = batch_packets
+        self.batch_bytes = batch_bytes
+        self.clock = clock
+        self.done = done
+        self.ready = ready
+        self.poll_interval = poll_interval
+
+        self.paused = False
+        self.stopped = False
+        self.finished = False
+        self.failed = False
+        self._call = None
+        self._next = None
+        # (packet time, clock time) the pacing is measured from
+        self._anchor = None
+
+        self.batches = 0
+        self.packets_sent = 0
+        self.bytes_sent = 0
+
+    def start(self):
+        self._schedule(0)
+
+    def _schedule(self, delay):
+        if self._call is None and not (self.paused or self.stopped or self.finished):
+            self._call = self.clock.callLater(delay, self._send)
+
+    def _cancel(self):
+        if self._call is not None:
+            if self._call.active():
+                self._call.cancel()
+            self._call = None
+
+    def _delay(self, packet):
+        """
+        :return: seconds until packet is due, 0 if unthrottled or already due
+        """
+        packet_time = packet.header.time
+        if self.speed is None or not packet_time:
+            return 0
+        now = self.clock.seconds()
+        if self._anchor is None:
+            self._anchor = (packet_time, now)
+        anchor_time, anchor_clock = self._anchor
+        return max(0, anchor_clock + (packet_time - anchor_time) / self.speed - now)
+
+    def _send(self):
+        self._call = None
+        if self.paused or self.stopped:
+            return
+
+        batch = []
+        size = 0
+        delay = 0
+        try:
+            while len(batch) < self.batch_packets and size < self.batch_bytes:
+                if self._next is None and self.ready is not None and not self.ready():
+                    delay = self.poll_interval
+                    break
+                packet = self._next if self._next is not None else next(self.packets, None)
+                self._next = None
+                if packet is None:
+                    self.finished = True
+                    break
+                delay = self._delay(packet)
+                if delay > 0:
+                    self._next = packet
+                    break
+                batch.append(packet)
+                size += packet.header.packet_size
+        except Exception:
+            log.err(None, 'Playback failed after %d packets' % (self.packets_sent + len(batch)))
+            self.failed = True
+            self.finished = True
+
+        if batch:
+            self.batches += 1
+            self.packets_sent += len(batch)
+            self.bytes_sent += size
+            # may pause this producer before returning
+            self.router.got_data(batch)
+
+        if self.finished:
+            if self.done is not None:
+                self.done()
+        else:
+            self._schedule(delay)
+
+    def pauseProducing(self):
+        self.paused = True
+        self._cancel()
+
+    def resumeProducing(self):
+        if self.paused:
+            self.paused = False
+            self._anchor = None
+            self._schedule(0)
+
+    def stopProducing(self):
+        self.stopped = True
+        self._cancel()
@@ -12,12 +12,12 @@ Usage:
     port_agent.py camhd <port> <commandport> <instaddr> <subport> <reqport> [--sniff=<sniffport>] [--name=<name>] [--refdes=<refdes>] [--ttl=<ttl>]
     port_agent.py antelope <instaddr> <instport> [--sniff=<sniffport>] [--name=<name>] [--refdes=<refdes>] [--ttl=<ttl>]
     port_agent.py antelope <port> <commandport> <instaddr> <instport> [--sniff=<sniffport>] [--name=<name>] [--refdes=<refdes>] [--ttl=<ttl>]
-    port_agent.py datalog <files>...
-    port_agent.py datalog <port> <commandport> <files>...
-    port_agent.py digilog_ascii <files>...
-    port_agent.py digilog_ascii <port> <commandport> <files>...
-    port_agent.py chunky <files>...
-    port_agent.py chunky <port> <commandport> <files>...
+    port_agent.py datalog <files>... [--speed=<speed>] [--start=<time>] [--end=<time>] [--merge [--dedupe] [--processes=<count>]]
+    port_agent.py datalog <port> <commandport> <files>... [--speed=<speed>] [--start=<time>] [--end=<time>] [--merge [--dedupe] [--processes=<count>]]
+    port_agent.py digilog_ascii <files>... [--speed=<speed>] [--start=<time>] [--end=<time>]
+    port_agent.py digilog_ascii <port> <commandport> <files>... [--speed=<speed>] [--start=<time>] [--end=<time>]
+    port_agent.py chunky <files>... [--speed=<speed>] [--start=<time>] [--end=<time>]
+    port_agent.py chunky <port> <commandport> <files>... [--speed=<speed>] [--start=<time>] [--end=<time>]
 
 Options:
     -h, --help          Show this screen.
@@ -25,6 +25,89 @@ Options:
     --name=<name>       Name this port agent (for logfiles, otherwise commandport is used)
     --refdes=<refdes>   Reference designator for this port agent (for consul local service ID, otherwise type is used)
     --ttl=<ttl>         The TTL Check status interval of consul local service
+    --speed=<speed>     Datalog replay speed: realtime, a multiple of real time (10x) or max [default: max]
+    --start=<time>      Replay the datalog from this time, ISO8601 UTC or NTP seconds
+    --end=<time>        Replay the datalog up to this time, ISO8601 UTC or NTP seconds
+    --merge             Replay all the datalogs at once, merged in timestamp order
+    --dedupe            Drop exact duplicate packets from the merged datalogs
+    --processes=<count> Processes decoding the merged datalogs (default: one per CPU)
+
+A config file may describe a single port agent, or many port agents hosted in one process
+by listing them under "agents". All other top level keys are defaults for every listed agent:
+
+    ttl: 30
+    agents:
+      - {type: tcp, name: CTDBP101, port: 4001, commandport: 4002, instaddr: 10.0.0.1, instport: 2101}
+      - {type: botpt, name: BOTPT101, port: 4003, commandport: 4004, instaddr: 10.0.0.2, rxport: 2102, txport: 2103}
+
+Hosted agents share the reactor, heartbeat and statistics timers, ASCII formatter thread,
+log writer thread and Consul client, each agent has its own router. Agent names must be unique.
+
+Config files may also give any agent a shared memory ring for clients on the same host,
+see shm.ShmReader:
+
+    shm: /dev/shm/CTDBP101
+    shm_size: 4194304
+
+Each agent keeps its most recent client packets for replay, up to replay_budget bytes (0 disables).
+Clients of the replay port request a replay before receiving the live stream, see
+protocols.ReplayClientProtocol:
+
+    replay_budget: 4194304
+    replayport: 4005
+
+Datalog and ASCII log files are written on a background thread. Written data is flushed to
+the file within log_flush_interval seconds and, if log_fsync_interval is set, synced to disk
+within that many seconds. Once log_queue_bytes are waiting for the thread the log outputs are
+paused and apply their slow consumer policy:
+
+    log_flush_interval: 1
+    log_fsync_interval: 30
+    log_queue_bytes: 4194304
+
+Datalogs may be written compressed, as <name>.datalog.gz made of independently decompressible
+gzip frames each holding up to datalog_frame_bytes of data or datalog_frame_interval seconds,
+see datalog. The datalog agents and decoder read compressed datalogs transparently:
+
+    datalog_compression: gzip
+    datalog_compression_level: 6
+    datalog_frame_bytes: 1048576
+    datalog_frame_interval: 60
+
+With datalog_segments set the datalog is written as a store of segments, plain or compressed,
+named <name>.datalog[.gz].<UTC time opened>. A segment is ended once it holds
+datalog_segment_bytes or is datalog_segment_seconds old, and each has a time index with an
+entry every datalog_index_interval packets, see datalog. The oldest segments are deleted
+while the store exceeds datalog_retain_bytes or once older than datalog_retain_seconds:
+
+    datalog_segments: true
+    datalog_segment_bytes: 67108864
+    datalog_segment_seconds: 3600
+    datalog_index_interval: 1000
+    datalog_retain_bytes: 10737418240
+    datalog_retain_seconds: 2592000
+
+The datalog, digilog_ascii and chunky agents push packets as fast as their clients drain
+them, or paced by the packet timestamps at a multiple of real time, see playback.Playback:
+
+    speed: realtime
+    replay_batch_packets: 1000
+
+The replay may be limited to a window of packet times, given as ISO8601 UTC or NTP seconds.
+Files outside the window are skipped and plain and indexed datalogs are read from its start
+without decoding the data before it:
+
+    start: 2015-03-01T12:00:00Z
+    end: 2015-03-01T12:10:00Z
+
+The datalog agent replays its files one after the other, or with merge set all at once merged
+in timestamp order, such as the datalogs of several ports or of overlapping captures. The files
+are decoded by merge_processes worker processes, one per CPU by default. With merge_dedupe set
+packets identical to one already replayed, in time, type and payload, are dropped:
+
+    merge: true
+    merge_processes: 4
+    merge_dedupe: true
 
 """
 import logging
@@ -44,6 +127,15 @@ from agents import DigiDatalogAsciiPortAgent
 from agents import ChunkyDatalogPortAgent
 
 
+# defaults for agents listed in a multi agent config
+AGENT_DEFAULTS = {
+    'port': 0,
+    'commandport': 0,
+    'sniffport': 0,
+    'ttl': 30,
+}
+
+
 def configure_logging():
     log_format = '%(asctime)-15s %(levelname)s %(message)s'
     logging.basicConfig(format=log_format)
@@ -102,14 +194,46 @@ def config_from_options(options):
     else:
         config['ttl'] = 30
 
+    config['speed'] = options['--speed']
+    config['start'] = options['--start']
+    config['end'] = options['--end']
+    config['merge'] = options['--merge']
+    config['merge_dedupe'] = options['--dedupe']
+    processes = options['--processes']
+    if processes is not None:
+        config['merge_processes'] = int(processes)
+
     return config
 
 
-def main():
-    configure_logging()
-    options = docopt(__doc__)
-    config = config_from_options(options)
+def agent_configs(config):
+    """
+    Expand a configuration into a list of per agent configurations
+    """
+    if 'agents' not in config:
+        return [config]
+
+    defaults = {key: value for key, value in config.iteritems() if key != 'agents'}
+    configs = []
+    for each in config['agents']:
+        agent_config = dict(AGENT_DEFAULTS)
+        agent_config.update(defaults)
+        agent_config.update(each)
+        # consul service IDs are derived from refdes and must not collide
+        if 'name' in agent_config:
+            agent_config.setdefault('refdes', agent_config['name'])
+        configs.append(agent_config)
+
+    names = [each.get('name') for each in configs]
+    if None in names or len(set(names)) != len(names):
+        raise ValueError('Each hosted port agent requires a unique name')
+    return configs
 
+
+def agent_types():
+    """
+    Map each AgentTypes value to its port agent class, None if the required libraries are unavailable
+    """
     try:
         from camhd_agent import CamhdPortAgent
     except ImportError:
@@ -123,7 +247,7 @@ def main():
         AntelopePortAgent = None
         log.err('Unable to import Antelope libraries, Antelope port agent unavailable')
 
-    agent_type_map = {
+    return {
         AgentTypes.TCP: TcpPortAgent,
         AgentTypes.RSN: RsnPortAgent,
         AgentTypes.BOTPT: BotptPortAgent,
@@ -134,11 +258,32 @@ def main():
         AgentTypes.ANTELOPE: AntelopePortAgent
     }
 
-    agent_type = config['type']
-    agent = agent_type_map.get(agent_type)
 
-    if agent is not None:
-        agent(config)
+def main():
+    configure_logging()
+    options = docopt(__doc__)
+    config = config_from_options(options)
+    agent_type_map = agent_types()
+
+    try:
+        configs = agent_configs(config)
+    except ValueError as e:
+        log.err(str(e))
+        exit(1)
+
+    started = 0
+    for agent_config in configs:
+        agent = agent_type_map.get(agent_config['type'])
+        if agent is None:
+            log.err('Unable to start port agent %s, unknown type: %r' % (agent_config.get('name'), agent_config['type']))
+            continue
+        try:
+            agent(agent_config).start()
+            started += 1
+        except Exception:
+            log.err(None, 'Unable to start port agent %s' % agent_config.get('name'))
+
+    if started:
         exit(reactor.run())
     else:
         exit(1)
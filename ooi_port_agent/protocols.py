@@ -1,7 +1,6 @@
 #################################################################################
 # Protocols
 #################################################################################
-from collections import deque
 import platform
 import socket
 from twisted.internet.protocol import Protocol
@@ -11,6 +10,7 @@ from twisted.python import log
 from common import PacketType
 from common import BINARY_TIMESTAMP
 from packet import Packet
+from packet import PacketDecoder
 
 KEEPALIVE_IDLE = 100
 KEEPALIVE_INTVL = 5
@@ -34,6 +34,9 @@ class PortAgentProtocol(Protocol):
     def write(self, data):
         self.transport.write(data)
 
+    def writeSequence(self, data):
+        self.transport.writeSequence(data)
+
     def connectionMade(self):
         """
         Register this protocol with the router
@@ -43,8 +46,8 @@ class PortAgentProtocol(Protocol):
         # this is about one packet for the broadband hydrophones.
         # We need a deeper buffer to provide decent throughput.
         # The buffer is still actually unbounded, this just defines
-        # the threshold for a call to pauseProducing if it is supported
-        # by the producer
+        # the threshold for a call to pauseProducing on the router Output
+        # for this endpoint, which then applies its slow consumer policy
         self.transport.bufferSize *= 10
 
     def connectionLost(self, reason=connectionDone):
@@ -70,6 +73,60 @@ class PortAgentClientProtocol(PortAgentProtocol):
         self.port_agent.client_disconnected(self)
 
 
+class ReplayClientProtocol(PortAgentClientProtocol):
+    """
+    Data port client which starts by requesting recent packets from the replay ring.
+    The first line received is the request, see ReplayRing.select, e.g.:
+
+        resume seq=1234
+
+    The client receives a PA_STATUS packet "REPLAY <first> <next>", the packets numbered
+    first up to next, then the live stream starting with packet next. Anything after the
+    request line is routed as data from the driver.
+    """
+    MAX_REQUEST = 1024
+
+    def connectionMade(self):
+        self.request = ''
+        self.registered = False
+
+    def dataReceived(self, data):
+        if self.registered:
+            return PortAgentClientProtocol.dataReceived(self, data)
+
+        self.request += data
+        line, newline, rest = self.request.partition('\n')
+        if not newline:
+            if len(self.request) > self.MAX_REQUEST:
+                self._reject('Replay request too long')
+            return
+
+        router = self.port_agent.router
+        replay = self.port_agent.replay
+        # packets still pending in the router have not reached the replay ring yet
+        router.flush()
+        try:
+            first, backlog = replay.select(line.split())
+        except ValueError as e:
+            self._reject(str(e))
+            return
+
+        status = Packet.create('REPLAY %d %d' % (first, replay.sequence), PacketType.PA_STATUS)
+        self.transport.writeSequence([packet.data for packet in status] + backlog)
+        self.registered = True
+        PortAgentClientProtocol.connectionMade(self)
+        if rest:
+            PortAgentClientProtocol.dataReceived(self, rest)
+
+    def _reject(self, message):
+        self.transport.writeSequence([packet.data for packet in Packet.create(message, PacketType.PA_FAULT)])
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason=connectionDone):
+        if self.registered:
+            PortAgentClientProtocol.connectionLost(self, reason)
+
+
 class InstrumentProtocol(PortAgentProtocol):
     """
     Overrides PortAgentProtocol for instrument state tracking
@@ -105,19 +162,17 @@ class DigiInstrumentProtocol(InstrumentProtocol):
     """
     def __init__(self, port_agent, packet_type, endpoint_type):
         InstrumentProtocol.__init__(self, port_agent, packet_type, endpoint_type)
-        self.buffer = deque(maxlen=65535)
+        self.decoder = PacketDecoder(verify=True)
 
     def dataReceived(self, data):
-        self.buffer.extend(data)
-        data = ''.join(self.buffer)
-        while True:
-            packet, data = Packet.packet_from_buffer(data)
-            if packet is not None:
-                self.port_agent.router.got_data([packet])
-                self.buffer.clear()
-                self.buffer.extend(data)
-            else:
-                break
+        packets = self.decoder.feed(data)
+        if packets:
+            self.port_agent.router.got_data(packets)
+
+    def connectionLost(self, reason=connectionDone):
+        log.msg('DIGI framing: skipped %d bytes, %d resyncs, %d bad checksums' % (
+            self.decoder.bytes_skipped, self.decoder.resyncs, self.decoder.bad_checksums))
+        InstrumentProtocol.connectionLost(self, reason)
 
 
 class DigiCommandProtocol(InstrumentProtocol):
@@ -180,3 +235,6 @@ class CommandProtocol(LineOnlyReceiver):
 
     def write(self, data):
         self.transport.write(data)
+
+    def writeSequence(self, data):
+        self.transport.writeSequence(data)
@@ -0,0 +1,132 @@
+from collections import deque
+from itertools import islice
+
+from common import REPLAY_BUDGET
+from packet import header_struct
+from subscription import parse_time
+
+
+#################################################################################
+# Replay
+#################################################################################
+
+
+class ReplayRing(object):
+    """
+    Router endpoint keeping the most recent packets sent to clients, so a client
+    which reconnects can receive what it missed before the live stream.
+
+    Register it as an EndpointType.CLIENT. Every packet it receives is numbered
+    with the next sequence number, the oldest packets are discarded once the
+    packed packets held exceed budget bytes. A client receiving every packet
+    routed to clients sees consecutive sequence numbers.
+    """
+    path = 'replay'
+
+    def __init__(self, budget=REPLAY_BUDGET):
+        """
+        :param budget: maximum bytes of packed packets held
+        """
+        self.budget = budget
+        # (sequence, NTP time, packed packet)
+        self.entries = deque()
+        self.bytes = 0
+        # sequence number of the next packet
+        self.sequence = 0
+
+    def __repr__(self):
+        return 'ReplayRing(%d packets, %d bytes)' % (len(self.entries), self.bytes)
+
+    @property
+    def first(self):
+        """
+        Sequence number of the oldest packet held
+        """
+        return self.entries[0][0] if self.entries else self.sequence
+
+    def write(self, data):
+        self.writeSequence((data,))
+
+    def writeSequence(self, sequence):
+        """
+        Number and store packed packets. Chunks holding a batch of packets are split.
+        """
+        entries = self.entries
+        number = self.sequence
+        for chunk in sequence:
+            offset = 0
+            end = len(chunk)
+            while offset < end:
+                _, _, packet_size, _, ts_high, ts_low = header_struct.unpack_from(chunk, offset)
+                data = chunk if packet_size == end else chunk[offset:offset + packet_size]
+                entries.append((number, ts_high + ts_low / 4294967296.0, data))
+                number += 1
+                self.bytes += packet_size
+                offset += packet_size
+        self.sequence = number
+
+        while self.bytes > self.budget:
+            self.bytes -= len(entries.popleft()[2])
+
+    def since_sequence(self, sequence):
+        """
+        :return: list of the packed packets numbered sequence or later
+        """
+        index = max(0, sequence - self.first)
+        return [entry[2] for entry in islice(self.entries, index, None)]
+
+    def sequence_at(self, packet_time):
+        """
+        :return: sequence number of the first packet stamped at or after packet_time,
+                 packets arrive in nearly time order so the search runs from the newest
+        """
+        number = self.sequence
+        for entry in reversed(self.entries):
+            if entry[1] < packet_time:
+                break
+            number = entry[0]
+        return number
+
+    def tail(self, count):
+        """
+        :return: list of the count most recent packed packets
+        """
+        start = max(0, len(self.entries) - count)
+        return [entry[2] for entry in islice(self.entries, start, None)]
+
+    def select(self, request):
+        """
+        Resolve a client replay request
+            resume seq=<sequence>
+            resume time=<NTP seconds or ISO8601>
+            tail <count>
+            live
+        :param request: list of words
+        :return: (sequence number of the first packet returned, list of packed packets)
+        """
+        if request == ['live']:
+            return self.sequence, []
+
+        if len(request) == 2 and request[0] == 'tail':
+            try:
+                count = int(request[1])
+            except ValueError:
+                raise ValueError('Invalid tail count: %r' % request[1])
+            packets = self.tail(count)
+            return self.sequence - len(packets), packets
+
+        if len(request) == 2 and request[0] == 'resume':
+            key, _, value = request[1].partition('=')
+            try:
+                if key == 'seq':
+                    number = int(value)
+                elif key == 'time':
+                    number = self.sequence_at(parse_time(value))
+                else:
+                    raise ValueError
+            except ValueError:
+                raise ValueError('Invalid resume point: %r' % request[1])
+            number = min(max(number, self.first), self.sequence)
+            return number, self.since_sequence(number)
+
+        raise ValueError('Unknown replay request: %r' % ' '.join(request))
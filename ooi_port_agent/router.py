@@ -1,5 +1,3 @@
-from collections import Counter
-
 from twisted.internet import reactor
 from twisted.internet.interfaces import IPushProducer
 from twisted.python import log
@@ -8,9 +6,15 @@ from zope.interface import implements
 from common import PacketType
 from common import EndpointType
 from common import Format
-from common import RouterStat
+from common import OUTPUT_BUDGET
+from common import OUTPUT_GRACE
+from common import ROUTER_FLUSH_BYTES
+from common import ROUTER_FLUSH_DELAY
 from common import ROUTER_STATS_INTERVAL
-from common import NEWLINE
+from formatter import AsciiFormatter
+from host import Scheduler
+from output import Counts
+from output import Output
 
 
 #################################################################################
@@ -24,7 +28,9 @@ class Router(object):
     """
     implements(IPushProducer)
 
-    def __init__(self):
+    def __init__(self, flush_bytes=ROUTER_FLUSH_BYTES, flush_delay=ROUTER_FLUSH_DELAY,
+                 policies=None, budget=OUTPUT_BUDGET, grace=OUTPUT_GRACE,
+                 name=None, scheduler=None, formatter=None):
         """
         Initial route and client sets are empty. New routes are registered with add_route.
         New clients are registered/deregistered with register/deregister
@@ -39,23 +45,102 @@ class Router(object):
         The data_format argument to add_route will determine the format of the message passed to the endpoint.
         A value of PACKET indicates the entire packet should be sent (packed), RAW indicates just the raw data
         will be passed and ASCII indicates the packet should be formatted in a method suitable for logging.
+        ASCII formatting is performed on a worker thread by the AsciiFormatter.
+
+        Whenever routes or clients change, the routing table is compiled into a flat dispatch list
+        per packet type, so got_data does no set traversal and formats each packet at most once
+        per data format, and only if an endpoint needs that format.
+
+        An endpoint may be given a Subscription with subscribe. Its packet types are applied when
+        the routing table is compiled, any per packet filters are evaluated in got_data before the
+        packet is serialized for that endpoint.
+
+        Output for each endpoint is coalesced and delivered with one writeSequence. By default
+        an endpoint is flushed at the end of every got_data call. If flush_delay is set, output
+        is held for up to flush_delay seconds, spanning multiple got_data calls. Once flush_bytes
+        or more have been routed since the last flush, all pending output is flushed immediately.
+
+        :param flush_bytes: flush once this many bytes have been routed
+        :param flush_delay: maximum time in seconds to hold output, None to flush per got_data call
+
+        Each endpoint transport pauses its Output when the transport buffer fills. What happens next
+        is decided by the OutputPolicy for the endpoint type, see Output. Endpoints using the PAUSE
+        policy pause all producers registered with the router until every such endpoint resumes.
+
+        :param policies: dict of endpoint type to OutputPolicy, overriding the Output defaults
+        :param budget: bytes held for each paused endpoint
+        :param grace: seconds before a paused endpoint with the DISCONNECT policy is disconnected
+
+        Routers hosted in the same process may share a Scheduler for their statistics timer and
+        an AsciiFormatter thread, by default each router creates its own.
+
+        :param name: name used in log messages
+        :param scheduler: Scheduler used to log statistics every ROUTER_STATS_INTERVAL
+        :param formatter: AsciiFormatter used for ASCII endpoints
         """
         self.routes = {}
         self.clients = {}
+        self.outputs = {}
+        self.flush_bytes = flush_bytes
+        self.flush_delay = flush_delay
+        self._dirty = []
+        self._pending_bytes = 0
+        self._flush_call = None
+        self.policies = policies or {}
+        self.budget = budget
+        self.grace = grace
+        self.paused_outputs = set()
         self.producers = set()
-        self.statistics = Counter()
+        self.name = name
+        self.scheduler = scheduler if scheduler is not None else Scheduler()
+        self.formatter = formatter if formatter is not None else AsciiFormatter()
+        self._owns_formatter = formatter is None
         for packet_type in PacketType.values():
             self.routes[packet_type] = set()
         for endpoint_type in EndpointType.values():
             self.clients[endpoint_type] = set()
 
-        self.log_stats()
+        # compiled routing table, see _compile
+        self.dispatch = {}
+        self.ascii_dispatch = {}
+        self.filtered_dispatch = {}
+
+        # cumulative statistics
+        # type_counts maps packet type to [packets_in, bytes_in, packets_out, bytes_out]
+        # retired holds the totals of deregistered outputs per endpoint type
+        self.routes_added = 0
+        self.clients_added = 0
+        self.clients_removed = 0
+        # packets dropped because the ASCII formatter queue was full
+        self.ascii_dropped = 0
+        self.type_counts = {}
+        self.retired = {}
+        for packet_type in PacketType.values():
+            self.type_counts[packet_type] = [0, 0, 0, 0]
+        for endpoint_type in EndpointType.values():
+            self.retired[endpoint_type] = Counts()
+        self._last_stats = self._stats()
+
+    def start(self):
+        """
+        Start logging statistics every ROUTER_STATS_INTERVAL
+        """
+        self.scheduler.add(ROUTER_STATS_INTERVAL, self.log_stats)
+
+    def stop(self):
+        """
+        Deliver any pending output and stop the statistics timer
+        """
+        self.flush()
+        self.scheduler.remove(ROUTER_STATS_INTERVAL, self.log_stats)
+        if self._owns_formatter:
+            self.formatter.stop()
 
     def add_route(self, packet_type, endpoint_type, data_format=Format.RAW):
         """
         Route packets of packet_type to all endpoints of endpoint_type using data_format
         """
-        self.statistics[RouterStat.ADD_ROUTE] += 1
+        self.routes_added += 1
         if packet_type == PacketType.ALL:
             for packet_type in PacketType.values():
                 log.msg('ADD ROUTE: %s -> %s data_format: %s' % (packet_type, endpoint_type, data_format))
@@ -63,32 +148,268 @@ class Router(object):
         else:
             log.msg('ADD ROUTE: %s -> %s data_format: %s' % (packet_type, endpoint_type, data_format))
             self.routes[packet_type].add((endpoint_type, data_format))
+        self._compile()
+
+    def _compile(self):
+        """
+        Build the per packet type dispatch lists used by got_data.
+        dispatch maps packet type to a tuple of (pending, output, data_format) for RAW and PACKET endpoints,
+        ascii_dispatch maps packet type to a tuple of the outputs receiving ASCII,
+        filtered_dispatch maps packet type to a tuple of (output, data_format, matches) for endpoints
+        whose subscription must be evaluated per packet.
+        """
+        dispatch = {}
+        ascii_dispatch = {}
+        filtered_dispatch = {}
+        for packet_type, routes in self.routes.iteritems():
+            targets = []
+            ascii_clients = []
+            filtered = []
+            for endpoint_type, data_format in routes:
+                for client in self.clients[endpoint_type]:
+                    output = self.outputs[client]
+                    subscription = output.subscription
+                    if subscription is not None:
+                        if not subscription.accepts_type(packet_type):
+                            continue
+                        if subscription.per_packet:
+                            filtered.append((output, data_format, subscription.matches))
+                            continue
+                    if data_format == Format.ASCII:
+                        ascii_clients.append(output)
+                    else:
+                        targets.append((output.pending, output, data_format))
+            if targets:
+                dispatch[packet_type] = tuple(targets)
+            if ascii_clients:
+                ascii_dispatch[packet_type] = tuple(ascii_clients)
+            if filtered:
+                filtered_dispatch[packet_type] = tuple(filtered)
+
+        self.dispatch = dispatch
+        self.ascii_dispatch = ascii_dispatch
+        self.filtered_dispatch = filtered_dispatch
 
     def got_data(self, packets):
         """
         Asynchronous callback from an endpoint. Packet will be routed as specified in the routing table.
         """
+        dispatch = self.dispatch
+        ascii_dispatch = self.ascii_dispatch
+        filtered_dispatch = self.filtered_dispatch
+        type_counts = self.type_counts
+        dirty = self._dirty
+        ascii_items = []
+
         for packet in packets:
-            self.statistics[RouterStat.PACKET_IN] += 1
-            self.statistics[RouterStat.BYTES_IN] += packet.header.packet_size
-
-            # delay formatting as string until needed
-            # to avoid doing this work on antelope unless
-            # an ascii logger is connected
-            format_map = {
-                Format.RAW: packet.payload,
-                Format.PACKET: repr(packet),
-                Format.ASCII: None,
-            }
-
-            for endpoint_type, data_format in self.routes.get(packet.header.packet_type, []):
-                for client in self.clients[endpoint_type]:
-                    # create the ASCII format now if we actually need it
-                    if data_format == Format.ASCII and format_map[Format.ASCII] is None:
-                        format_map[Format.ASCII] = str(packet) + NEWLINE
-                    self.statistics[RouterStat.PACKET_OUT] += 1
-                    self.statistics[RouterStat.BYTES_OUT] += packet.header.packet_size
-                    client.write(format_map[data_format])
+            header = packet.header
+            packet_type = header.packet_type
+            packet_size = header.packet_size
+            counts = type_counts.get(packet_type)
+            if counts is None:
+                counts = type_counts[packet_type] = [0, 0, 0, 0]
+            counts[0] += 1
+            counts[1] += packet_size
+
+            targets = dispatch.get(packet_type)
+            if targets is not None:
+                packed = None
+                for pending, output, data_format in targets:
+                    if data_format == Format.PACKET:
+                        if packed is None:
+                            packed = packet.data
+                        data = packed
+                    else:
+                        data = packet.payload
+                    if not pending:
+                        dirty.append(output)
+                    pending.append(data)
+                counts[2] += len(targets)
+                counts[3] += packet_size * len(targets)
+
+                # no single endpoint holds more than the bytes routed since the last flush
+                self._pending_bytes += packet_size
+                if self._pending_bytes >= self.flush_bytes:
+                    self.flush()
+                    dirty = self._dirty
+
+            # ASCII output is formatted off the reactor thread
+            ascii_clients = ascii_dispatch.get(packet_type)
+            if ascii_clients is not None:
+                counts[2] += len(ascii_clients)
+                counts[3] += packet_size * len(ascii_clients)
+
+            filtered = filtered_dispatch.get(packet_type)
+            if filtered is not None:
+                matched = self._route_filtered(packet, filtered, counts)
+                if matched:
+                    ascii_clients = ascii_clients + matched if ascii_clients else matched
+
+            if ascii_clients:
+                ascii_items.append((packet, ascii_clients))
+
+        if ascii_items:
+            self._submit_ascii(ascii_items)
+
+        self._schedule_flush()
+
+    def _submit_ascii(self, items):
+        """
+        Hand packets to the ASCII formatter, counting those dropped when it has fallen behind
+        """
+        if not self.formatter.submit(items):
+            self.ascii_dropped += len(items)
+
+    def got_batch(self, batch):
+        """
+        Route a PacketBatch. PACKET and RAW endpoints receive the entire batch in a single write.
+        """
+        if not len(batch):
+            return
+
+        counts = self.type_counts.setdefault(batch.packet_type, [0, 0, 0, 0])
+        counts[0] += len(batch)
+        counts[1] += batch.size
+
+        targets = self.dispatch.get(batch.packet_type)
+        if targets is not None:
+            packed = raw = None
+            for pending, output, data_format in targets:
+                if data_format == Format.PACKET:
+                    if packed is None:
+                        packed = batch.data
+                    data = packed
+                else:
+                    if raw is None:
+                        raw = batch.raw
+                    data = raw
+                if not pending:
+                    self._dirty.append(output)
+                pending.append(data)
+            self._pending_bytes += batch.size
+            counts[2] += len(batch) * len(targets)
+            counts[3] += batch.size * len(targets)
+
+        ascii_clients = self.ascii_dispatch.get(batch.packet_type)
+        if ascii_clients is not None:
+            counts[2] += len(batch) * len(ascii_clients)
+            counts[3] += batch.size * len(ascii_clients)
+
+        filtered = self.filtered_dispatch.get(batch.packet_type)
+        if filtered is not None:
+            ascii_items = []
+            for packet in batch:
+                clients = ascii_clients
+                matched = self._route_filtered(packet, filtered, counts)
+                if matched:
+                    clients = clients + matched if clients else matched
+                if clients:
+                    ascii_items.append((packet, clients))
+            if ascii_items:
+                self._submit_ascii(ascii_items)
+        elif ascii_clients is not None:
+            self._submit_ascii([(packet, ascii_clients) for packet in batch])
+
+        self._schedule_flush()
+
+    def _route_filtered(self, packet, filtered, counts):
+        """
+        Route a packet to the subscribed endpoints whose filters match it
+        :return: tuple of the matching outputs receiving ASCII
+        """
+        matched = []
+        packet_size = packet.header.packet_size
+        packed = None
+        for output, data_format, matches in filtered:
+            if not matches(packet):
+                continue
+            counts[2] += 1
+            counts[3] += packet_size
+            if data_format == Format.ASCII:
+                matched.append(output)
+                continue
+            if data_format == Format.PACKET:
+                if packed is None:
+                    packed = packet.data
+                data = packed
+            else:
+                data = packet.payload
+            if not output.pending:
+                self._dirty.append(output)
+            output.pending.append(data)
+            self._pending_bytes += packet_size
+        return tuple(matched)
+
+    def find_output(self, name):
+        """
+        Find the output of a registered endpoint by name (host:port for network endpoints)
+        """
+        for output in self.outputs.itervalues():
+            if output.name == name:
+                return output
+        return None
+
+    def subscribe(self, output, subscription):
+        """
+        Install a Subscription for an endpoint, None removes any existing subscription
+        """
+        log.msg('SUBSCRIBE: %r %r' % (output, subscription))
+        output.subscription = subscription
+        self._compile()
+
+    def _schedule_flush(self):
+        if self.flush_delay is None or self._pending_bytes >= self.flush_bytes:
+            self.flush()
+        elif self._flush_call is None and self._dirty:
+            self._flush_call = reactor.callLater(self.flush_delay, self.flush)
+
+    def flush(self):
+        """
+        Deliver all pending output
+        """
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        dirty = self._dirty
+        self._dirty = []
+        self._pending_bytes = 0
+        for output in dirty:
+            output.flush()
+
+    @property
+    def packets_in(self):
+        return sum(counts[0] for counts in self.type_counts.itervalues())
+
+    @property
+    def bytes_in(self):
+        return sum(counts[1] for counts in self.type_counts.itervalues())
+
+    @property
+    def packets_out(self):
+        return sum(counts[2] for counts in self.type_counts.itervalues())
+
+    @property
+    def bytes_out(self):
+        return sum(counts[3] for counts in self.type_counts.itervalues())
+
+    def endpoint_counts(self):
+        """
+        Cumulative output totals per endpoint type, including deregistered endpoints
+        """
+        totals = {}
+        for endpoint_type, retired in self.retired.iteritems():
+            totals[endpoint_type] = Counts(retired)
+        for output in self.outputs.itervalues():
+            totals.setdefault(output.endpoint_type, Counts()).add(output)
+        return totals
+
+    @property
+    def writes_saved(self):
+        """
+        Number of endpoint writes avoided by coalescing
+        """
+        return sum(counts.chunks - counts.writes for counts in self.endpoint_counts().itervalues())
 
     def register(self, endpoint_type, source):
         """
@@ -96,14 +417,12 @@ class Router(object):
         :param endpoint_type value of EndpointType enumeration
         :param source endpoint object, must contain a "write" method
         """
-        self.statistics[RouterStat.ADD_CLIENT] += 1
+        self.clients_added += 1
         log.msg('REGISTER: %s %s' % (endpoint_type, source))
         self.clients[endpoint_type].add(source)
-
-        # attempt to support pausing for client endpoints
-        # only valid for playback agents!
-        if endpoint_type == EndpointType.CLIENT:
-            source.transport.registerProducer(self, True)
+        self.outputs[source] = Output(source, endpoint_type, policy=self.policies.get(endpoint_type),
+                                      budget=self.budget, grace=self.grace, upstream=self)
+        self._compile()
 
     def deregister(self, endpoint_type, source):
         """
@@ -111,34 +430,75 @@ class Router(object):
         :param endpoint_type value of EndpointType enumeration
         :param source endpoint object, must contain a "write" method
         """
-        self.statistics[RouterStat.DEL_CLIENT] += 1
+        self.clients_removed += 1
         log.msg('DEREGISTER: %s %s' % (endpoint_type, source))
         self.clients[endpoint_type].remove(source)
+        output = self.outputs.pop(source)
+        output.close()
+        self.retired[endpoint_type].add(output)
+        self._compile()
+
+    def _stats(self):
+        return (self.clients_added, self.clients_removed, self.packets_in,
+                self.packets_out, self.bytes_in, self.bytes_out, self.writes_saved)
 
     def log_stats(self):
+        """
+        Log the activity since the previous call
+        """
+        stats = self._stats()
+        clients_added, clients_removed, packets_in, packets_out, bytes_in, bytes_out, writes_saved = [
+            current - last for current, last in zip(stats, self._last_stats)]
+        self._last_stats = stats
+
         interval = float(ROUTER_STATS_INTERVAL)
-        in_rate = self.statistics[RouterStat.PACKET_IN] / interval
-        out_rate = self.statistics[RouterStat.PACKET_OUT] / interval
-        in_byte_rate = self.statistics[RouterStat.BYTES_IN] / interval
-        out_byte_rate = self.statistics[RouterStat.BYTES_OUT] / interval
-        log.msg('Router stats:: (REG) IN: %d OUT: %d' % (
-            self.statistics[RouterStat.ADD_CLIENT],
-            self.statistics[RouterStat.DEL_CLIENT],
+        prefix = 'Router stats::' if self.name is None else 'Router stats (%s)::' % self.name
+        log.msg(prefix + ' (REG) IN: %d OUT: %d' % (
+            clients_added,
+            clients_removed,
         ))
-        log.msg('Router stats:: (PACKETS) IN: %d (%.2f/s) OUT: %d (%.2f/s)' % (
-            self.statistics[RouterStat.PACKET_IN],
-            in_rate,
-            self.statistics[RouterStat.PACKET_OUT],
-            out_rate,
+        log.msg(prefix + ' (PACKETS) IN: %d (%.2f/s) OUT: %d (%.2f/s)' % (
+            packets_in,
+            packets_in / interval,
+            packets_out,
+            packets_out / interval,
         ))
-        log.msg('Router stats:: (KB) IN: %d (%.2f/s) OUT: %d (%.2f/s)' % (
-            self.statistics[RouterStat.BYTES_IN] / 1000,
-            in_byte_rate / 1000,
-            self.statistics[RouterStat.BYTES_OUT] / 1000,
-            out_byte_rate / 1000,
+        log.msg(prefix + ' (KB) IN: %d (%.2f/s) OUT: %d (%.2f/s)' % (
+            bytes_in / 1000,
+            bytes_in / interval / 1000,
+            bytes_out / 1000,
+            bytes_out / interval / 1000,
         ))
-        self.statistics.clear()
-        reactor.callLater(ROUTER_STATS_INTERVAL, self.log_stats)
+        log.msg(prefix + ' (WRITES) COALESCED: %d (%.2f/s)' % (
+            writes_saved,
+            writes_saved / interval,
+        ))
+
+    def output_stats(self):
+        """
+        Slow consumer statistics for each registered endpoint
+        """
+        return [output.stats() for output in self.outputs.itervalues()]
+
+    def output_paused(self, output):
+        """
+        An endpoint using the PAUSE policy cannot keep up, pause all producers
+        :return: False if no producers are registered, the endpoint is not paused upstream
+        """
+        if not self.producers:
+            return False
+        if not self.paused_outputs:
+            self.pauseProducing()
+        self.paused_outputs.add(output)
+        return True
+
+    def output_resumed(self, output):
+        """
+        An endpoint using the PAUSE policy has drained, resume once none remain paused
+        """
+        self.paused_outputs.discard(output)
+        if not self.paused_outputs:
+            self.resumeProducing()
 
     def registerProducer(self, producer):
         self.producers.add(producer)
@@ -156,4 +516,4 @@ class Router(object):
 
     def resumeProducing(self):
         for producer in self.producers:
-            producer.resumeProducing()
\ No newline at end of file
+            producer.resumeProducing()
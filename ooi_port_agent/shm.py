@@ -0,0 +1,317 @@
+"""
+Shared memory ring for port agent clients on the same host.
+
+The port agent writes packed packets into a memory mapped file once, any number of
+local readers map the same file and consume the packets with their own cursors.
+
+File layout, all integers little endian:
+
+    offset  size  field
+         0     8  magic 'PASHMRNG'
+         8     4  version (2)
+        12     4  capacity, size of the data region in bytes
+        16     8  write position, total bytes ever written to the ring
+        24     8  reserved position, end of the data being written
+        32    32  unused
+        64     -  data region, stream byte n is stored at 64 + n % capacity
+
+The writer publishes the reserved position before copying data into the ring and the
+write position once the copy is complete, both always fall on a packet boundary. A
+reader copies the bytes between its cursor and the write position, then checks the
+reserved position: if the writer may have overwritten any of the bytes copied, when
+more than capacity bytes separate the cursor and the reserved position, the copy is
+discarded and the reader skips to the newest data.
+
+Readers are woken through a Unix domain socket at <path>.sock. The writer sends a
+single byte to each connected reader per write, unless an earlier wakeup is still
+queued, and closes the socket when the ring is closed.
+"""
+import errno
+import mmap
+import os
+import select
+import socket
+import struct
+
+from twisted.internet import reactor
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.protocol import Factory
+from twisted.internet.protocol import Protocol
+from twisted.python import log
+from zope.interface import implements
+
+from common import SHM_RING_SIZE
+from packet import PacketDecoder
+
+
+MAGIC = 'PASHMRNG'
+VERSION = 2
+HEADER_SIZE = 64
+header_struct = struct.Struct('<8sIIQQ')
+position_struct = struct.Struct('<Q')
+POSITION_OFFSET = 16
+RESERVED_OFFSET = 24
+# a single packet must always fit in the ring
+MIN_CAPACITY = 0x20000
+
+
+#################################################################################
+# Writer
+#################################################################################
+
+
+class Wakeup(Protocol):
+    """
+    Wakeup connection to a reader. The transport pauses the Wakeup as its streaming producer
+    while a wakeup is waiting to be sent, so at most one is queued in the reactor for a slow reader.
+    """
+    implements(IPushProducer)
+
+    paused = False
+
+    def connectionMade(self):
+        # pause once anything is buffered
+        self.transport.bufferSize = 0
+        self.transport.registerProducer(self, True)
+        self.factory.readers.add(self)
+
+    def connectionLost(self, reason=None):
+        self.factory.readers.discard(self)
+
+    def wake(self):
+        if not self.paused:
+            self.transport.write('\0')
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+    def stopProducing(self):
+        self.paused = True
+
+
+class WakeupFactory(Factory):
+    protocol = Wakeup
+
+    def __init__(self):
+        self.readers = set()
+
+
+class ShmRing(object):
+    """
+    Router endpoint writing packets into a shared memory ring.
+    Register it as an EndpointType.CLIENT so it receives what clients of the data port receive.
+    """
+    def __init__(self, path, capacity=SHM_RING_SIZE):
+        """
+        :param path: ring file, normally under /dev/shm, replaced if it exists
+        :param capacity: size of the data region in bytes
+        """
+        if capacity < MIN_CAPACITY:
+            raise ValueError('Shared memory ring capacity must be at least %d bytes' % MIN_CAPACITY)
+        self.path = path
+        self.capacity = capacity
+        self.position = 0
+        self.writes = 0
+
+        # readers of a previous ring keep their own mapping of the unlinked file
+        for stale in (path, path + '.sock'):
+            try:
+                os.unlink(stale)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0644)
+        try:
+            os.ftruncate(fd, HEADER_SIZE + capacity)
+            self.ring = mmap.mmap(fd, HEADER_SIZE + capacity)
+        finally:
+            os.close(fd)
+        header_struct.pack_into(self.ring, 0, MAGIC, VERSION, capacity, 0, 0)
+
+        self.wakeups = WakeupFactory()
+        self.port = reactor.listenUNIX(path + '.sock', self.wakeups)
+
+    def __repr__(self):
+        return 'ShmRing(%r)' % self.path
+
+    def write(self, data):
+        self.writeSequence((data,))
+
+    def writeSequence(self, sequence):
+        """
+        Copy whole packets into the ring, publish the new write position and wake the readers
+        """
+        data = ''.join(sequence)
+        # a batch larger than the ring is written packet by packet, readers will have been lapped
+        chunks = (data,) if len(data) <= self.capacity else sequence
+
+        ring = self.ring
+        for chunk in chunks:
+            end = self.position + len(chunk)
+            # readers see the bytes about to be overwritten as reserved before any is copied
+            position_struct.pack_into(ring, RESERVED_OFFSET, end)
+            self._copy(chunk)
+            self.position = end
+            position_struct.pack_into(ring, POSITION_OFFSET, end)
+
+        self.writes += 1
+        for reader in self.wakeups.readers:
+            reader.wake()
+
+    def _copy(self, chunk):
+        """
+        Copy data into the ring at the write position
+        """
+        ring = self.ring
+        capacity = self.capacity
+        size = len(chunk)
+        start = self.position % capacity
+        split = capacity - start
+        if size <= split:
+            ring[HEADER_SIZE + start:HEADER_SIZE + start + size] = chunk
+        else:
+            ring[HEADER_SIZE + start:HEADER_SIZE + capacity] = chunk[:split]
+            ring[HEADER_SIZE:HEADER_SIZE + size - split] = chunk[split:]
+
+    def close(self):
+        self.port.stopListening()
+        for reader in list(self.wakeups.readers):
+            reader.transport.loseConnection()
+        self.ring.close()
+        for path in (self.path, self.path + '.sock'):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+#################################################################################
+# Reader
+#################################################################################
+
+
+class ShmReader(object):
+    """
+    Read packets from a port agent's shared memory ring, starting with the next packet written.
+
+        reader = ShmReader('/dev/shm/CTDBP101')
+        for packet in reader:
+            ...
+
+    Iteration ends when the port agent closes the ring. For use with select or an event loop,
+    wait on fileno() and call drain() then read_packets() when it is readable.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fh:
+            self.ring = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, capacity, _, _ = header_struct.unpack_from(self.ring, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a port agent shared memory ring' % path)
+        self.capacity = capacity
+
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path + '.sock')
+        self.socket.setblocking(False)
+        self.closed = False
+
+        self.decoder = PacketDecoder()
+        self.cursor = self.position
+        # bytes skipped because the writer lapped this reader, and the number of times it happened
+        self.lost = 0
+        self.overruns = 0
+
+    @property
+    def position(self):
+        return position_struct.unpack_from(self.ring, POSITION_OFFSET)[0]
+
+    @property
+    def reserved(self):
+        return position_struct.unpack_from(self.ring, RESERVED_OFFSET)[0]
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def _overrun(self):
+        position = self.position
+        self.lost += position - self.cursor
+        self.overruns += 1
+        self.cursor = position
+        self.decoder = PacketDecoder()
+        return ''
+
+    def read(self):
+        """
+        :return: string of the packed packets written since the previous read, '' if none
+        """
+        cursor = self.cursor
+        position = self.position
+        if position == cursor:
+            return ''
+        if position - cursor > self.capacity:
+            return self._overrun()
+
+        ring = self.ring
+        start = cursor % self.capacity
+        end = start + position - cursor
+        if end <= self.capacity:
+            data = ring[HEADER_SIZE + start:HEADER_SIZE + end]
+        else:
+            data = ring[HEADER_SIZE + start:HEADER_SIZE + self.capacity] + \
+                ring[HEADER_SIZE:HEADER_SIZE + end - self.capacity]
+
+        # the writer may have been overwriting the start of the copy while it was made
+        if self.reserved - cursor > self.capacity:
+            return self._overrun()
+        self.cursor = position
+        return data
+
+    def read_packets(self):
+        """
+        :return: list of the Packets written since the previous read
+        """
+        data = self.read()
+        return self.decoder.feed(data) if data else []
+
+    def drain(self):
+        """
+        Consume pending wakeups
+        :return: False once the port agent has closed the ring
+        """
+        while True:
+            try:
+                data = self.socket.recv(4096)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return True
+                raise
+            if not data:
+                self.closed = True
+                return False
+
+    def wait(self, timeout=None):
+        """
+        Block until the ring is written to, timeout seconds pass or the ring is closed
+        :return: False once the port agent has closed the ring
+        """
+        if not self.closed:
+            select.select([self.socket], [], [], timeout)
+            self.drain()
+        return not self.closed
+
+    def __iter__(self):
+        while True:
+            for packet in self.read_packets():
+                yield packet
+            if not self.wait():
+                for packet in self.read_packets():
+                    yield packet
+                return
+
+    def close(self):
+        self.socket.close()
+        self.ring.close()
@@ -0,0 +1,131 @@
+import datetime
+import re
+
+from common import DATE_FORMAT
+from common import PacketType
+from common import string_to_ntp_date_time
+
+
+#################################################################################
+# Subscriptions
+#################################################################################
+
+
+def parse_time(value):
+    """
+    Parse an ISO8601 date string, a number of NTP seconds or a UTC date or datetime, as loaded from YAML
+    :return: NTP time as a float
+    """
+    if isinstance(value, datetime.date):
+        if not isinstance(value, datetime.datetime):
+            value = datetime.datetime(value.year, value.month, value.day)
+        elif value.utcoffset() is not None:
+            value = value.replace(tzinfo=None) - value.utcoffset()
+        value = value.strftime(DATE_FORMAT)
+    try:
+        return float(value)
+    except ValueError:
+        return string_to_ntp_date_time(value)
+
+
+def parse_packet_type(value):
+    """
+    Parse a packet type by name (FROM_INSTRUMENT) or number (1)
+    """
+    if value.isdigit():
+        packet_type = int(value)
+    else:
+        packet_type = PacketType.dict().get(value.upper())
+    if not PacketType.has(packet_type):
+        raise ValueError('Unknown packet type: %r' % value)
+    return packet_type
+
+
+class Subscription(object):
+    """
+    Filter applied by the router to the packets sent to a single endpoint.
+
+    Packet types are compiled into the routing table and cost nothing per packet.
+    The time window, payload prefix and regex are evaluated per packet by matches,
+    before the packet is serialized for the endpoint.
+    """
+    def __init__(self, packet_types=None, start=None, end=None, prefix=None, regex=None):
+        """
+        :param packet_types: collection of PacketType values, None for all types
+        :param start: NTP time, packets stamped earlier are dropped
+        :param end: NTP time, packets stamped at or after end are dropped
+        :param prefix: payloads must start with this string
+        :param regex: payloads must contain a match for this regular expression
+        """
+        self.packet_types = frozenset(packet_types) if packet_types is not None else None
+        self.start = start
+        self.end = end
+        self.prefix = prefix
+        self.regex = None
+        if regex is not None:
+            try:
+                self.regex = re.compile(regex)
+            except re.error as e:
+                raise ValueError('Invalid regex %r: %s' % (regex, e))
+
+    def __repr__(self):
+        return 'Subscription(%s)' % ' '.join(self.describe())
+
+    @classmethod
+    def parse(cls, args):
+        """
+        Build a subscription from key=value command arguments:
+            type=FROM_INSTRUMENT,PA_STATUS start=2016-01-01T00:00:00Z end=3660000000 prefix=$GPRMC regex=^\\d+
+        Values may not contain whitespace.
+        """
+        kwargs = {}
+        for arg in args:
+            key, sep, value = arg.partition('=')
+            if not sep or not value:
+                raise ValueError('Expected key=value, got: %r' % arg)
+            if key == 'type':
+                kwargs['packet_types'] = [parse_packet_type(each) for each in value.split(',')]
+            elif key in ('start', 'end'):
+                kwargs[key] = parse_time(value)
+            elif key in ('prefix', 'regex'):
+                kwargs[key] = value
+            else:
+                raise ValueError('Unknown subscription filter: %r' % key)
+        return cls(**kwargs)
+
+    def describe(self):
+        parts = []
+        if self.packet_types is not None:
+            parts.append('type=%s' % ','.join(PacketType.get_key(each, str(each)) for each in sorted(self.packet_types)))
+        if self.start is not None:
+            parts.append('start=%r' % self.start)
+        if self.end is not None:
+            parts.append('end=%r' % self.end)
+        if self.prefix is not None:
+            parts.append('prefix=%s' % self.prefix)
+        if self.regex is not None:
+            parts.append('regex=%s' % self.regex.pattern)
+        return parts
+
+    def accepts_type(self, packet_type):
+        return self.packet_types is None or packet_type in self.packet_types
+
+    @property
+    def per_packet(self):
+        """
+        True if matches must be evaluated for each packet
+        """
+        return any(each is not None for each in (self.start, self.end, self.prefix, self.regex))
+
+    def matches(self, packet):
+        if self.start is not None or self.end is not None:
+            packet_time = packet.header.time
+            if self.start is not None and packet_time < self.start:
+                return False
+            if self.end is not None and packet_time >= self.end:
+                return False
+        if self.prefix is not None and not packet.payload.startswith(self.prefix):
+            return False
+        if self.regex is not None and self.regex.search(packet.payload) is None:
+            return False
+        return True
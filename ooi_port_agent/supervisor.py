@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+"""
+Usage:
+    supervisor.py --config <config_file> [--workers=<count>] [--commandport=<port>] [--metricsport=<port>]
+
+Options:
+    -h, --help              Show this screen.
+    --workers=<count>       Number of worker processes (default: one per CPU, at most one per agent)
+    --commandport=<port>    Serve aggregated state and statistics on this port
+    --metricsport=<port>    Serve aggregated metrics over HTTP on this port
+
+Shard the port agents of a fleet config across worker processes, so that routing
+work is spread over several cores. The fleet config is a multi agent port agent
+config with an optional "supervisor" section:
+
+    supervisor: {workers: 4, commandport: 4000, metricsport: 9100, rebalance_interval: 60}
+    ttl: 30
+    agents:
+      - {type: tcp, name: CTDBP101, port: 4001, commandport: 4002, instaddr: 10.0.0.1, instport: 2101}
+      - ...
+
+Agents are moved from the busiest to the idlest worker, one at a time, when the
+byte rates reported by the workers become unbalanced. An agent being moved is
+stopped, closing its ports, before it is started in the other worker. Crashed
+workers are restarted with their agents. Agents which stop on their own, such
+as datalog readers, are not restarted.
+
+The command port accepts the commands get_state and get_stats [json|prometheus].
+"""
+from __future__ import division
+import json
+import multiprocessing
+import os
+import sys
+from collections import OrderedDict
+
+from docopt import docopt
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.defer import DeferredList
+from twisted.internet.endpoints import TCP4ServerEndpoint
+from twisted.internet.protocol import Factory
+from twisted.internet.protocol import ProcessProtocol
+from twisted.protocols.basic import LineOnlyReceiver
+from twisted.python import log
+from twisted.web.server import Site
+import yaml
+
+import metrics
+from common import MAX_WORKER_RESTART_DELAY
+from common import RATE_SMOOTHING
+from common import REBALANCE_MIN_RATE
+from common import REBALANCE_TOLERANCE
+from common import WORKER_REBALANCE_INTERVAL
+from host import Scheduler
+from port_agent import agent_configs
+from port_agent import configure_logging
+
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'worker.py')
+
+# seconds a worker may take to exit after its stdin is closed
+WORKER_SHUTDOWN_TIMEOUT = 10
+
+
+#################################################################################
+# Agent placement
+#################################################################################
+
+
+def worker_loads(assignment, rates, workers):
+    """
+    :param assignment: dict of agent name to worker index
+    :param rates: dict of agent name to bytes per second
+    :param workers: number of workers
+    :return: list of the total rate of each worker
+    """
+    loads = [0] * workers
+    for name, index in assignment.iteritems():
+        loads[index] += rates.get(name, 0)
+    return loads
+
+
+def assign(names, workers, rates=None):
+    """
+    Place agents on workers, busiest agent first onto the least loaded worker.
+    Without rates agents are spread evenly by count.
+    :return: dict of agent name to worker index
+    """
+    rates = rates or {}
+    loads = [(0, 0, index) for index in xrange(workers)]
+    assignment = {}
+    for name in sorted(names, key=lambda name: -rates.get(name, 0)):
+        load, count, index = min(loads)
+        loads[index] = (load + rates.get(name, 0), count + 1, index)
+        assignment[name] = index
+    return assignment
+
+
+def plan_move(assignment, rates, workers, tolerance=REBALANCE_TOLERANCE, min_rate=REBALANCE_MIN_RATE):
+    """
+    Choose a single agent to move from the busiest to the idlest worker, the one
+    which leaves the two closest to equal.
+    :return: (agent name, source index, destination index) or None if balanced
+    """
+    loads = worker_loads(assignment, rates, workers)
+    busiest = max(xrange(workers), key=loads.__getitem__)
+    idlest = min(xrange(workers), key=loads.__getitem__)
+    gap = loads[busiest] - loads[idlest]
+    if gap < min_rate or gap <= tolerance * loads[busiest]:
+        return None
+
+    # moving an agent with rate r changes the gap to abs(gap - 2r), only agents with r < gap help
+    candidates = [(abs(gap - 2 * rates.get(name, 0)), name) for name, index in sorted(assignment.iteritems())
+                  if index == busiest and 0 < rates.get(name, 0) < gap]
+    if not candidates:
+        return None
+    return min(candidates)[1], busiest, idlest
+
+
+#################################################################################
+# Supervisor
+#################################################################################
+
+
+class WorkerProcess(ProcessProtocol):
+    """
+    A worker process, exchanging JSON lines with the worker over its stdin and stdout
+    """
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        self.pid = None
+        self.running = False
+        self.restarts = 0
+        self.failures = 0
+        self.ended = []
+        self._buffer = ''
+
+    def __repr__(self):
+        return 'WorkerProcess(%d, pid=%s)' % (self.index, self.pid)
+
+    def spawn(self):
+        self._buffer = ''
+        reactor.spawnProcess(self, sys.executable, [sys.executable, WORKER_SCRIPT],
+                             env=os.environ, childFDs={0: 'w', 1: 'r', 2: 2})
+
+    def connectionMade(self):
+        self.pid = self.transport.pid
+        self.running = True
+        log.msg('Started worker %d, pid: %d' % (self.index, self.pid))
+        self.supervisor.worker_started(self)
+
+    def outReceived(self, data):
+        lines = (self._buffer + data).split('\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                log.msg('Invalid message from worker %d: %r' % (self.index, line))
+                continue
+            self.supervisor.worker_message(self, message)
+
+    def send(self, **message):
+        if self.running:
+            self.transport.write(json.dumps(message) + '\n')
+
+    def shutdown(self):
+        """
+        Close the worker's stdin, the worker stops its agents and exits
+        :return: deferred firing when the process has ended
+        """
+        d = Deferred()
+        self.ended.append(d)
+        self.transport.closeStdin()
+        kill = reactor.callLater(WORKER_SHUTDOWN_TIMEOUT, self.transport.signalProcess, 'KILL')
+
+        def ended(result):
+            if kill.active():
+                kill.cancel()
+            return result
+
+        return d.addBoth(ended)
+
+    def processEnded(self, reason):
+        self.running = False
+        log.msg('Worker %d (pid: %s) ended: %s' % (self.index, self.pid, reason.getErrorMessage()))
+        ended, self.ended = self.ended, []
+        for d in ended:
+            d.callback(None)
+        self.supervisor.worker_ended(self)
+
+
+class Supervisor(object):
+    """
+    Run a fleet of port agents in worker processes
+    """
+    def __init__(self, configs, workers, rebalance_interval=WORKER_REBALANCE_INTERVAL, clock=reactor):
+        """
+        :param configs: list of agent configurations, see port_agent.agent_configs
+        :param workers: number of worker processes
+        :param rebalance_interval: seconds between rebalancing passes, None to disable
+        """
+        self.configs = OrderedDict((config['name'], config) for config in configs)
+        self.workers = [WorkerProcess(self, index) for index in xrange(workers)]
+        self.rebalance_interval = rebalance_interval
+        self.clock = clock
+        self.scheduler = Scheduler(clock=clock)
+        self.stopping = False
+
+        self.assignment = assign(self.configs, workers)
+        # agent name -> (source index, destination index) while an agent is moved
+        self.moving = {}
+        self.finished = set()
+        self.moves = 0
+
+        # latest statistics, smoothed byte rates and the byte totals they were computed from
+        self.stats = {}
+        self.rates = {}
+        self._totals = {}
+
+    def start(self):
+        for worker in self.workers:
+            worker.spawn()
+        if self.rebalance_interval:
+            self.scheduler.add(self.rebalance_interval, self.rebalance)
+
+    def stop(self):
+        """
+        Stop all workers
+        :return: deferred firing once every worker has exited
+        """
+        self.stopping = True
+        self.scheduler.stop()
+        return DeferredList([worker.shutdown() for worker in self.workers if worker.running])
+
+    def agents(self, index):
+        return [name for name in self.configs if self.assignment.get(name) == index]
+
+    def worker_started(self, worker):
+        for name in self.agents(worker.index):
+            if name not in self.moving:
+                worker.send(start=self.configs[name])
+
+    def worker_message(self, worker, message):
+        if 'stats' in message:
+            worker.failures = 0
+            self.update_rates(message['stats'], self.clock.seconds())
+        elif 'started' in message:
+            log.msg('Worker %d started port agent %s' % (worker.index, message['started']))
+        elif 'failed' in message:
+            log.msg('Worker %d unable to start port agent %s: %s' %
+                    (worker.index, message['failed'], message.get('error')))
+        elif 'stopped' in message:
+            self.agent_stopped(worker, message['stopped'])
+
+    def agent_stopped(self, worker, name):
+        if name in self.moving and self.moving[name][0] == worker.index:
+            self._finish_move(name)
+        elif self.assignment.get(name) == worker.index:
+            log.msg('Port agent %s finished' % name)
+            self.assignment.pop(name)
+            self.finished.add(name)
+            self.stats.pop(name, None)
+
+    def _finish_move(self, name):
+        source, destination = self.moving.pop(name)
+        log.msg('Moving port agent %s to worker %d' % (name, destination))
+        self.workers[destination].send(start=self.configs[name])
+
+    def worker_ended(self, worker):
+        for name in self.agents(worker.index):
+            self.stats.pop(name, None)
+        for name, (source, destination) in self.moving.items():
+            if source == worker.index:
+                self._finish_move(name)
+
+        if not self.stopping:
+            delay = min(2 ** worker.failures, MAX_WORKER_RESTART_DELAY)
+            worker.failures += 1
+            worker.restarts += 1
+            log.msg('Restarting worker %d in %d seconds' % (worker.index, delay))
+            self.clock.callLater(delay, self._restart, worker)
+
+    def _restart(self, worker):
+        if not self.stopping and not worker.running:
+            worker.spawn()
+
+    def update_rates(self, stats, now):
+        """
+        Record the latest statistics of each agent and update its smoothed rate of bytes routed
+        """
+        for each in stats:
+            name = each['name']
+            total = sum(counts['bytes_in'] + counts['bytes_out'] for counts in each['packet_types'].itervalues())
+            last = self._totals.get(name)
+            self._totals[name] = (now, total)
+            self.stats[name] = each
+
+            # counters restart from zero when an agent is moved or its worker restarted
+            if last is None or total < last[1] or now <= last[0]:
+                continue
+            rate = (total - last[1]) / (now - last[0])
+            previous = self.rates.get(name)
+            self.rates[name] = rate if previous is None else previous + RATE_SMOOTHING * (rate - previous)
+
+    def rebalance(self):
+        """
+        Move at most one agent, and only while no move is in progress and all workers are running
+        """
+        if self.moving or not all(worker.running for worker in self.workers):
+            return
+        move = plan_move(self.assignment, self.rates, len(self.workers))
+        if move is not None:
+            name, source, destination = move
+            log.msg('Rebalancing port agent %s (%d bytes/s) from worker %d to %d' %
+                    (name, self.rates[name], source, destination))
+            self.moves += 1
+            self.assignment[name] = destination
+            self.moving[name] = (source, destination)
+            self.workers[source].send(stop=name)
+
+    def collect(self):
+        """
+        :return: the latest statistics of every running agent, see metrics.collect
+        """
+        return [self.stats[name] for name in self.configs if name in self.stats]
+
+    def state(self):
+        loads = worker_loads(self.assignment, self.rates, len(self.workers))
+        return {
+            'workers': [{
+                'index': worker.index,
+                'pid': worker.pid,
+                'running': worker.running,
+                'restarts': worker.restarts,
+                'bytes_per_second': loads[worker.index],
+                'agents': {name: self.rates.get(name, 0) for name in self.agents(worker.index)},
+            } for worker in self.workers],
+            'moving': sorted(self.moving),
+            'moves': self.moves,
+            'finished': sorted(self.finished),
+        }
+
+
+class SupervisorCommandProtocol(LineOnlyReceiver):
+    """
+    Plain text command port for the supervisor, each command is answered with a single response
+    """
+    delimiter = b'\n'
+
+    def lineReceived(self, line):
+        parts = line.split()
+        command = parts[0] if parts else ''
+        supervisor = self.factory.supervisor
+
+        if command == 'get_state':
+            response = json.dumps(supervisor.state(), sort_keys=True)
+        elif command == 'get_stats':
+            output_format = parts[1] if len(parts) > 1 else 'json'
+            if output_format == 'prometheus':
+                response = metrics.format_prometheus(supervisor.collect())
+            elif output_format == 'json':
+                response = metrics.format_json(supervisor.collect())
+            else:
+                response = 'Unknown stats format: %r' % output_format
+        else:
+            response = 'Received bad command on supervisor command port: %r' % command
+
+        self.transport.write(response.rstrip('\n') + self.delimiter)
+
+
+class SupervisorCommandFactory(Factory):
+    protocol = SupervisorCommandProtocol
+
+    def __init__(self, supervisor):
+        self.supervisor = supervisor
+
+
+def main():
+    configure_logging()
+    options = docopt(__doc__)
+    config = yaml.load(open(options['<config_file>']))
+    settings = config.pop('supervisor', None) or {}
+
+    try:
+        configs = agent_configs(config)
+    except ValueError as e:
+        log.err(str(e))
+        exit(1)
+
+    workers = options['--workers'] or settings.get('workers') or multiprocessing.cpu_count()
+    workers = max(1, min(int(workers), len(configs)))
+    command_port = options['--commandport'] or settings.get('commandport')
+    metrics_port = options['--metricsport'] or settings.get('metricsport')
+
+    supervisor = Supervisor(configs, workers,
+                            rebalance_interval=settings.get('rebalance_interval', WORKER_REBALANCE_INTERVAL))
+    if command_port is not None:
+        TCP4ServerEndpoint(reactor, int(command_port)).listen(SupervisorCommandFactory(supervisor))
+    if metrics_port is not None:
+        TCP4ServerEndpoint(reactor, int(metrics_port)).listen(Site(metrics.MetricsResource(supervisor.collect)))
+
+    reactor.addSystemEventTrigger('before', 'shutdown', supervisor.stop)
+    reactor.callWhenRunning(supervisor.start)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
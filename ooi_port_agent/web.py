@@ -1,6 +1,11 @@
+import json
+
 from twisted.internet import reactor
 from twisted.internet.defer import succeed
+from twisted.python import log
 from twisted.web.client import Agent
+from twisted.web.client import HTTPConnectionPool
+from twisted.web.client import readBody
 from twisted.web.http_headers import Headers
 from twisted.web.iweb import IBodyProducer
 from zope.interface import implements
@@ -32,4 +37,47 @@ def get(url):
 def put(url, data):
     agent = Agent(reactor)
     producer = StringProducer(data)
-    return agent.request('PUT', url, Headers(), producer)
\ No newline at end of file
+    return agent.request('PUT', url, Headers(), producer)
+
+
+class ConsulClient(object):
+    """
+    Minimal client for the local Consul agent API.
+    Requests share a pool of persistent HTTP connections, so every port agent
+    in a process can use a single client.
+    """
+    base_url = 'http://localhost:8500/v1/agent/'
+
+    def __init__(self, base_url=None):
+        if base_url is not None:
+            self.base_url = base_url
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.agent = Agent(reactor, pool=self.pool)
+
+    def _request(self, method, path, data=None, caller=''):
+        producer = StringProducer(data) if data is not None else None
+        d = self.agent.request(method, self.base_url + path, Headers(), producer)
+        d.addCallbacks(self._done, self._failed, callbackArgs=(caller,), errbackArgs=(caller,))
+        return d
+
+    @classmethod
+    def _done(cls, response, caller):
+        log.msg(caller + 'http response: %s' % response.code)
+        # the body must be consumed before the connection returns to the pool
+        return readBody(response).addErrback(cls._failed, caller)
+
+    @staticmethod
+    def _failed(failure, caller):
+        log.msg(caller + 'http request failed: %s' % failure.getErrorMessage())
+
+    def register_service(self, values, caller=''):
+        return self._request('PUT', 'service/register', json.dumps(values), caller=caller)
+
+    def deregister_service(self, service_id, caller=''):
+        return self._request('PUT', 'service/deregister/' + service_id, '', caller=caller)
+
+    def pass_check(self, service_id, caller=''):
+        return self._request('GET', 'check/pass/service:' + service_id, caller=caller)
+
+    def close(self):
+        return self.pool.closeCachedConnections()
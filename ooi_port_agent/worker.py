@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""
+Port agent worker process, started by the supervisor.
+
+Usage:
+    worker.py
+
+The worker hosts the port agents assigned to it by the supervisor. Messages are
+exchanged as one JSON object per line, on stdin from the supervisor:
+
+    {"start": <agent config>}
+    {"stop": <agent name>}
+
+and on stdout to the supervisor:
+
+    {"started": <agent name>}
+    {"failed": <agent name>, "error": <message>}
+    {"stopped": <agent name>}               once the agent's listening ports are closed
+    {"stats": [<metrics.collect output>...]}
+
+The worker exits when stdin is closed.
+"""
+import json
+
+from twisted.internet import reactor
+from twisted.internet import stdio
+from twisted.internet.defer import gatherResults
+from twisted.protocols.basic import LineOnlyReceiver
+from twisted.python import log
+
+import metrics
+from common import WORKER_STATS_INTERVAL
+from host import AgentHost
+from host import set_host
+from port_agent import agent_types
+from port_agent import configure_logging
+
+
+#################################################################################
+# Worker
+#################################################################################
+
+
+def to_str(value):
+    """
+    Convert the unicode strings produced by json.loads back to the str the port agents expect
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [to_str(each) for each in value]
+    if isinstance(value, dict):
+        return {to_str(key): to_str(each) for key, each in value.iteritems()}
+    return value
+
+
+class WorkerHost(AgentHost):
+    """
+    Agent host which reports stopped agents to the supervisor and keeps
+    running when it has no agents
+    """
+    exit_when_empty = False
+
+    def __init__(self, protocol, **kwargs):
+        super(WorkerHost, self).__init__(**kwargs)
+        self.protocol = protocol
+
+    def remove(self, agent):
+        super(WorkerHost, self).remove(agent)
+        self.protocol.agent_stopped(agent)
+
+
+class WorkerProtocol(LineOnlyReceiver):
+    """
+    Supervisor connection over stdio
+    """
+    delimiter = b'\n'
+    MAX_LENGTH = 0x100000
+
+    def __init__(self, agent_type_map):
+        self.agent_type_map = agent_type_map
+        self.agents = {}
+        self.host = None
+
+    def connectionMade(self):
+        self.host = WorkerHost(self)
+        set_host(self.host)
+        self.host.scheduler.add(WORKER_STATS_INTERVAL, self.send_stats)
+
+    def send(self, **message):
+        self.transport.write(json.dumps(message) + self.delimiter)
+
+    def send_stats(self):
+        self.send(stats=[metrics.collect(agent) for agent in self.agents.itervalues()])
+
+    def lineReceived(self, line):
+        try:
+            message = to_str(json.loads(line))
+        except ValueError:
+            log.err(None, 'Invalid message from supervisor: %r' % line)
+            return
+
+        if 'start' in message:
+            self.start_agent(message['start'])
+        elif 'stop' in message:
+            self.stop_agent(message['stop'])
+        else:
+            log.msg('Unknown message from supervisor: %r' % line)
+
+    def start_agent(self, config):
+        name = config.get('name')
+        agent_class = self.agent_type_map.get(config.get('type'))
+        if agent_class is None:
+            self.send(failed=name, error='unknown type: %r' % config.get('type'))
+            return
+        try:
+            agent = agent_class(config).start()
+        except Exception as e:
+            log.err(None, 'Unable to start port agent %s' % name)
+            self.send(failed=name, error=str(e))
+            return
+        self.agents[name] = agent
+        self.send(started=name)
+
+    def stop_agent(self, name):
+        agent = self.agents.get(name)
+        if agent is None:
+            self.send(stopped=name)
+        else:
+            agent.stop()
+
+    def agent_stopped(self, agent):
+        """
+        Called by the host once an agent has stopped, at the request of the supervisor or on its own
+        """
+        if self.agents.get(agent.name) is agent:
+            del self.agents[agent.name]
+            self.send(stopped=agent.name)
+
+    def connectionLost(self, reason=None):
+        log.msg('Supervisor connection closed, stopping worker')
+        stopped = gatherResults([agent.stop() for agent in self.agents.values()])
+        stopped.addBoth(lambda _: reactor.stop())
+
+
+def main():
+    configure_logging()
+    stdio.StandardIO(WorkerProtocol(agent_types()))
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
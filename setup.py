@@ -97,8 +97,9 @@ setup(
         'console_scripts': [
             'port_agent=ooi_port_agent.port_agent:main',
             'port_agent_decoder=ooi_port_agent.decoder:main',
+            'port_agent_supervisor=ooi_port_agent.supervisor:main',
         ],
     },
 
-    ext_modules=cythonize('ooi_port_agent/lrc.pyx'),
+    ext_modules=cythonize(['ooi_port_agent/lrc.pyx', 'ooi_port_agent/codec.pyx']),
 )
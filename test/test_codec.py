@@ -0,0 +1,133 @@
+import unittest
+from ooi_port_agent import packet
+from ooi_port_agent.common import PacketType
+from ooi_port_agent.packet import Packet, PacketHeader
+
+try:
+    from ooi_port_agent import codec
+except ImportError:
+    codec = None
+
+
+class CodecTestMixin(object):
+    """
+    Tests common to the compiled and pure python codec implementations
+    """
+    encode_header = None
+    scan_buffer = None
+    scan_verified = None
+    xor_prefix = None
+
+    def test_encode_header(self):
+        payload = 'abc123'
+        header = self.encode_header(PacketType.FROM_INSTRUMENT, payload, 3600000000, 2 ** 31)
+        expected = PacketHeader(packet_type=PacketType.FROM_INSTRUMENT, payload_size=len(payload),
+                                ts_high=3600000000, ts_low=2 ** 31)
+        expected.set_checksum(payload)
+
+        self.assertEqual(header, repr(expected))
+        self.assertTrue(Packet(payload=payload, header=PacketHeader.from_buffer(header)).valid)
+
+    def test_encode_empty_header(self):
+        header = self.encode_header(PacketType.PA_HEARTBEAT, '', 1, 2)
+        self.assertEqual(len(header), PacketHeader.header_size)
+        self.assertTrue(Packet(payload='', header=PacketHeader.from_buffer(header)).valid)
+
+    def test_scan_buffer(self):
+        junk = 'kj34jk3h45'
+        first = Packet.create('abc123', PacketType.FROM_INSTRUMENT)[0]
+        second = Packet.create('', PacketType.PA_HEARTBEAT)[0]
+        # a sync followed by an impossible packet size
+        fake = PacketHeader.sync + '\x01\x00\x02' + 'z' * 20
+        data_buffer = junk + first.data + fake + second.data + first.data[:-1]
+
+        for each in (data_buffer, bytearray(data_buffer)):
+            records, offset = self.scan_buffer(each)
+            self.assertEqual(len(records), 2)
+            self.assertEqual(offset, len(data_buffer) - len(first.data) + 1)
+
+            for record, (index, expected) in zip(records, [(len(junk), first),
+                                                           (len(junk + first.data + fake), second)]):
+                header = expected.header
+                self.assertEqual(record, (index, header.packet_type, header.packet_size, header.checksum,
+                                          header.ts_high, header.ts_low, True))
+
+    def test_scan_buffer_bad_checksum(self):
+        data_buffer = Packet.create('abc123', PacketType.FROM_INSTRUMENT)[0].data
+        data_buffer = data_buffer[:-2] + 'ZZ'
+
+        records, offset = self.scan_buffer(data_buffer)
+        self.assertEqual(len(records), 1)
+        self.assertFalse(records[0][-1])
+        self.assertEqual(offset, len(data_buffer))
+
+    def test_scan_buffer_partial_sync(self):
+        records, offset = self.scan_buffer('abcdef' + PacketHeader.sync[:2])
+        self.assertEqual(records, [])
+        self.assertEqual(offset, 6)
+
+        records, offset = self.scan_buffer('abcdef' + PacketHeader.sync[:2], 7)
+        self.assertEqual(offset, 7)
+
+    def test_xor_prefix(self):
+        data = 'abc123'
+        self.assertEqual(self.xor_prefix(data), packet.py_xor_prefix(data))
+        self.assertEqual(self.xor_prefix(data, 7)[-1], packet.lrc(data, 7))
+        self.assertEqual(self.xor_prefix(''), bytearray())
+
+    def test_scan_verified(self):
+        junk = 'kj34jk3h45'
+        good = Packet.create('abc123', PacketType.FROM_INSTRUMENT)[0].data
+        bad = good[:-2] + 'ZZ'
+        # plausible header with a bad checksum
+        fake = PacketHeader.sync + '\x01\x00\x40\x00\x01' + 'z' * 8
+        data_buffer = junk + fake + bad + good + good + 'z' * 64
+        prefix = bytearray(1) + self.xor_prefix(data_buffer)
+
+        records, offset, resyncs, bad_checksums = self.scan_verified(data_buffer, prefix, 0, 10)
+        self.assertEqual([record[0] for record in records],
+                         [len(junk + fake + bad), len(junk + fake + bad + good)])
+        self.assertTrue(all(record[-1] for record in records))
+        self.assertEqual(offset, len(data_buffer) - 2)
+        self.assertEqual(resyncs, 2)
+        self.assertEqual(bad_checksums, 2)
+
+    def test_scan_verified_pending(self):
+        good = Packet.create('abc123', PacketType.FROM_INSTRUMENT)[0].data
+        # plausible header claiming more data than the rest of the buffer
+        fake = PacketHeader.sync + '\x01\x00\x40\x00\x01' + 'z' * 8
+        data_buffer = fake + good
+        prefix = bytearray(1) + self.xor_prefix(data_buffer)
+
+        records, offset, resyncs, bad_checksums = self.scan_verified(data_buffer, prefix, 0, 10)
+        self.assertEqual(records, [])
+        self.assertEqual(offset, 0)
+
+    def test_scan_verified_implausible(self):
+        good = Packet.create('abc123', PacketType.FROM_INSTRUMENT)[0].data
+        # bad packet type, undersized packet and a checksum larger than one byte
+        fakes = [PacketHeader.sync + '\xff\x00\x20\x00\x01' + 'z' * 8,
+                 PacketHeader.sync + '\x01\x00\x02\x00\x01' + 'z' * 8,
+                 PacketHeader.sync + '\x01\x00\x20\x01\x01' + 'z' * 8]
+        data_buffer = ''.join(fakes) + good
+        prefix = bytearray(1) + self.xor_prefix(data_buffer)
+
+        records, offset, resyncs, bad_checksums = self.scan_verified(data_buffer, prefix, 0, 10)
+        self.assertEqual([record[0] for record in records], [len(data_buffer) - len(good)])
+        self.assertEqual(resyncs, 3)
+        self.assertEqual(bad_checksums, 0)
+
+
+class PurePythonCodecUnitTest(CodecTestMixin, unittest.TestCase):
+    encode_header = staticmethod(packet.py_encode_header)
+    scan_buffer = staticmethod(packet.py_scan_buffer)
+    scan_verified = staticmethod(packet.py_scan_verified)
+    xor_prefix = staticmethod(packet.py_xor_prefix)
+
+
+@unittest.skipIf(codec is None, 'compiled codec not available')
+class CompiledCodecUnitTest(CodecTestMixin, unittest.TestCase):
+    encode_header = staticmethod(codec.encode_header if codec else None)
+    scan_buffer = staticmethod(codec.scan_buffer if codec else None)
+    scan_verified = staticmethod(codec.scan_verified if codec else None)
+    xor_prefix = staticmethod(codec.xor_prefix if codec else None)
@@ -0,0 +1,285 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+from ooi_port_agent.common import PacketType
+from ooi_port_agent.datalog import (FrameCompressor, FrameReader, GZIP_WBITS, SegmentStore, bisect_time,
+                                    filename_time, list_segments, open_datalog, probe_packets, read_index,
+                                    search_index, series_end_times, time_bounds)
+from ooi_port_agent.logwriter import CompressedLogFile, LogFile, LogWriter
+from ooi_port_agent.packet import FakeClock, Packet, PacketReader
+
+
+class FrameCompressorUnitTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'test.datalog.gz')
+        self.now = 1000.0
+        self.compressor = FrameCompressor(frame_bytes=1000, frame_interval=10, clock=lambda: self.now)
+        self.packet_clock = FakeClock(start=3600000000, step=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def packets(self, count):
+        packets = []
+        for index in xrange(count):
+            packets.extend(Packet.create('SAMPLE,%04d\r\n' % index, PacketType.FROM_INSTRUMENT,
+                                         clock=self.packet_clock))
+        return [packet.data for packet in packets]
+
+    def write(self, data):
+        with open(self.path, 'ab') as fh:
+            fh.write(data)
+
+    def read(self):
+        with open_datalog(self.path) as fh:
+            return [packet.data for packet in PacketReader(fh)]
+
+    def test_frames(self):
+        written = []
+        frames = []
+        for _ in xrange(10):
+            chunks = self.packets(10)
+            written.extend(chunks)
+            data = self.compressor.compress(chunks)
+            frames.append(data)
+            self.write(data)
+        frames.append(self.compressor.end())
+        self.write(frames[-1])
+
+        # 290 bytes per call, a frame ends after the fourth call that fills it
+        self.assertEqual(self.compressor.frames, 3)
+        self.assertEqual(self.read(), written)
+        self.assertEqual(gzip.open(self.path).read(), ''.join(written))
+
+        # the second frame starts with the fifth call and decompresses on its own
+        self.assertEqual(zlib.decompress(''.join(frames[4:8]), GZIP_WBITS), ''.join(written[40:80]))
+
+    def test_frame_interval(self):
+        self.write(self.compressor.compress(self.packets(1)))
+        self.now += 10
+        self.write(self.compressor.compress(self.packets(1)))
+        self.write(self.compressor.end())
+        self.assertEqual(self.compressor.frames, 2)
+        self.assertEqual(len(self.read()), 2)
+
+    def test_sync(self):
+        written = self.packets(5)
+        self.write(self.compressor.compress(written))
+        self.write(self.compressor.sync())
+        # the open frame can be read up to the sync
+        self.assertEqual(self.read(), written)
+        self.assertEqual(self.compressor.sync(), '')
+
+    def test_restart_after_crash(self):
+        # the writer dies after a sync, leaving its frame open
+        before = self.packets(5)
+        self.write(self.compressor.compress(before) + self.compressor.sync())
+        # the restarted writer appends a new frame
+        compressor = FrameCompressor()
+        after = self.packets(5)
+        self.write(compressor.compress(after) + compressor.end())
+        self.assertEqual(self.read(), before + after)
+
+        # whichever block the next frame header falls in
+        for block_size in xrange(1, 20):
+            reader = FrameReader(open(self.path, 'rb'))
+            reader.block_size = block_size
+            self.assertEqual(reader.read(), ''.join(before + after))
+            self.assertEqual(reader.truncated_frames, 1)
+            self.assertEqual(reader.bytes_skipped, 0)
+            reader.close()
+
+    def test_corrupt_frame(self):
+        first = self.packets(5)
+        self.write(self.compressor.compress(first) + self.compressor.end())
+        size = os.path.getsize(self.path)
+        self.write(self.compressor.compress(self.packets(5)) + self.compressor.end())
+        # the second frame is damaged after its header
+        with open(self.path, 'r+b') as fh:
+            fh.seek(size + 10)
+            fh.write('\xff' * 8)
+        last = self.packets(5)
+        self.write(self.compressor.compress(last) + self.compressor.end())
+
+        reader = FrameReader(open(self.path, 'rb'))
+        self.assertEqual(reader.read(), ''.join(first + last))
+        self.assertEqual(reader.truncated_frames, 1)
+        self.assertTrue(reader.bytes_skipped > 0)
+        reader.close()
+
+    def test_plain(self):
+        written = self.packets(3)
+        self.write(''.join(written))
+        self.assertEqual(self.read(), written)
+
+    def test_read_sizes(self):
+        written = ''.join(self.packets(100))
+        self.write(self.compressor.compress([written]) + self.compressor.end())
+        reader = FrameReader(open(self.path, 'rb'))
+        reader.block_size = 7
+        self.assertEqual(reader.read(10), written[:10])
+        self.assertEqual(reader.tell(), 10)
+        self.assertEqual(reader.read(), written[10:])
+        self.assertEqual(reader.read(1), '')
+        reader.close()
+
+
+class CompressedLogFileUnitTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_rotate(self):
+        writer = LogWriter()
+        log_file = LogFile(CompressedLogFile('test.datalog.gz', self.tempdir, FrameCompressor()), writer)
+        packets = Packet.create('abc', PacketType.FROM_INSTRUMENT) + Packet.create('def', PacketType.FROM_INSTRUMENT)
+        log_file.write(packets[0].data)
+        writer.stop()
+
+        # the rotated file is closed with a complete frame
+        log_file.log_file.lastDate = (2000, 1, 1)
+        log_file.write(packets[1].data)
+        log_file.close()
+        writer.stop()
+
+        rotated = os.path.join(self.tempdir, 'test.datalog.gz.2000_1_1')
+        self.assertEqual(gzip.open(rotated).read(), packets[0].data)
+        self.assertEqual(gzip.open(log_file.path).read(), packets[1].data)
+
+
+class SegmentStoreUnitTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.now = 1500000000.0
+        self.packet_clock = FakeClock(start=3600000000, step=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def open(self, **kwargs):
+        return SegmentStore('test.datalog', self.tempdir, clock=lambda: self.now, **kwargs)
+
+    def write(self, store, count):
+        """
+        Write count packets stamped one second apart, as a batch of packets in one chunk and single packets
+        """
+        packets = []
+        for index in xrange(count):
+            packets.extend(Packet.create('%04d' % index, PacketType.FROM_INSTRUMENT, clock=self.packet_clock))
+        data = [packet.data for packet in packets]
+        half = len(data) // 2
+        store.writelines([''.join(data[:half])] + data[half:])
+        return data
+
+    def read(self, path, start_time=None):
+        with open_datalog(path, start_time) as fh:
+            return [packet.data for packet in PacketReader(fh)]
+
+    def test_index(self):
+        store = self.open(index_interval=10)
+        written = self.write(store, 45)
+        store.close()
+        segment, = list_segments(store.path)
+
+        interval, entries = read_index(segment + '.idx')
+        self.assertEqual(interval, 10)
+        self.assertEqual(len(entries), 5)
+        self.assertEqual(entries[2], (3600000020, 20 * len(written[0]), PacketType.FROM_INSTRUMENT))
+
+        self.assertEqual(search_index(segment + '.idx', 3600000025), 20 * len(written[0]))
+        self.assertEqual(search_index(segment + '.idx', 3600000000), 0)
+        self.assertEqual(self.read(segment, 3600000025), written[20:])
+        self.assertEqual(self.read(segment, 3600000099), written[40:])
+        self.assertEqual(self.read(segment), written)
+
+    def test_compressed_index(self):
+        store = self.open(index_interval=10, compressor=FrameCompressor())
+        written = self.write(store, 45)
+        store.flush()
+        # readable while the segment is open
+        segment, = list_segments(store.path)
+        self.assertEqual(self.read(segment, 3600000031), written[30:])
+        store.close()
+        self.assertEqual(self.read(segment), written)
+        self.assertEqual(gzip.open(segment).read(), ''.join(written))
+
+    def test_roll_and_retention(self):
+        store = self.open(segment_bytes=200, segment_seconds=60, retain_bytes=600)
+        for _ in xrange(6):
+            self.write(store, 10)
+            self.now += 1
+        # 236 bytes per segment with its index, the new segment's index header is 16 bytes
+        self.assertEqual(store.segments, 6)
+        self.assertEqual(len(list_segments(store.path)), 3)
+        self.assertEqual(store.deleted, 3)
+
+        self.now += 60
+        self.write(store, 1)
+        self.assertEqual(store.segments, 7)
+        store.close()
+
+    def test_retain_seconds(self):
+        store = self.open(segment_seconds=10, retain_seconds=15)
+        self.write(store, 1)
+        first = store.segment_path
+        self.now += 10
+        self.write(store, 1)
+        os.utime(first, (self.now - 10, self.now - 10))
+        self.assertTrue(os.path.exists(first))
+        self.now += 10
+        self.write(store, 1)
+        self.assertFalse(os.path.exists(first))
+        self.assertFalse(os.path.exists(first + '.idx'))
+        self.assertEqual(len(list_segments(store.path)), 2)
+        store.close()
+
+
+class TimeWindowUnitTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'test.datalog')
+        clock = FakeClock(start=3600000000, step=1)
+        self.offsets = []
+        with open(self.path, 'wb') as fh:
+            for index in xrange(2000):
+                # varying sizes, some payloads holding a false sync
+                payload = ('\xa3\x9d\x7a' if index % 7 == 0 else '') + 'x' * (index * 37 % 300)
+                self.offsets.append(fh.tell())
+                fh.write(Packet.create(payload, PacketType.FROM_INSTRUMENT, clock=clock)[0].data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_filename_time(self):
+        self.assertEqual(filename_time('test.datalog.20150301T120000.500000Z'), 3634200000.5)
+        self.assertEqual(filename_time('/data/CTDBP_20150301T120000_UTC.dat'), 3634200000)
+        self.assertEqual(filename_time('test.datalog'), None)
+
+    def test_series_end_times(self):
+        paths = ['a.datalog.20150301T130000.000000Z', 'a.datalog.20150301T120000.000000Z',
+                 'b.datalog.20150301T123000.000000Z', 'other.datalog']
+        self.assertEqual(series_end_times(paths), {'a.datalog.20150301T120000.000000Z': 3634203600})
+
+    def test_probe(self):
+        with open(self.path, 'rb') as fh:
+            records = probe_packets(fh, self.offsets[10] + 1, size=1000)
+            self.assertEqual(records[0], (self.offsets[11], 3600000011))
+            self.assertEqual(time_bounds(fh), (3600000000, 3600001999))
+
+    def test_bisect(self):
+        with open(self.path, 'rb') as fh:
+            for start_time in (3600000000, 3600000001, 3600000999.5, 3600001999, 3600005000):
+                offset = bisect_time(fh, start_time, size=1000)
+                self.assertEqual(fh.tell(), offset)
+                packets = list(PacketReader(fh))
+                # starts before the window, not far before it
+                self.assertTrue(offset == 0 or packets[0].header.time < start_time)
+                self.assertTrue(sum(1 for each in packets if each.header.time < start_time) < 20)
+                self.assertEqual(len([each for each in packets if each.header.time >= start_time]),
+                                 len([each for each in xrange(2000) if 3600000000 + each >= start_time]))
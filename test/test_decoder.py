@@ -0,0 +1,75 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from ooi_port_agent.common import PacketType
+from ooi_port_agent.decoder import FileDecoder, FileStats, combine_stats, decode
+from ooi_port_agent.packet import FakeClock, Packet
+
+
+class DecoderUnitTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.clock = FakeClock(start=3600000000, step=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write(self, name, count, packet_type=PacketType.FROM_INSTRUMENT, corrupt=False):
+        path = os.path.join(self.tempdir, name)
+        with open(path, 'wb') as fh:
+            for index in xrange(count):
+                data = Packet.create('%s %d\r\n' % (name, index), packet_type, clock=self.clock)[0].data
+                if corrupt and index == 0:
+                    data = data[:-1] + 'X'
+                fh.write(data)
+        return path
+
+    def output(self, path, output_format):
+        return ''.join(iter(FileDecoder(path, chunk_bytes=64, output_format=output_format).next_chunk, None))
+
+    def test_formats(self):
+        path = self.write('a', 3)
+        ascii_lines = self.output(path, 'ascii').splitlines()
+        self.assertEqual(ascii_lines[0], "3600000000.0000 : FROM_INSTRUMENT :  CRC OK : 'a 0\\r\\n'")
+        self.assertEqual(len(ascii_lines), 3)
+
+        record = json.loads(self.output(path, 'json').splitlines()[1])
+        self.assertEqual(record, {'time': 3600000001.0, 'type': 'FROM_INSTRUMENT', 'valid': True,
+                                  'payload': 'a 1\r\n'})
+        self.assertEqual(self.output(path, 'raw'), 'a 0\r\na 1\r\na 2\r\n')
+        self.assertEqual(self.output(path, 'csv').splitlines()[2], '3600000002.000000,FROM_INSTRUMENT,21,%d,1' %
+                         Packet.create('a 2\r\n', 1, clock=FakeClock(start=3600000002))[0].header.checksum)
+
+    def test_stats(self):
+        first = self.write('a', 10, corrupt=True)
+        self.clock.time += 100
+        second = self.write('b', 5)
+        self.write('c', 1, packet_type=PacketType.PA_STATUS)
+
+        stats = FileStats(first, gap=10).next_chunk()
+        self.assertEqual(stats['types'][PacketType.FROM_INSTRUMENT]['bad_checksums'], 1)
+
+        total = {'files': 0, 'bytes_skipped': 0, 'types': {}}
+        for path in (first, second):
+            combine_stats(total, FileStats(path, gap=10).next_chunk(), 10)
+        stats = total['types'][PacketType.FROM_INSTRUMENT]
+        self.assertEqual((stats['packets'], stats['bytes']), (15, 15 * 21))
+        # the gap between the files
+        self.assertEqual((stats['gaps'], stats['max_gap']), (1, 101))
+        self.assertEqual((stats['first'], stats['last']), (3600000000, 3600000114))
+
+    def test_decode_in_order(self):
+        files = [self.write('%02d' % index, 50) for index in xrange(5)]
+        files.append(os.path.join(self.tempdir, 'missing'))
+        expected = ''.join(self.output(path, 'raw') for path in files[:-1])
+        for processes in (0, 2):
+            chunks = decode(files, FileDecoder, ('raw',), processes=processes)
+            self.assertEqual(''.join(chunks), expected)
+
+    def test_window_and_types(self):
+        path = self.write('a', 20)
+        chunks = decode([path], FileDecoder, ('raw',), start=3600000005, end=3600000006,
+                        packet_types=[PacketType.FROM_INSTRUMENT], processes=0)
+        self.assertEqual(''.join(chunks), 'a 5\r\na 6\r\n')
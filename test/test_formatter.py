@@ -0,0 +1,75 @@
+import threading
+import unittest
+from ooi_port_agent.common import EndpointType, Format, PacketType, NEWLINE
+from ooi_port_agent.formatter import AsciiFormatter, format_packets
+from ooi_port_agent.packet import FakeClock, Packet
+from ooi_port_agent.router import Router
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data)
+
+
+class SmallFormatter(AsciiFormatter):
+    max_queue = 2
+
+
+class FormatterUnitTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock(start=3600000000.25, step=1)
+        self.delivered = []
+        self.formatter = AsciiFormatter(deliver=lambda func, *args: func(*args))
+
+    def create(self, payload, packet_type=PacketType.FROM_INSTRUMENT):
+        return Packet.create(payload, packet_type, clock=self.clock)[0]
+
+    def test_format_packets(self):
+        packets = [self.create('abc123'), self.create('HB', PacketType.PA_HEARTBEAT)]
+        expected = ('3600000000.2500 : FROM_INSTRUMENT :  CRC OK : \'abc123\'' + NEWLINE +
+                    '3600000001.2500 :    PA_HEARTBEAT :  CRC OK : \'HB\'' + NEWLINE)
+        self.assertEqual(format_packets(packets), expected)
+
+    def test_format_groups_clients(self):
+        first = FakeClient()
+        second = FakeClient()
+        both = (first, second)
+        packets = [self.create(str(i)) for i in xrange(4)]
+
+        self.formatter.format([(packets[0], both), (packets[1], both), (packets[2], (first,)), (packets[3], both)])
+
+        self.assertEqual(first.writes, [format_packets(packets[:2]), format_packets(packets[2:3]),
+                                        format_packets(packets[3:])])
+        self.assertEqual(second.writes, [format_packets(packets[:2]), format_packets(packets[3:])])
+
+    def test_drain_queue(self):
+        client = FakeClient()
+        packets = [self.create(str(i)) for i in xrange(100)]
+
+        for packet in packets:
+            self.formatter.queue.put([(packet, (client,))])
+        self.formatter.queue.put(None)
+        self.formatter.run()
+
+        self.assertEqual(''.join(client.writes), format_packets(packets))
+        self.assertEqual(len(client.writes), 1)
+
+    def test_full_queue_drops(self):
+        formatter = SmallFormatter(deliver=lambda func, *args: func(*args))
+        # a worker which never drains the queue
+        formatter.thread = threading.Thread()
+        client = FakeClient()
+        router = Router(formatter=formatter)
+        router.add_route(PacketType.FROM_INSTRUMENT, EndpointType.LOGGER, data_format=Format.ASCII)
+        router.register(EndpointType.LOGGER, client)
+
+        for index in xrange(4):
+            router.got_data([self.create(str(index)), self.create(str(index))])
+        self.assertEqual(formatter.queue.qsize(), 2)
+        self.assertEqual(formatter.dropped_batches, 2)
+        self.assertEqual(formatter.dropped_packets, 4)
+        self.assertEqual(router.ascii_dropped, 4)
+        router.stop()
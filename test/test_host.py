@@ -0,0 +1,208 @@
+import threading
+import unittest
+from twisted.internet import reactor
+from twisted.internet.task import Clock
+from ooi_port_agent.agents import DatalogReadingPortAgent, TcpPortAgent
+from ooi_port_agent.common import EndpointType, PacketType
+from ooi_port_agent.formatter import AsciiFormatter
+from ooi_port_agent.host import AgentHost, Scheduler, set_host
+from ooi_port_agent.packet import Packet
+from ooi_port_agent.port_agent import agent_configs
+
+
+class FakeConsul(object):
+    def __init__(self):
+        self.services = set()
+
+    def register_service(self, values, caller=''):
+        self.services.add(values['ID'])
+
+    def deregister_service(self, service_id, caller=''):
+        self.services.discard(service_id)
+
+    def pass_check(self, service_id, caller=''):
+        pass
+
+
+class FakeLogger(object):
+    def __init__(self):
+        self.writes = []
+        self.closed = False
+
+    def write(self, data):
+        self.writes.append(data)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeTransport(object):
+    def __init__(self, client):
+        self.client = client
+        self.writes_when_closed = None
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def loseConnection(self):
+        self.writes_when_closed = len(self.client.writes)
+
+
+class FakeSniffer(FakeLogger):
+    def __init__(self):
+        super(FakeSniffer, self).__init__()
+        self.transport = FakeTransport(self)
+
+
+class LoggingPortAgent(TcpPortAgent):
+    def _register_loggers(self):
+        self.data_logger = FakeLogger()
+        self.ascii_logger = FakeLogger()
+        self.router.register(EndpointType.DATALOGGER, self.data_logger)
+        self.router.register(EndpointType.LOGGER, self.ascii_logger)
+
+    def _start_inst_connection(self):
+        pass
+
+
+class UnreachablePortAgent(TcpPortAgent):
+    def _register_loggers(self):
+        pass
+
+    def _start_inst_connection(self):
+        raise RuntimeError('instrument unreachable')
+
+
+class SchedulerUnitTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.scheduler = Scheduler(clock=self.clock)
+        self.calls = []
+
+    def test_shared_timer(self):
+        first = lambda: self.calls.append('first')
+        second = lambda: self.calls.append('second')
+        self.scheduler.add(10, first)
+        self.scheduler.add(10, second)
+        self.assertEqual(len(self.scheduler.loops), 1)
+
+        self.clock.advance(10)
+        self.assertEqual(self.calls, ['first', 'second'])
+
+        self.scheduler.remove(10, first)
+        self.clock.advance(10)
+        self.assertEqual(self.calls, ['first', 'second', 'second'])
+
+        self.scheduler.remove(10, second)
+        self.assertEqual(self.scheduler.loops, {})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_failure_isolated(self):
+        def fail():
+            raise RuntimeError('boom')
+
+        self.scheduler.add(1, fail)
+        self.scheduler.add(1, lambda: self.calls.append('ok'))
+        self.clock.advance(1)
+        self.assertEqual(self.calls, ['ok'])
+        self.scheduler.stop()
+
+
+class AgentHostUnitTest(unittest.TestCase):
+    def test_shared_services(self):
+        scheduler = Scheduler(clock=Clock())
+        host = AgentHost(scheduler=scheduler, formatter=object(), consul=object())
+        agent = object()
+        host.add(agent)
+        host.remove(agent)
+        self.assertEqual(host.agents, [])
+
+
+class AgentStartUnitTest(unittest.TestCase):
+    def setUp(self):
+        self.consul = FakeConsul()
+        self.host = AgentHost(scheduler=Scheduler(clock=Clock()), formatter=AsciiFormatter(), consul=self.consul,
+                              log_writer=object())
+        set_host(self.host)
+        self.config = {'type': 'tcp', 'name': 'a', 'port': 0, 'commandport': 0, 'sniffport': 0, 'ttl': 30,
+                       'instaddr': '127.0.0.1', 'instport': 1}
+
+    def tearDown(self):
+        set_host(None)
+
+    def assertNothingStarted(self):
+        self.assertEqual(self.host.agents, [])
+        self.assertEqual(self.consul.services, set())
+        # no heartbeat or router statistics timers
+        self.assertEqual(self.host.scheduler.loops, {})
+
+    def test_invalid_config(self):
+        config = dict(self.config)
+        del config['instaddr']
+        self.assertRaises(KeyError, TcpPortAgent, config)
+        self.assertRaises(ValueError, DatalogReadingPortAgent, dict(self.config, type='datalog', files=[],
+                                                                    start='yesterday'))
+        self.assertNothingStarted()
+
+    def test_failed_start(self):
+        agent = UnreachablePortAgent(self.config)
+        self.assertRaises(RuntimeError, agent.start)
+        self.assertTrue(agent.stopped)
+        self.assertNothingStarted()
+        self.assertEqual(len(agent.listening_ports), 3)
+        self.assertTrue(all(port.disconnecting for port in agent.listening_ports))
+
+    def test_datalog_start(self):
+        agent = DatalogReadingPortAgent(dict(self.config, type='datalog', files=[], start='3600000000'))
+        self.assertEqual(agent.window_start, 3600000000)
+        agent.start()
+        self.assertEqual(self.host.agents, [agent])
+        agent.stop()
+        # no longer waiting for a client
+        for call in reactor.getDelayedCalls():
+            if call.func == agent._start_when_ready:
+                call.cancel()
+        self.assertTrue(agent.stopped)
+        self.assertEqual(self.consul.services, set())
+
+    def test_stop_drains_formatter(self):
+        formatter = AsciiFormatter(deliver=lambda func, *args: func(*args))
+        # a worker which is run below
+        formatter.thread = threading.Thread()
+        self.host.formatter = formatter
+        agent = LoggingPortAgent(self.config).start()
+        sniffer = FakeSniffer()
+        agent.router.register(EndpointType.LOGGER, sniffer)
+        agent.client_connected(sniffer)
+
+        agent.router.got_data(Packet.create('last words', PacketType.FROM_INSTRUMENT))
+        agent.stop()
+        # the ASCII output is still waiting for the formatter
+        self.assertFalse(agent.ascii_logger.closed)
+        self.assertIsNone(sniffer.transport.writes_when_closed)
+
+        formatter.queue.put(None)
+        formatter.run()
+        self.assertTrue(agent.ascii_logger.closed)
+        self.assertIn('last words', ''.join(agent.ascii_logger.writes))
+        self.assertIn('last words', ''.join(sniffer.writes))
+        self.assertEqual(sniffer.transport.writes_when_closed, len(sniffer.writes))
+
+
+class AgentConfigUnitTest(unittest.TestCase):
+    def test_single(self):
+        config = {'type': 'tcp', 'port': 1}
+        self.assertEqual(agent_configs(config), [config])
+
+    def test_multiple(self):
+        configs = agent_configs({'ttl': 5, 'agents': [{'type': 'tcp', 'name': 'a'},
+                                                      {'type': 'rsn', 'name': 'b', 'ttl': 7, 'refdes': 'R'}]})
+        self.assertEqual(configs[0], {'type': 'tcp', 'name': 'a', 'refdes': 'a', 'ttl': 5,
+                                      'port': 0, 'commandport': 0, 'sniffport': 0})
+        self.assertEqual(configs[1]['ttl'], 7)
+        self.assertEqual(configs[1]['refdes'], 'R')
+
+    def test_unique_names(self):
+        self.assertRaises(ValueError, agent_configs, {'agents': [{'type': 'tcp', 'name': 'a'},
+                                                                 {'type': 'tcp', 'name': 'a'}]})
+        self.assertRaises(ValueError, agent_configs, {'agents': [{'type': 'tcp'}]})
@@ -0,0 +1,142 @@
+import os
+import shutil
+import tempfile
+import unittest
+from ooi_port_agent.logwriter import BufferedLogFile, LogFile, LogWriter
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeProducer(object):
+    def __init__(self):
+        self.paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+class ManualLogWriter(LogWriter):
+    """
+    Runs the worker passes on demand in the test thread
+    """
+    def start(self):
+        self.thread = True
+
+    def run_once(self):
+        items = []
+        while not self.queue.empty():
+            items.append(self.queue.get_nowait())
+        self.process(items)
+        self.sync()
+
+
+class LogWriterUnitTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.clock = FakeClock()
+        self.writer = ManualLogWriter(deliver=lambda func, *args: func(*args), clock=self.clock)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def open(self, **kwargs):
+        return LogFile(BufferedLogFile('test.log', self.tempdir), self.writer, **kwargs)
+
+    def contents(self, name='test.log'):
+        with open(os.path.join(self.tempdir, name), 'rb') as fh:
+            return fh.read()
+
+    def test_group_commit(self):
+        log_file = self.open()
+        log_file.writeSequence(['ab', 'c'])
+        log_file.write('def')
+        self.assertEqual(log_file.stats()['queue_depth'], 2)
+        self.assertEqual(log_file.stats()['queued_bytes'], 6)
+
+        self.clock.now += 0.5
+        self.writer.run_once()
+        stats = log_file.stats()
+        self.assertEqual(stats['writes'], 1)
+        self.assertEqual(stats['bytes'], 6)
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertEqual(stats['write_latency'], 0.5)
+
+    def test_flush_interval(self):
+        log_file = self.open(flush_interval=2)
+        log_file.write('abc')
+        self.writer.run_once()
+        self.assertEqual(self.contents(), '')
+        self.assertEqual(self.writer.timeout(), 2)
+
+        self.clock.now += 2
+        self.writer.sync()
+        self.assertEqual(self.contents(), 'abc')
+        self.assertEqual(log_file.flushes, 1)
+        self.assertEqual(log_file.fsyncs, 0)
+        self.assertEqual(self.writer.timeout(), None)
+
+    def test_fsync_interval(self):
+        log_file = self.open(flush_interval=1, fsync_interval=5)
+        log_file.write('abc')
+        self.writer.run_once()
+        self.clock.now += 1
+        self.writer.sync()
+        self.assertEqual((log_file.flushes, log_file.fsyncs), (1, 0))
+        self.assertEqual(self.writer.timeout(), 4)
+
+        self.clock.now += 4
+        self.writer.sync()
+        self.assertEqual((log_file.flushes, log_file.fsyncs), (2, 1))
+        self.assertEqual(self.writer.dirty, set())
+
+    def test_pause_resume(self):
+        log_file = self.open(queue_bytes=10)
+        producer = FakeProducer()
+        log_file.registerProducer(producer, True)
+        log_file.write('x' * 8)
+        self.assertFalse(producer.paused)
+        log_file.write('x' * 8)
+        self.assertTrue(producer.paused)
+
+        self.writer.run_once()
+        self.assertFalse(producer.paused)
+        self.assertEqual(log_file.pauses, 1)
+
+    def test_close(self):
+        log_file = self.open()
+        log_file.write('abc')
+        log_file.close()
+        log_file.write('def')
+        self.writer.run_once()
+        self.assertEqual(self.contents(), 'abc')
+        self.assertTrue(log_file.log_file.closed)
+        self.assertEqual(self.writer.dirty, set())
+
+    def test_rotate(self):
+        log_file = self.open()
+        log_file.log_file.lastDate = (2000, 1, 1)
+        log_file.write('abc')
+        self.writer.run_once()
+        log_file.close()
+        self.writer.run_once()
+        self.assertEqual(self.contents('test.log.2000_1_1'), '')
+        self.assertEqual(self.contents(), 'abc')
+
+    def test_thread(self):
+        writer = LogWriter()
+        log_file = LogFile(BufferedLogFile('test.log', self.tempdir), writer)
+        for index in xrange(1000):
+            log_file.writeSequence(['%04d' % index, '\n'])
+        log_file.close()
+        writer.stop()
+        self.assertEqual(self.contents(), ''.join('%04d\n' % index for index in xrange(1000)))
+        self.assertEqual(log_file.stats()['bytes'], 5000)
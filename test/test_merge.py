@@ -0,0 +1,141 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from ooi_port_agent.common import PacketType
+from ooi_port_agent.datalog import FrameCompressor
+from ooi_port_agent.merge import ChunkDecoder, DatalogMerge
+from ooi_port_agent.packet import FakeClock, Packet
+
+
+class DatalogMergeUnitTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write(self, name, times, prefix=None, packet_type=PacketType.FROM_INSTRUMENT, compressed=False):
+        """
+        Write a datalog of one packet per time, its payload naming the file and time
+        """
+        path = os.path.join(self.tempdir, name)
+        data = []
+        for packet_time in times:
+            clock = FakeClock(start=packet_time)
+            payload = '%s %d' % (prefix or name, packet_time)
+            data.append(Packet.create(payload, packet_type, clock=clock)[0].data)
+        with open(path, 'wb') as fh:
+            if compressed:
+                compressor = FrameCompressor(frame_bytes=100)
+                fh.write(compressor.compress(data))
+                fh.write(compressor.end())
+            else:
+                fh.writelines(data)
+        return path
+
+    def payloads(self, merge):
+        return [packet.payload for packet in merge]
+
+    def test_chunks(self):
+        path = self.write('a.datalog', xrange(3600000000, 3600000100))
+        decoder = ChunkDecoder(path, start=3600000010, end=3600000019.5, chunk_bytes=100)
+        chunks = list(iter(decoder.next_chunk, None))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(''.join(chunks).count('a.datalog'), 10)
+        self.assertTrue(decoder.file_handle.closed)
+
+    def test_merge(self):
+        files = [self.write('a.datalog', xrange(3600000000, 3600000100, 3)),
+                 self.write('b.datalog.gz', xrange(3600000001, 3600000100, 2), compressed=True),
+                 self.write('c.datalog', xrange(3600000050, 3600000060))]
+        merge = DatalogMerge(files, processes=0, chunk_bytes=64)
+        times = [packet.header.time for packet in merge]
+        self.assertEqual(times, sorted(times))
+        self.assertEqual(len(times), 34 + 50 + 10)
+        self.assertEqual(merge.packets, len(times))
+
+    def test_ties_in_file_order(self):
+        files = [self.write('a.datalog', [3600000000, 3600000001]),
+                 self.write('b.datalog', [3600000000, 3600000000, 3600000001], prefix='b')]
+        self.assertEqual(self.payloads(DatalogMerge(files, processes=0)),
+                         ['a.datalog 3600000000', 'b 3600000000', 'b 3600000000', 'a.datalog 3600000001',
+                          'b 3600000001'])
+
+    def test_dedupe(self):
+        # overlapping captures of the same port
+        files = [self.write('a.datalog', xrange(3600000000, 3600000020), prefix='port'),
+                 self.write('b.datalog', xrange(3600000010, 3600000030), prefix='port')]
+        merge = DatalogMerge(files, processes=0, dedupe=True)
+        self.assertEqual(self.payloads(merge), ['port %d' % each for each in xrange(3600000000, 3600000030)])
+        self.assertEqual(merge.duplicates, 10)
+        self.assertEqual(len(list(DatalogMerge(files, processes=0))), 40)
+
+    def test_window_and_types(self):
+        files = [self.write('a.datalog', xrange(3600000000, 3600000100)),
+                 self.write('b.datalog', xrange(3600000000, 3600000100), packet_type=PacketType.PA_STATUS),
+                 self.write('c.datalog', xrange(3600000200, 3600000300))]
+        merge = DatalogMerge(files, start=3600000010, end=3600000019, processes=0,
+                             packet_types=[PacketType.FROM_INSTRUMENT])
+        self.assertEqual(self.payloads(merge), ['a.datalog %d' % each for each in xrange(3600000010, 3600000020)])
+
+    def test_unreadable(self):
+        files = [self.write('a.datalog', xrange(3600000000, 3600000010)), os.path.join(self.tempdir, 'missing')]
+        merge = DatalogMerge(files, processes=0)
+        self.assertEqual(len(list(merge)), 10)
+        self.assertEqual(merge.errors, 1)
+
+    def test_processes(self):
+        files = [self.write('%02d.datalog' % index, xrange(3600000000 + index, 3600001000, 7),
+                            compressed=index % 2 == 1)
+                 for index in xrange(7)]
+        expected = self.payloads(DatalogMerge(files, processes=0, chunk_bytes=256))
+        merge = DatalogMerge(files, processes=3, chunk_bytes=256)
+        self.assertEqual(self.payloads(merge), expected)
+        self.assertEqual(len(expected), 1000)
+        self.assertEqual(merge.pool.workers, [])
+
+    def test_ready(self):
+        files = [self.write('%02d.datalog' % index, xrange(3600000000 + index, 3600001000, 7))
+                 for index in xrange(4)]
+        expected = self.payloads(DatalogMerge(files, processes=0, chunk_bytes=256))
+        merge = DatalogMerge(files, processes=2, chunk_bytes=256)
+        merge.start()
+
+        def wait():
+            raise AssertionError('Merged a packet which was not ready')
+
+        # packets are only taken while ready, the merge never waits on a worker
+        merge.pool._receive = wait
+        packets = iter(merge)
+        payloads = []
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            if not merge.ready():
+                time.sleep(0.001)
+                continue
+            packet = next(packets, None)
+            if packet is None:
+                break
+            payloads.append(packet.payload)
+        self.assertEqual(payloads, expected)
+        self.assertEqual(merge.pool.workers, [])
+
+    def test_close(self):
+        files = [self.write('%02d.datalog' % index, xrange(3600000000 + index, 3600010000, 4))
+                 for index in xrange(4)]
+        merge = DatalogMerge(files, processes=4, chunk_bytes=16384, prefetch=8)
+        packets = iter(merge)
+        next(packets)
+        workers = list(merge.pool.workers)
+        # let the workers fill the results pipe
+        time.sleep(0.5)
+        started = time.time()
+        merge.close()
+        self.assertLess(time.time() - started, 0.5)
+        self.assertEqual(merge.pool.workers, [])
+        deadline = time.time() + 5
+        while any(worker.is_alive() for worker in workers) and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(any(worker.is_alive() for worker in workers))
@@ -0,0 +1,83 @@
+import json
+import unittest
+from ooi_port_agent import metrics
+from ooi_port_agent.common import EndpointType, Format, PacketType
+from ooi_port_agent.packet import FakeClock, Packet
+from ooi_port_agent.router import Router
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data)
+
+
+class FakePortAgent(object):
+    def __init__(self):
+        self.name = 'test "agent"'
+        self.refdes = 'REFDES'
+        self.router = Router()
+        self.connections = set()
+        self.clients = set()
+        self.loggers = []
+        self.instrument_connects = 2
+        self.instrument_disconnects = 1
+        self.client_connects = 0
+        self.client_disconnects = 0
+
+
+class MetricsUnitTest(unittest.TestCase):
+    def setUp(self):
+        self.agent = FakePortAgent()
+        self.router = self.agent.router
+        self.router.add_route(PacketType.FROM_INSTRUMENT, EndpointType.CLIENT, data_format=Format.PACKET)
+        self.first = FakeClient()
+        self.second = FakeClient()
+        self.router.register(EndpointType.CLIENT, self.first)
+        self.router.register(EndpointType.CLIENT, self.second)
+
+        clock = FakeClock(start=3600000000, step=1)
+        self.packets = Packet.create('abc', PacketType.FROM_INSTRUMENT, clock=clock)
+        self.packets += Packet.create('defg', PacketType.FROM_INSTRUMENT, clock=clock)
+        self.router.got_data(self.packets)
+        self.router.deregister(EndpointType.CLIENT, self.second)
+
+    def test_collect(self):
+        stats = metrics.collect(self.agent)
+        self.assertEqual(stats['packet_types']['FROM_INSTRUMENT'],
+                         {'packets_in': 2, 'bytes_in': 39, 'packets_out': 4, 'bytes_out': 78})
+        self.assertEqual(stats['packet_types']['PA_STATUS']['packets_in'], 0)
+
+        # the deregistered client is still counted for its endpoint type
+        client = stats['endpoint_types'][EndpointType.CLIENT]
+        self.assertEqual(client['endpoints'], 2)
+        self.assertEqual(client['chunks'], 4)
+        self.assertEqual(client['bytes'], 78)
+        self.assertEqual(client['writes'], 2)
+        self.assertEqual(stats['router']['writes_saved'], 2)
+        self.assertEqual(stats['router']['ascii_dropped'], 0)
+
+        self.assertEqual(len(stats['endpoints']), 1)
+        self.assertEqual(stats['endpoints'][0]['bytes'], 39)
+        self.assertEqual(stats['connections']['instrument_connects'], 2)
+
+        self.assertEqual(json.loads(metrics.format_json(stats))['refdes'], 'REFDES')
+
+    def test_prometheus(self):
+        text = metrics.format_prometheus(metrics.collect(self.agent))
+        lines = text.splitlines()
+        self.assertIn('# TYPE port_agent_packets_in_total counter', lines)
+        self.assertIn('port_agent_packets_in_total{agent="test \\"agent\\"",packet_type="FROM_INSTRUMENT"} 2', lines)
+        self.assertIn('port_agent_endpoint_bytes_total{agent="test \\"agent\\"",endpoint_type="client"} 78', lines)
+        self.assertIn('port_agent_instrument_disconnects_total{agent="test \\"agent\\""} 1', lines)
+        self.assertTrue(text.endswith('\n'))
+
+    def test_prometheus_many_agents(self):
+        first = metrics.collect(self.agent)
+        second = dict(first, name='second')
+        lines = metrics.format_prometheus([first, second]).splitlines()
+        self.assertEqual(lines.count('# TYPE port_agent_packets_in_total counter'), 1)
+        self.assertIn('port_agent_packets_in_total{agent="second",packet_type="FROM_INSTRUMENT"} 2', lines)
+        self.assertIn('port_agent_packets_in_total{agent="test \\"agent\\"",packet_type="FROM_INSTRUMENT"} 2', lines)
@@ -0,0 +1,149 @@
+import unittest
+from ooi_port_agent.common import EndpointType, OutputPolicy
+from ooi_port_agent.output import Output
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.producer = None
+        self.aborted = False
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def abortConnection(self):
+        self.aborted = True
+
+
+class FakeEndpoint(object):
+    def __init__(self):
+        self.transport = FakeTransport()
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data)
+
+
+class FakeUpstream(object):
+    def __init__(self):
+        self.paused = set()
+
+    def output_paused(self, output):
+        self.paused.add(output)
+        return True
+
+    def output_resumed(self, output):
+        self.paused.discard(output)
+
+
+class OutputUnitTest(unittest.TestCase):
+    def create(self, policy, budget=10):
+        self.endpoint = FakeEndpoint()
+        self.upstream = FakeUpstream()
+        return Output(self.endpoint, EndpointType.CLIENT, policy=policy, budget=budget, upstream=self.upstream)
+
+    def test_default_policy(self):
+        self.assertEqual(Output(FakeEndpoint(), EndpointType.CLIENT).policy, OutputPolicy.PAUSE)
+        self.assertEqual(Output(FakeEndpoint(), EndpointType.LOGGER).policy, OutputPolicy.DROP_OLDEST)
+        self.assertRaises(ValueError, Output, FakeEndpoint(), EndpointType.CLIENT, policy='bogus')
+
+    def test_registers_producer(self):
+        output = self.create(OutputPolicy.PAUSE)
+        self.assertIs(self.endpoint.transport.producer, output)
+
+    def test_pause(self):
+        output = self.create(OutputPolicy.PAUSE, budget=100)
+        output.pauseProducing()
+        self.assertEqual(self.upstream.paused, {output})
+
+        # data is still written under the PAUSE policy
+        output.write('abcdefghijkl')
+        self.assertEqual(self.endpoint.writes, ['abcdefghijkl'])
+        self.assertEqual(output.buffered, 12)
+        self.assertEqual(output.high_water, 12)
+
+        output.resumeProducing()
+        self.assertEqual(self.upstream.paused, set())
+        self.assertEqual(output.pauses, 1)
+        self.assertEqual(output.buffered, 0)
+
+    def test_pause_over_budget(self):
+        output = self.create(OutputPolicy.PAUSE)
+        output.pauseProducing()
+        output.write('1234')
+        self.assertFalse(self.endpoint.transport.aborted)
+        output.write('56789abc')
+        self.assertTrue(self.endpoint.transport.aborted)
+        self.assertTrue(output.disconnected)
+
+    def test_pause_without_upstream(self):
+        # nothing upstream to pause, the endpoint is bounded as DISCONNECT
+        output = Output(FakeEndpoint(), EndpointType.CLIENT, policy=OutputPolicy.PAUSE, budget=10)
+        output.pauseProducing()
+        self.assertEqual(output.paused_policy, OutputPolicy.DISCONNECT)
+        output.write('1234')
+        self.assertEqual(output.endpoint.writes, [])
+        self.assertEqual(output.held_bytes, 4)
+        self.assertTrue(output._disconnect_call.active())
+        output.resumeProducing()
+        self.assertEqual(output.endpoint.writes, ['1234'])
+        self.assertIsNone(output._disconnect_call)
+
+    def test_drop_oldest(self):
+        output = self.create(OutputPolicy.DROP_OLDEST)
+        output.pauseProducing()
+        for data in ('1234', '5678', 'abcd'):
+            output.write(data)
+        self.assertEqual(self.endpoint.writes, [])
+        self.assertEqual(output.held_bytes, 8)
+        self.assertEqual(output.dropped_chunks, 1)
+        self.assertEqual(output.dropped_bytes, 4)
+        self.assertEqual(output.high_water, 8)
+
+        output.resumeProducing()
+        self.assertEqual(self.endpoint.writes, ['5678abcd'])
+        self.assertEqual(output.held_bytes, 0)
+        self.assertEqual(self.upstream.paused, set())
+
+    def test_drop_newest(self):
+        output = self.create(OutputPolicy.DROP_NEWEST)
+        output.pauseProducing()
+        for data in ('1234', '5678', 'abcd'):
+            output.write(data)
+
+        output.resumeProducing()
+        self.assertEqual(self.endpoint.writes, ['12345678'])
+        self.assertEqual(output.dropped_bytes, 4)
+
+    def test_disconnect_over_budget(self):
+        output = self.create(OutputPolicy.DISCONNECT)
+        output.pauseProducing()
+        output.write('1234')
+        self.assertFalse(self.endpoint.transport.aborted)
+        output.write('56789abc')
+        self.assertTrue(self.endpoint.transport.aborted)
+        self.assertTrue(output.disconnected)
+        self.assertEqual(output.held_bytes, 0)
+        self.assertIsNone(output._disconnect_call)
+
+    def test_disconnect_grace(self):
+        output = self.create(OutputPolicy.DISCONNECT)
+        output.pauseProducing()
+        self.assertTrue(output._disconnect_call.active())
+        output.resumeProducing()
+        self.assertIsNone(output._disconnect_call)
+
+        output.pauseProducing()
+        output._disconnect_call.func()
+        self.assertTrue(self.endpoint.transport.aborted)
+
+    def test_close(self):
+        output = self.create(OutputPolicy.PAUSE)
+        output.pauseProducing()
+        output.stopProducing()
+        self.assertFalse(output.paused)
+        self.assertEqual(self.upstream.paused, set())
+
+        # late writes from the formatter thread are dropped
+        output.write('abc')
+        self.assertEqual(self.endpoint.writes, [])
@@ -1,7 +1,10 @@
+import time
 import unittest
 from StringIO import StringIO
+from ooi_port_agent import packet
 from ooi_port_agent.common import PacketType
-from ooi_port_agent.packet import Packet, PacketHeader, InvalidHeaderException
+from ooi_port_agent.packet import Packet, PacketHeader, PacketBatch, PacketDecoder, PacketReader
+from ooi_port_agent.packet import FakeClock, NtpClock, PacketAssembler, InvalidHeaderException
 
 
 class PacketUnitTest(unittest.TestCase):
@@ -19,7 +22,7 @@ class PacketUnitTest(unittest.TestCase):
         self.assertTrue(packet.valid)
         self.assertNotEqual(packet.header.time, 0)
 
-    def test_packet_from_buffer(self):
+    def test_packet_from_decoder(self):
         # create a packet
         payload = 'abc123'
         packet_type = PacketType.FROM_INSTRUMENT
@@ -27,17 +30,20 @@ class PacketUnitTest(unittest.TestCase):
         # get the packet contents as a string
         data_buffer = packet.data
         # create a new packet from the buffer
-        packet, data_buffer = Packet.packet_from_buffer(data_buffer)
+        decoder = PacketDecoder()
+        packets = decoder.feed(data_buffer)
 
+        self.assertEqual(len(packets), 1)
+        packet = packets[0]
         self.assertEqual(packet.payload, payload)
         self.assertEqual(packet.header.packet_type, packet_type)
         self.assertEqual(packet.header.payload_size, len(payload))
         self.assertTrue(packet.valid)
         self.assertNotEqual(packet.header.time, 0)
         # Verify there is no data left
-        self.assertEqual(data_buffer, '')
+        self.assertEqual(decoder.pending, 0)
 
-    def test_multiple_packets_from_buffer(self):
+    def test_multiple_packets_from_decoder(self):
         data_buffer = ''
         payload = 'abc123'
         packet_type = PacketType.FROM_INSTRUMENT
@@ -48,11 +54,11 @@ class PacketUnitTest(unittest.TestCase):
             # get the packet contents as a string
             data_buffer += packet.data
 
-        while True:
-            packet, data_buffer = Packet.packet_from_buffer(data_buffer)
-            if packet is None:
-                break
+        decoder = PacketDecoder()
+        packets = decoder.feed(data_buffer)
+        self.assertEqual(len(packets), 3)
 
+        for packet in packets:
             self.assertEqual(packet.payload, payload)
             self.assertEqual(packet.header.packet_type, packet_type)
             self.assertEqual(packet.header.payload_size, len(payload))
@@ -60,9 +66,9 @@ class PacketUnitTest(unittest.TestCase):
             self.assertNotEqual(packet.header.time, 0)
 
         # Verify there is no data left
-        self.assertEqual(data_buffer, '')
+        self.assertEqual(decoder.pending, 0)
 
-    def test_multiple_packets_from_buffer_with_junk(self):
+    def test_multiple_packets_from_decoder_with_junk(self):
         data_buffer = ''
         payload = 'abc123'
         packet_type = PacketType.FROM_INSTRUMENT
@@ -74,20 +80,53 @@ class PacketUnitTest(unittest.TestCase):
             # get the packet contents as a string
             data_buffer += packet.data + junk
 
-        while True:
-            packet, data_buffer = Packet.packet_from_buffer(data_buffer)
-            if packet is None:
-                break
+        decoder = PacketDecoder()
+        packets = decoder.feed(data_buffer)
+        self.assertEqual(len(packets), 3)
 
+        for packet in packets:
             self.assertEqual(packet.payload, payload)
             self.assertEqual(packet.header.packet_type, packet_type)
             self.assertEqual(packet.header.payload_size, len(payload))
             self.assertTrue(packet.valid)
             self.assertNotEqual(packet.header.time, 0)
-            self.assertIn(junk, data_buffer)
 
-        # Verify there is no data left
-        self.assertEqual(data_buffer, junk)
+        # Verify all the junk was skipped or is still pending
+        self.assertEqual(decoder.bytes_skipped + decoder.pending, len(junk) * 3)
+
+    def test_decoder_split_packets(self):
+        data_buffer = ''
+        payloads = ['abc123', 'x' * 1000, '', 'def456']
+        packet_type = PacketType.FROM_INSTRUMENT
+
+        for payload in payloads:
+            data_buffer += Packet.create(payload, packet_type)[0].data
+
+        # feed the stream one byte at a time
+        decoder = PacketDecoder()
+        packets = []
+        for byte in data_buffer:
+            packets.extend(decoder.feed(byte))
+
+        self.assertEqual([packet.payload for packet in packets], payloads)
+        self.assertTrue(all(packet.valid for packet in packets))
+        self.assertEqual(decoder.pending, 0)
+        self.assertEqual(decoder.bytes_skipped, 0)
+
+    def test_decoder_offsets(self):
+        payload = 'abc123'
+        packet_type = PacketType.FROM_INSTRUMENT
+        junk = 'kj34jk3h45'
+        data = Packet.create(payload, packet_type)[0].data
+
+        decoder = PacketDecoder()
+        decoder.compact_threshold = 1
+        first = decoder.decode(junk + data)
+        second = decoder.decode(junk + data)
+
+        self.assertEqual([offset for offset, _ in first], [len(junk)])
+        self.assertEqual([offset for offset, _ in second], [len(junk) * 2 + len(data)])
+        self.assertEqual(decoder.bytes_skipped, len(junk) * 2)
 
     def test_packet_from_fh(self):
         # create a packet
@@ -130,12 +169,117 @@ class PacketUnitTest(unittest.TestCase):
             self.assertNotEqual(packet.header.time, 0)
             self.assertIn(junk, data_buffer)
 
+    def test_decoder_verify(self):
+        junk = 'kj34jk3h45'
+        payload = 'abc123'
+        packet_type = PacketType.FROM_INSTRUMENT
+        data = Packet.create(payload, packet_type)[0].data
+        bad = data[:-2] + 'ZZ'
+        # plausible header claiming a much larger packet
+        fake = PacketHeader.sync + '\x01\xff\x00\x00\x01' + 'z' * 8
+
+        decoder = PacketDecoder(verify=True)
+        packets = decoder.feed(junk + bad + data)
+        packets.extend(decoder.feed(fake + data))
+        self.assertEqual(len(packets), 1)
+
+        # the false sync holds back the stream until it can be verified
+        packets.extend(decoder.feed('x' * 0xff00))
+        self.assertEqual([packet.payload for packet in packets], [payload, payload])
+        self.assertEqual(decoder.resyncs, 2)
+        self.assertEqual(decoder.bad_checksums, 2)
+
+    def test_decoder_verify_split(self):
+        payloads = ['abc123', 'x' * 1000, '', 'def456']
+        packet_type = PacketType.FROM_INSTRUMENT
+        data_buffer = ''.join(Packet.create(payload, packet_type)[0].data for payload in payloads)
+
+        decoder = PacketDecoder(verify=True)
+        decoder.compact_threshold = 1
+        packets = []
+        for byte in data_buffer:
+            packets.extend(decoder.feed(byte))
+
+        self.assertEqual([packet.payload for packet in packets], payloads)
+        self.assertEqual(decoder.resyncs, 0)
+        self.assertEqual(decoder.pending, 0)
+
+    def test_packet_reader(self):
+        data_buffer = ''
+        offsets = []
+        payloads = ['abc123', 'x' * 1000, '', 'def456']
+        packet_type = PacketType.FROM_INSTRUMENT
+        junk = 'kj34jk3h45'
+
+        for payload in payloads:
+            data_buffer += junk
+            offsets.append(len(data_buffer))
+            data_buffer += Packet.create(payload, packet_type)[0].data
+
+        # use a block size which forces packets to straddle block boundaries
+        reader = PacketReader(StringIO(data_buffer), block_size=7)
+        records = list(reader.packets_with_offsets())
+
+        self.assertEqual([offset for offset, _ in records], offsets)
+        self.assertEqual([packet.payload for _, packet in records], payloads)
+        self.assertTrue(all(packet.valid for _, packet in records))
+        self.assertEqual(reader.offset, offsets[-1])
+        self.assertEqual(reader.bytes_skipped, len(junk) * len(payloads))
+
+    def test_packet_reader_truncated(self):
+        payload = 'abc123'
+        packet_type = PacketType.FROM_INSTRUMENT
+        data = Packet.create(payload, packet_type)[0].data
+
+        reader = PacketReader(StringIO(data + data[:-1]))
+        packets = list(reader)
+
+        self.assertEqual([packet.payload for packet in packets], [payload])
+        self.assertEqual(reader.pending, len(data) - 1)
+
+    def test_create_with_clock(self):
+        clock = FakeClock(start=3600000000.5, step=1)
+        first = Packet.create('abc123', PacketType.FROM_INSTRUMENT, clock=clock)[0]
+        second = Packet.create('abc123', PacketType.FROM_INSTRUMENT, clock=clock)[0]
+
+        self.assertEqual((first.header.ts_high, first.header.ts_low), (3600000000, 2 ** 31))
+        self.assertEqual((second.header.ts_high, second.header.ts_low), (3600000001, 2 ** 31))
+        self.assertEqual(first.header.time, 3600000000.5)
+        self.assertTrue(first.valid)
+
+    def test_ntp_clock(self):
+        ts_high, ts_low = NtpClock().now()
+        self.assertIsInstance(ts_low, int)
+        self.assertAlmostEqual(ts_high + ts_low / 2.0 ** 32, time.time() + NtpClock.ntp_delta, delta=1)
+
+    def test_ntp_clock_reanchor(self):
+        timer = FakeClock(start=100)
+        clock = NtpClock(timer=lambda: timer.time)
+        offset = clock._offset
+
+        timer.time += NtpClock.reanchor_interval - 1
+        clock.now()
+        self.assertEqual(clock._offset, offset)
+
+        timer.time += 1
+        clock.now()
+        self.assertNotEqual(clock._offset, offset)
+
     def test_create_invalid_header(self):
         packet_type = PacketType.FROM_INSTRUMENT
         self.assertRaises(InvalidHeaderException, PacketHeader, packet_type=packet_type, payload_size=10)
         self.assertRaises(InvalidHeaderException, PacketHeader,
                           packet_type=packet_type, payload_size=10, ts_high=4, packet_time=5)
 
+    def test_header_round_trip(self):
+        packet = Packet.create('abc123', PacketType.FROM_INSTRUMENT)[0]
+        header = PacketHeader.from_buffer(packet.data)
+
+        self.assertEqual(repr(header), repr(packet.header))
+        self.assertEqual(header.time, packet.header.time)
+        self.assertFalse(hasattr(header, '__dict__'))
+        self.assertFalse(hasattr(packet, '__dict__'))
+
     def test_bad_crc(self):
         # create a packet
         payload = 'abc123'
@@ -148,7 +292,7 @@ class PacketUnitTest(unittest.TestCase):
         data_buffer = data_buffer[:-2] + 'ZZ'
 
         # create a new packet from the buffer
-        packet, _ = Packet.packet_from_buffer(data_buffer)
+        packet = PacketDecoder().feed(data_buffer)[0]
 
         # make sure the packet is marked invalid and contains our corrupted payload
         self.assertFalse(packet.valid)
@@ -175,3 +319,91 @@ class PacketUnitTest(unittest.TestCase):
         self.assertEqual(packets[0].payload, payload1)
         self.assertEqual(packets[1].payload, payload2)
         self.assertEqual(packets[0].header.time, packets[1].header.time)
+
+    def test_fragmented_packet(self):
+        payload = bytearray('x' * Packet.max_payload * 3 + 'abcabc')
+        packets = Packet.create(payload, PacketType.FROM_INSTRUMENT)
+
+        self.assertEqual(len(packets), 4)
+        self.assertEqual([len(packet.payload) for packet in packets], [Packet.max_payload] * 3 + [6])
+        self.assertTrue(all(isinstance(packet.payload, str) for packet in packets))
+        self.assertTrue(all(packet.valid for packet in packets))
+
+    def test_reassemble(self):
+        clock = FakeClock(start=3600000000, step=1)
+        large = 'x' * Packet.max_payload * 2 + 'abcabc'
+        exact = 'y' * Packet.max_payload
+        packets = []
+        packets.extend(Packet.create(large, PacketType.FROM_INSTRUMENT, clock=clock))
+        packets.extend(Packet.create('abc123', PacketType.FROM_INSTRUMENT, clock=clock))
+        packets.extend(Packet.create(exact, PacketType.FROM_INSTRUMENT, clock=clock))
+        data_buffer = ''.join(packet.data for packet in packets)
+
+        assembler = PacketAssembler()
+        messages = []
+        # split the stream so chains span multiple reads
+        decoder = PacketDecoder()
+        for index in xrange(0, len(data_buffer), 10000):
+            messages.extend(assembler.feed(decoder.feed(data_buffer[index:index + 10000])))
+
+        self.assertEqual([payload for _, payload in messages], [large, 'abc123', exact])
+        self.assertEqual([header.ts_high for header, _ in messages], [3600000000, 3600000001, 3600000002])
+        self.assertEqual(assembler.pending, 0)
+        self.assertEqual(assembler.broken_chains, 0)
+
+    def test_reassemble_interleaved(self):
+        clock = FakeClock(start=3600000000, step=1)
+        large = 'x' * Packet.max_payload + 'abcabc'
+        first = Packet.create(large, PacketType.FROM_INSTRUMENT, clock=clock)
+        status = Packet.create('status', PacketType.PA_STATUS, clock=clock)
+        truncated = Packet.create(large, PacketType.FROM_INSTRUMENT, clock=clock)[:1]
+        second = Packet.create('abc123', PacketType.FROM_INSTRUMENT, clock=clock)
+
+        assembler = PacketAssembler()
+        messages = assembler.feed(first[:1] + status + first[1:] + truncated + second)
+
+        self.assertEqual([payload for _, payload in messages], ['status', large, 'x' * Packet.max_payload, 'abc123'])
+        self.assertEqual(assembler.broken_chains, 1)
+
+    def test_packet_batch(self):
+        payloads = ['abc123', '', 'x' * 1000]
+        packet_type = PacketType.FROM_INSTRUMENT
+        batch = PacketBatch(payloads, packet_type)
+
+        self.assertEqual(len(batch), len(payloads))
+        self.assertEqual(batch.raw, ''.join(payloads))
+
+        packets = PacketDecoder().feed(batch.data)
+        self.assertEqual([packet.payload for packet in packets], payloads)
+        self.assertTrue(all(packet.valid for packet in packets))
+        self.assertEqual(''.join(packet.data for packet in packets), batch.data)
+        self.assertEqual(''.join(packet.data for packet in batch), batch.data)
+
+        for index, packet in enumerate(packets):
+            self.assertEqual(batch.wire(index).tobytes(), packet.data)
+            self.assertEqual(batch.payload(index).tobytes(), packet.payload)
+
+    def test_packet_batch_fragments(self):
+        payload1 = 'x' * Packet.max_payload
+        payload2 = 'abcabc'
+        packet_type = PacketType.FROM_INSTRUMENT
+        batch = PacketBatch([payload1, payload1 + payload2], packet_type)
+
+        self.assertEqual(batch.payloads, [payload1, '', payload1, payload2])
+        self.assertEqual(batch.data, ''.join(packet.data for packet in batch))
+        self.assertTrue(all(packet.valid for packet in batch))
+
+
+class PurePythonPacketUnitTest(PacketUnitTest):
+    """
+    Repeat the packet tests using the pure python codec
+    """
+    def setUp(self):
+        self.codec = packet.encode_header, packet.scan_buffer, packet.scan_verified, packet.xor_prefix
+        packet.encode_header = packet.py_encode_header
+        packet.scan_buffer = packet.py_scan_buffer
+        packet.scan_verified = packet.py_scan_verified
+        packet.xor_prefix = packet.py_xor_prefix
+
+    def tearDown(self):
+        packet.encode_header, packet.scan_buffer, packet.scan_verified, packet.xor_prefix = self.codec
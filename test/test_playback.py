@@ -0,0 +1,145 @@
+import unittest
+from twisted.internet.task import Clock
+from ooi_port_agent.common import EndpointType, Format, PacketType
+from ooi_port_agent.packet import FakeClock, Packet
+from ooi_port_agent.playback import Playback, parse_speed
+from ooi_port_agent.router import Router
+
+
+class FakeTransport(object):
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+
+class FakeClient(object):
+    """
+    Client whose transport buffer fills after a number of writes
+    """
+    def __init__(self):
+        self.transport = FakeTransport()
+        self.writes = []
+        self.pause_after = None
+
+    def write(self, data):
+        self.writes.append(data)
+        if len(self.writes) == self.pause_after:
+            self.transport.producer.pauseProducing()
+
+
+class PlaybackUnitTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.router = Router()
+        self.router.add_route(PacketType.FROM_INSTRUMENT, EndpointType.CLIENT, data_format=Format.PACKET)
+        self.client = FakeClient()
+        self.router.register(EndpointType.CLIENT, self.client)
+        self.done = []
+
+    def packets(self, count, step=1):
+        clock = FakeClock(start=3600000000, step=step)
+        return [Packet.create('%04d' % index, PacketType.FROM_INSTRUMENT, clock=clock)[0]
+                for index in xrange(count)]
+
+    def playback(self, count, step=1, **kwargs):
+        packets = self.packets(count, step)
+        playback = Playback(self.router, iter(packets), clock=self.clock, done=lambda: self.done.append(True),
+                            **kwargs)
+        self.router.registerProducer(playback)
+        playback.start()
+        return playback
+
+    def test_parse_speed(self):
+        self.assertEqual(parse_speed(None), None)
+        self.assertEqual(parse_speed('max'), None)
+        self.assertEqual(parse_speed(0), None)
+        self.assertEqual(parse_speed('realtime'), 1.0)
+        self.assertEqual(parse_speed('10x'), 10.0)
+        self.assertEqual(parse_speed(2.5), 2.5)
+        self.assertRaises(ValueError, parse_speed, 'fast')
+
+    def test_unthrottled(self):
+        playback = self.playback(25, batch_packets=10)
+        self.clock.advance(0)
+        self.assertEqual(playback.packets_sent, 25)
+        self.assertEqual(playback.batches, 3)
+        self.assertEqual(len(self.client.writes), 3)
+        self.assertEqual(self.done, [True])
+
+    def test_batch_bytes(self):
+        playback = self.playback(10, batch_bytes=40)
+        self.clock.advance(0)
+        # 20 byte packets
+        self.assertEqual(playback.batches, 5)
+
+    def test_pause(self):
+        # the client transport buffer fills, the PAUSE policy pauses the router producers
+        self.client.pause_after = 1
+        playback = self.playback(30, batch_packets=10)
+        self.clock.advance(0)
+        self.assertTrue(playback.paused)
+        self.clock.advance(1)
+        self.assertEqual(playback.packets_sent, 10)
+
+        self.client.pause_after = 2
+        self.client.transport.producer.resumeProducing()
+        self.clock.advance(0)
+        self.assertEqual(playback.packets_sent, 20)
+
+    def test_speed(self):
+        playback = self.playback(10, step=1, speed=2)
+        self.clock.advance(0)
+        self.assertEqual(playback.packets_sent, 1)
+        self.clock.advance(0.5)
+        self.assertEqual(playback.packets_sent, 2)
+        self.clock.advance(2)
+        self.assertEqual(playback.packets_sent, 6)
+        self.clock.advance(2)
+        self.assertEqual(playback.packets_sent, 10)
+        self.assertEqual(self.done, [True])
+
+    def test_speed_resume(self):
+        self.client.pause_after = 1
+        playback = self.playback(10, step=1, speed=1)
+        self.clock.advance(0)
+        self.clock.advance(100)
+        playback.resumeProducing()
+        # paced again from the resume, not caught up in a burst
+        self.clock.advance(0)
+        self.assertEqual(playback.packets_sent, 2)
+        self.clock.advance(1)
+        self.assertEqual(playback.packets_sent, 3)
+
+    def test_ready(self):
+        ready = [False]
+        playback = self.playback(10, ready=lambda: ready[0], poll_interval=0.5)
+        self.clock.advance(0)
+        self.assertEqual(playback.packets_sent, 0)
+        ready[0] = True
+        self.clock.advance(0.5)
+        self.assertEqual(playback.packets_sent, 10)
+        self.assertEqual(self.done, [True])
+
+    def test_failure(self):
+        def packets():
+            for packet in self.packets(5):
+                yield packet
+            raise RuntimeError('decoder died')
+
+        playback = Playback(self.router, packets(), clock=self.clock, done=lambda: self.done.append(True))
+        self.router.registerProducer(playback)
+        playback.start()
+        self.clock.advance(0)
+        self.assertTrue(playback.failed)
+        self.assertEqual(playback.packets_sent, 5)
+        self.assertEqual(self.done, [True])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_stop(self):
+        self.client.pause_after = 1
+        playback = self.playback(30, batch_packets=10)
+        self.clock.advance(0)
+        playback.stopProducing()
+        playback.resumeProducing()
+        self.clock.advance(1)
+        self.assertEqual(playback.packets_sent, 10)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
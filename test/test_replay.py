@@ -0,0 +1,130 @@
+import unittest
+from twisted.internet import reactor
+from twisted.internet.testing import StringTransport
+from ooi_port_agent.agents import DatalogReadingPortAgent
+from ooi_port_agent.common import EndpointType, Format, PacketType
+from ooi_port_agent.packet import FakeClock, Packet, PacketBatch, PacketDecoder
+from ooi_port_agent.protocols import ReplayClientProtocol
+from ooi_port_agent.replay import ReplayRing
+from ooi_port_agent.router import Router
+
+
+class FakePortAgent(object):
+    def __init__(self):
+        self.router = Router()
+        self.router.add_route(PacketType.FROM_INSTRUMENT, EndpointType.CLIENT, data_format=Format.PACKET)
+        self.router.add_route(PacketType.FROM_DRIVER, EndpointType.INSTRUMENT, data_format=Format.RAW)
+        self.replay = ReplayRing()
+        self.router.register(EndpointType.CLIENT, self.replay)
+        self.clients = set()
+
+    def client_connected(self, connection):
+        self.clients.add(connection)
+
+    def client_disconnected(self, connection):
+        self.clients.remove(connection)
+
+
+class FakePlayback(object):
+    started = False
+
+    def start(self):
+        self.started = True
+
+
+class ReplayRingUnitTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock(start=3600000000, step=1)
+        self.ring = ReplayRing(budget=1000)
+
+    def write(self, count):
+        packets = []
+        for index in xrange(count):
+            packets.extend(Packet.create('%04d' % index, PacketType.FROM_INSTRUMENT, clock=self.clock))
+        self.ring.writeSequence([packet.data for packet in packets])
+        return [packet.data for packet in packets]
+
+    def test_sequence(self):
+        written = self.write(5)
+        self.assertEqual(self.ring.sequence, 5)
+        self.assertEqual(self.ring.since_sequence(2), written[2:])
+        self.assertEqual(self.ring.tail(2), written[3:])
+        self.assertEqual(self.ring.sequence_at(3600000003), 3)
+
+    def test_budget(self):
+        written = self.write(100)
+        # 20 byte packets, 1000 byte budget
+        self.assertEqual(self.ring.first, 50)
+        self.assertEqual(self.ring.bytes, 1000)
+        self.assertEqual(self.ring.since_sequence(0), written[50:])
+
+    def test_batch(self):
+        batch = PacketBatch(['a', 'bb', 'ccc'], PacketType.FROM_INSTRUMENT, clock=self.clock)
+        self.ring.write(batch.data)
+        self.assertEqual(self.ring.sequence, 3)
+        self.assertEqual([len(data) for data in self.ring.tail(3)], [17, 18, 19])
+
+    def test_select(self):
+        written = self.write(5)
+        self.assertEqual(self.ring.select(['resume', 'seq=3']), (3, written[3:]))
+        self.assertEqual(self.ring.select(['resume', 'time=3600000004']), (4, written[4:]))
+        self.assertEqual(self.ring.select(['resume', 'seq=99']), (5, []))
+        self.assertEqual(self.ring.select(['tail', '2']), (3, written[3:]))
+        self.assertEqual(self.ring.select(['live']), (5, []))
+        self.assertRaises(ValueError, self.ring.select, ['resume', 'bogus=1'])
+        self.assertRaises(ValueError, self.ring.select, ['rewind'])
+
+
+class ReplayClientUnitTest(unittest.TestCase):
+    def setUp(self):
+        self.agent = FakePortAgent()
+        self.router = self.agent.router
+        self.router.got_data(Packet.create('before', PacketType.FROM_INSTRUMENT))
+
+    def connect(self):
+        protocol = ReplayClientProtocol(self.agent, PacketType.FROM_DRIVER, EndpointType.CLIENT)
+        transport = StringTransport()
+        protocol.makeConnection(transport)
+        return protocol, transport
+
+    def test_resume(self):
+        protocol, transport = self.connect()
+        # not registered, and receives nothing, until the request
+        self.router.got_data(Packet.create('gap', PacketType.FROM_INSTRUMENT))
+        self.assertEqual(transport.value(), '')
+
+        protocol.dataReceived('resume seq=1\n')
+        self.router.got_data(Packet.create('live', PacketType.FROM_INSTRUMENT))
+        packets = PacketDecoder().feed(transport.value())
+        self.assertEqual([packet.payload for packet in packets], ['REPLAY 1 2', 'gap', 'live'])
+        self.assertEqual(self.agent.clients, {protocol})
+
+    def test_reject(self):
+        protocol, transport = self.connect()
+        protocol.dataReceived('rewind\n')
+        packets = PacketDecoder().feed(transport.value())
+        self.assertEqual(packets[0].header.packet_type, PacketType.PA_FAULT)
+        self.assertTrue(transport.disconnecting)
+        protocol.connectionLost()
+        self.assertEqual(self.agent.clients, set())
+
+
+class DatalogReplayStartUnitTest(unittest.TestCase):
+    def test_waits_for_client(self):
+        # the replay ring is registered as a CLIENT endpoint, replay waits for a connected client
+        fake = FakePortAgent()
+        agent = DatalogReadingPortAgent.__new__(DatalogReadingPortAgent)
+        agent.router = fake.router
+        agent.clients = fake.clients
+        agent.stopped = False
+        agent.playback = FakePlayback()
+        try:
+            agent._start_when_ready()
+            self.assertFalse(agent.playback.started)
+            fake.client_connected(object())
+            agent._start_when_ready()
+            self.assertTrue(agent.playback.started)
+        finally:
+            for call in reactor.getDelayedCalls():
+                if call.func == agent._start_when_ready:
+                    call.cancel()
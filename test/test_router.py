@@ -0,0 +1,255 @@
+import unittest
+from ooi_port_agent.common import EndpointType, Format, OutputPolicy, PacketType
+from ooi_port_agent.formatter import format_packets
+from ooi_port_agent.packet import FakeClock, Packet, PacketBatch
+from ooi_port_agent.router import Router
+from ooi_port_agent.subscription import Subscription
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.producer = None
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def loseConnection(self):
+        self.disconnecting = True
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.transport = FakeTransport()
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data)
+
+
+class SequenceClient(FakeClient):
+    def __init__(self):
+        super(SequenceClient, self).__init__()
+        self.sequences = []
+
+    def writeSequence(self, data):
+        self.sequences.append(list(data))
+
+
+class FakeProducer(object):
+    def __init__(self):
+        self.paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+class UnpackablePacket(Packet):
+    @property
+    def data(self):
+        raise AssertionError('packet should not be packed')
+
+
+class RouterUnitTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock(start=3600000000, step=1)
+        self.router = Router()
+        self.router.formatter.deliver = lambda func, *args: func(*args)
+        self.router.formatter.submit = self.router.formatter.format
+        self.router.add_route(PacketType.ALL, EndpointType.LOGGER, data_format=Format.ASCII)
+        self.router.add_route(PacketType.ALL, EndpointType.DATALOGGER, data_format=Format.PACKET)
+        self.router.add_route(PacketType.FROM_INSTRUMENT, EndpointType.CLIENT, data_format=Format.PACKET)
+        self.router.add_route(PacketType.FROM_DRIVER, EndpointType.INSTRUMENT, data_format=Format.RAW)
+
+    def create(self, payload, packet_type=PacketType.FROM_INSTRUMENT):
+        return Packet.create(payload, packet_type, clock=self.clock)
+
+    def test_route_formats(self):
+        clients = {endpoint_type: FakeClient() for endpoint_type in
+                   (EndpointType.LOGGER, EndpointType.DATALOGGER, EndpointType.CLIENT, EndpointType.INSTRUMENT)}
+        for endpoint_type, client in clients.iteritems():
+            self.router.register(endpoint_type, client)
+
+        from_instrument = self.create('abc123')
+        from_driver = self.create('cmd', PacketType.FROM_DRIVER)
+        self.router.got_data(from_instrument + from_driver)
+
+        self.assertEqual(clients[EndpointType.CLIENT].writes, [from_instrument[0].data])
+        self.assertEqual(clients[EndpointType.INSTRUMENT].writes, ['cmd'])
+        self.assertEqual(clients[EndpointType.DATALOGGER].writes, [from_instrument[0].data + from_driver[0].data])
+        self.assertEqual(clients[EndpointType.LOGGER].writes, [format_packets(from_instrument + from_driver)])
+        self.assertEqual(self.router.packets_in, 2)
+        self.assertEqual(self.router.packets_out, 6)
+
+    def test_register_deregister(self):
+        first = FakeClient()
+        second = FakeClient()
+        self.router.register(EndpointType.CLIENT, first)
+        self.router.register(EndpointType.CLIENT, second)
+        self.assertIs(first.transport.producer, self.router.outputs[first])
+
+        self.router.got_data(self.create('one'))
+        self.router.deregister(EndpointType.CLIENT, first)
+        self.router.got_data(self.create('two'))
+
+        self.assertEqual(len(first.writes), 1)
+        self.assertEqual(len(second.writes), 2)
+        self.assertEqual(self.router.clients_added, 2)
+        self.assertEqual(self.router.clients_removed, 1)
+
+    def test_lazy_packing(self):
+        instrument = FakeClient()
+        self.router.register(EndpointType.INSTRUMENT, instrument)
+
+        packet = self.create('cmd', PacketType.FROM_DRIVER)[0]
+        self.router.got_data([UnpackablePacket(payload=packet.payload, header=packet.header)])
+        self.assertEqual(instrument.writes, ['cmd'])
+
+    def test_got_batch(self):
+        clients = [FakeClient() for _ in xrange(3)]
+        for client in clients:
+            self.router.register(EndpointType.CLIENT, client)
+
+        batch = PacketBatch(['abc', 'def'], PacketType.FROM_INSTRUMENT)
+        self.router.got_batch(batch)
+
+        for client in clients:
+            self.assertEqual(client.writes, [batch.data])
+        self.assertEqual(self.router.packets_in, 2)
+        self.assertEqual(self.router.packets_out, 6)
+
+    def test_coalesce_write_sequence(self):
+        client = SequenceClient()
+        self.router.register(EndpointType.CLIENT, client)
+
+        packets = self.create('one') + self.create('two') + self.create('three')
+        self.router.got_data(packets)
+
+        self.assertEqual(client.sequences, [[packet.data for packet in packets]])
+        self.assertEqual(client.writes, [])
+        self.assertEqual(self.router.writes_saved, 2)
+
+    def test_flush_bytes(self):
+        self.router.flush_bytes = 40
+        client = SequenceClient()
+        self.router.register(EndpointType.CLIENT, client)
+
+        # each packet is 16 byte header plus a 10 byte payload, the cap is reached on every second packet
+        packets = [self.create('%010d' % i)[0] for i in xrange(5)]
+        self.router.got_data(packets)
+
+        self.assertEqual(client.sequences, [[packets[0].data, packets[1].data],
+                                            [packets[2].data, packets[3].data],
+                                            [packets[4].data]])
+
+    def test_flush_delay(self):
+        self.router.flush_delay = 1
+        client = SequenceClient()
+        self.router.register(EndpointType.CLIENT, client)
+
+        first = self.create('one')
+        second = self.create('two')
+        self.router.got_data(first)
+        self.router.got_data(second)
+        self.assertEqual(client.sequences, [])
+        self.assertIsNotNone(self.router._flush_call)
+
+        self.router.flush()
+        self.assertIsNone(self.router._flush_call)
+        self.assertEqual(client.sequences, [[first[0].data, second[0].data]])
+
+    def test_deregister_discards_pending(self):
+        self.router.flush_delay = 1
+        client = SequenceClient()
+        self.router.register(EndpointType.CLIENT, client)
+
+        self.router.got_data(self.create('one'))
+        self.router.deregister(EndpointType.CLIENT, client)
+        self.router.flush()
+        self.assertEqual(client.sequences, [])
+
+    def test_pause_upstream(self):
+        producer = FakeProducer()
+        self.router.registerProducer(producer)
+        first = FakeClient()
+        second = FakeClient()
+        self.router.register(EndpointType.CLIENT, first)
+        self.router.register(EndpointType.CLIENT, second)
+
+        first.transport.producer.pauseProducing()
+        second.transport.producer.pauseProducing()
+        self.assertTrue(producer.paused)
+
+        first.transport.producer.resumeProducing()
+        self.assertTrue(producer.paused)
+        self.router.deregister(EndpointType.CLIENT, second)
+        self.assertFalse(producer.paused)
+
+    def test_stalled_client_without_producers(self):
+        # a live agent registers no producers, a client which never drains stays within its budget
+        self.router.budget = 1000
+        client = FakeClient()
+        self.router.register(EndpointType.CLIENT, client)
+        output = self.router.outputs[client]
+        output.pauseProducing()
+        for index in xrange(100):
+            self.router.got_data(self.create('%04d' % index))
+            self.router.flush()
+            self.assertTrue(output.held_bytes <= 1000)
+        self.assertEqual(client.writes, [])
+        self.assertTrue(output.disconnected)
+        self.assertTrue(client.transport.disconnecting)
+        self.assertEqual(self.router.paused_outputs, set())
+
+    def test_policy_override(self):
+        self.router.policies = {EndpointType.CLIENT: OutputPolicy.DROP_NEWEST}
+        client = FakeClient()
+        self.router.register(EndpointType.CLIENT, client)
+        self.assertEqual(self.router.outputs[client].policy, OutputPolicy.DROP_NEWEST)
+        self.assertEqual(self.router.output_stats()[0]['policy'], OutputPolicy.DROP_NEWEST)
+
+    def test_subscribe_type(self):
+        client = FakeClient()
+        self.router.register(EndpointType.CLIENT, client)
+        self.router.add_route(PacketType.PA_STATUS, EndpointType.CLIENT, data_format=Format.PACKET)
+        self.router.subscribe(self.router.outputs[client], Subscription(packet_types=[PacketType.PA_STATUS]))
+        self.assertNotIn(PacketType.FROM_INSTRUMENT, self.router.dispatch)
+
+        status = self.create('CONNECTED', PacketType.PA_STATUS)
+        self.router.got_data(self.create('abc') + status)
+        self.assertEqual(client.writes, [status[0].data])
+
+        self.router.subscribe(self.router.outputs[client], None)
+        self.assertIn(PacketType.FROM_INSTRUMENT, self.router.dispatch)
+
+    def test_subscribe_filtered(self):
+        matching = FakeClient()
+        other = FakeClient()
+        sniffer = FakeClient()
+        self.router.register(EndpointType.CLIENT, matching)
+        self.router.register(EndpointType.CLIENT, other)
+        self.router.register(EndpointType.LOGGER, sniffer)
+        self.router.subscribe(self.router.find_output(self.router.outputs[matching].name), Subscription(prefix='$GP'))
+        self.router.subscribe(self.router.outputs[sniffer], Subscription(regex='GGA'))
+
+        packets = self.create('$GPRMC') + self.create('SAMPLE') + self.create('$GPGGA')
+        self.router.got_data(packets)
+
+        self.assertEqual(matching.writes, [packets[0].data + packets[2].data])
+        self.assertEqual(other.writes, [''.join(packet.data for packet in packets)])
+        self.assertEqual(sniffer.writes, [format_packets(packets[2:])])
+        self.assertEqual(self.router.packets_out, 6)
+
+    def test_subscribe_batch(self):
+        client = FakeClient()
+        self.router.register(EndpointType.CLIENT, client)
+        self.router.subscribe(self.router.outputs[client], Subscription(prefix='d'))
+
+        batch = PacketBatch(['abc', 'def'], PacketType.FROM_INSTRUMENT)
+        self.router.got_batch(batch)
+        self.assertEqual(client.writes, [batch.wire(1)])
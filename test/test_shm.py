@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+import unittest
+from ooi_port_agent.common import PacketType
+from ooi_port_agent.packet import Packet
+from ooi_port_agent.shm import MIN_CAPACITY, ShmReader, ShmRing
+
+
+class ShmRingUnitTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'ring')
+        self.ring = ShmRing(self.path, MIN_CAPACITY)
+        self.reader = ShmReader(self.path)
+
+    def tearDown(self):
+        self.reader.close()
+        self.ring.close()
+        shutil.rmtree(self.tempdir)
+
+    def write(self, payload, count=1):
+        packets = []
+        for _ in xrange(count):
+            packets.extend(Packet.create(payload, PacketType.FROM_INSTRUMENT))
+        self.ring.writeSequence([packet.data for packet in packets])
+        return packets
+
+    def test_read(self):
+        self.assertEqual(self.reader.read_packets(), [])
+        written = self.write('abc', 3)
+        packets = self.reader.read_packets()
+        self.assertEqual([p.data for p in packets], [p.data for p in written])
+        self.assertEqual(self.reader.read_packets(), [])
+
+    def test_wrap(self):
+        payload = 'x' * 1000
+        # position the write just before the end of the data region
+        for _ in xrange(MIN_CAPACITY // 4096):
+            self.write(payload, 4)
+            self.reader.read_packets()
+        for _ in xrange(4):
+            written = self.write(payload, 3)
+            packets = self.reader.read_packets()
+            self.assertEqual([p.data for p in packets], [p.data for p in written])
+        self.assertEqual(self.reader.lost, 0)
+
+    def test_overrun(self):
+        self.write('x' * 1000, MIN_CAPACITY // 1000 + 1)
+        self.assertEqual(self.reader.read_packets(), [])
+        self.assertEqual(self.reader.overruns, 1)
+        self.assertEqual(self.reader.cursor, self.ring.position)
+
+        # the reader continues with the next write
+        written = self.write('abc')
+        self.assertEqual([p.data for p in self.reader.read_packets()], [p.data for p in written])
+
+    def test_read_during_write(self):
+        # the reader lags by all but 1024 bytes of the ring
+        self.write('x' * 1000, MIN_CAPACITY // 1024)
+        copy = self.ring._copy
+        reads = []
+
+        def interleaved(chunk):
+            # half the chunk wraps over the oldest unread packet before the reader copies
+            copy(chunk[:len(chunk) // 2])
+            reads.append(self.reader.read())
+            copy(chunk)
+
+        self.ring._copy = interleaved
+        written = self.write('y' * 1000, 4)
+        self.assertEqual(reads, [''])
+        self.assertEqual(self.reader.overruns, 1)
+
+        # the reader continues with the completed write
+        self.assertEqual([p.data for p in self.reader.read_packets()], [p.data for p in written])
+
+    def test_independent_readers(self):
+        self.write('abc')
+        second = ShmReader(self.path)
+        written = self.write('def')
+        self.assertEqual(len(self.reader.read_packets()), 2)
+        self.assertEqual([p.data for p in second.read_packets()], [p.data for p in written])
+        second.close()
+
+    def test_invalid_capacity(self):
+        self.assertRaises(ValueError, ShmRing, self.path + '2', MIN_CAPACITY - 1)
@@ -0,0 +1,55 @@
+import datetime
+import unittest
+from ooi_port_agent.common import PacketType
+from ooi_port_agent.packet import FakeClock, Packet
+from ooi_port_agent.subscription import Subscription, parse_time
+
+
+class SubscriptionUnitTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock(start=3600000000, step=10)
+
+    def create(self, payload, packet_type=PacketType.FROM_INSTRUMENT):
+        return Packet.create(payload, packet_type, clock=self.clock)[0]
+
+    def test_parse(self):
+        subscription = Subscription.parse(['type=FROM_INSTRUMENT,4', 'start=1970-01-01T00:00:00Z',
+                                           'end=3600000000.5', 'prefix=$GP', r'regex=\d+'])
+        self.assertEqual(subscription.packet_types, {PacketType.FROM_INSTRUMENT, PacketType.PA_STATUS})
+        self.assertEqual(subscription.start, 2208988800)
+        self.assertEqual(subscription.end, 3600000000.5)
+        self.assertEqual(subscription.prefix, '$GP')
+        self.assertTrue(subscription.per_packet)
+        self.assertEqual(subscription.describe()[0], 'type=FROM_INSTRUMENT,PA_STATUS')
+
+    def test_parse_time(self):
+        # dates and datetimes as loaded from YAML
+        self.assertEqual(parse_time(datetime.datetime(1970, 1, 1, 0, 0, 1, 500000)), 2208988801.5)
+        self.assertEqual(parse_time(datetime.date(1970, 1, 2)), 2208988800 + 86400)
+
+    def test_parse_errors(self):
+        self.assertRaises(ValueError, Subscription.parse, ['type=NOT_A_TYPE'])
+        self.assertRaises(ValueError, Subscription.parse, ['type=99'])
+        self.assertRaises(ValueError, Subscription.parse, ['bogus=1'])
+        self.assertRaises(ValueError, Subscription.parse, ['prefix'])
+        self.assertRaises(ValueError, Subscription.parse, ['regex=('])
+
+    def test_type_only(self):
+        subscription = Subscription.parse(['type=PA_STATUS'])
+        self.assertFalse(subscription.per_packet)
+        self.assertTrue(subscription.accepts_type(PacketType.PA_STATUS))
+        self.assertFalse(subscription.accepts_type(PacketType.FROM_INSTRUMENT))
+        self.assertTrue(Subscription().accepts_type(PacketType.FROM_INSTRUMENT))
+
+    def test_matches(self):
+        first = self.create('$GPRMC,1')
+        second = self.create('$GPGGA,2')
+        third = self.create('SAMPLE 3')
+
+        self.assertTrue(Subscription(prefix='$GP').matches(first))
+        self.assertFalse(Subscription(prefix='$GP').matches(third))
+        self.assertTrue(Subscription(regex='GGA').matches(second))
+        self.assertFalse(Subscription(regex='GGA').matches(first))
+
+        window = Subscription(start=second.header.time, end=third.header.time)
+        self.assertEqual([window.matches(packet) for packet in (first, second, third)], [False, True, False])
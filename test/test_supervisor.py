@@ -0,0 +1,103 @@
+import unittest
+from twisted.internet.task import Clock
+from ooi_port_agent.supervisor import Supervisor, assign, plan_move, worker_loads
+
+
+class FakeWorker(object):
+    def __init__(self, index):
+        self.index = index
+        self.running = True
+        self.failures = 0
+        self.restarts = 0
+        self.sent = []
+
+    def send(self, **message):
+        self.sent.append(message)
+
+    def spawn(self):
+        self.running = True
+
+
+def agent_stats(name, bytes_in):
+    return {'name': name, 'packet_types': {'DATA_FROM_INSTRUMENT': {'bytes_in': bytes_in, 'bytes_out': 0}}}
+
+
+class PlacementUnitTest(unittest.TestCase):
+    def test_assign_even(self):
+        assignment = assign(['a', 'b', 'c', 'd', 'e'], 2)
+        self.assertEqual(sorted(worker_loads(assignment, {n: 1 for n in assignment}, 2)), [2, 3])
+
+    def test_assign_rates(self):
+        rates = {'a': 100, 'b': 60, 'c': 50, 'd': 10}
+        assignment = assign(rates, 2, rates)
+        self.assertEqual(sorted(worker_loads(assignment, rates, 2)), [110, 110])
+
+    def test_plan_move(self):
+        rates = {'a': 5000, 'b': 3000, 'c': 1000, 'd': 1000}
+        assignment = {'a': 0, 'b': 0, 'c': 1, 'd': 1}
+        # gap is 6000, moving b (3000) leaves both workers at 5000
+        self.assertEqual(plan_move(assignment, rates, 2), ('b', 0, 1))
+
+    def test_plan_move_balanced(self):
+        rates = {'a': 5000, 'b': 4500}
+        self.assertIsNone(plan_move({'a': 0, 'b': 1}, rates, 2))
+        # a single busy agent can not be split
+        self.assertIsNone(plan_move({'a': 0}, {'a': 9000}, 2))
+        # below the minimum rate nothing is moved
+        self.assertIsNone(plan_move({'a': 0, 'b': 0}, {'a': 100, 'b': 100}, 2))
+
+
+class SupervisorUnitTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        configs = [{'name': name, 'type': 'tcp'} for name in ('a', 'b', 'c', 'd')]
+        self.supervisor = Supervisor(configs, 2, clock=self.clock)
+        self.workers = self.supervisor.workers = [FakeWorker(0), FakeWorker(1)]
+        self.supervisor.assignment = {'a': 0, 'b': 0, 'c': 1, 'd': 1}
+
+    def report(self, worker, **totals):
+        stats = [agent_stats(name, total) for name, total in sorted(totals.iteritems())]
+        self.supervisor.worker_message(worker, {'stats': stats})
+
+    def test_rebalance(self):
+        self.report(self.workers[0], a=0, b=0)
+        self.report(self.workers[1], c=0, d=0)
+        self.clock.advance(10)
+        self.report(self.workers[0], a=50000, b=30000)
+        self.report(self.workers[1], c=10000, d=10000)
+        self.assertEqual(self.supervisor.rates['b'], 3000)
+
+        self.supervisor.rebalance()
+        self.assertEqual(self.workers[0].sent, [{'stop': 'b'}])
+        self.assertEqual(self.supervisor.moving, {'b': (0, 1)})
+
+        # no further moves until the agent has stopped
+        self.supervisor.rebalance()
+        self.assertEqual(len(self.workers[0].sent), 1)
+
+        self.supervisor.worker_message(self.workers[0], {'stopped': 'b'})
+        self.assertEqual(self.workers[1].sent, [{'start': {'name': 'b', 'type': 'tcp'}}])
+        self.assertEqual(self.supervisor.moving, {})
+        self.assertEqual(self.supervisor.agents(1), ['b', 'c', 'd'])
+
+    def test_finished_agent(self):
+        self.supervisor.worker_message(self.workers[0], {'stopped': 'a'})
+        self.assertNotIn('a', self.supervisor.assignment)
+        self.assertEqual(self.supervisor.finished, {'a'})
+
+    def test_restart(self):
+        self.workers[0].running = False
+        self.supervisor.worker_ended(self.workers[0])
+        self.clock.advance(1)
+        self.assertTrue(self.workers[0].running)
+        self.assertEqual(self.workers[0].restarts, 1)
+
+        self.workers[0].running = False
+        self.supervisor.worker_ended(self.workers[0])
+        self.clock.advance(1)
+        self.assertFalse(self.workers[0].running)
+        self.clock.advance(1)
+        self.assertTrue(self.workers[0].running)
+
+        self.supervisor.worker_started(self.workers[0])
+        self.assertEqual([m['start']['name'] for m in self.workers[0].sent], ['a', 'b'])